@@ -0,0 +1,313 @@
+# In this file we announce to every tracker a torrent lists (BEP 12).
+# The announce-list is a list of tiers. Trackers within a tier are shuffled
+# once and then tried in order, and one that answers is moved to the front
+# of its tier so it is asked first next time. We don't want a dead tracker
+# to hold up startup, though: every tier is announced to concurrently, and
+# within a tier the next tracker is started when the current one fails or
+# hasn't answered after `stagger` seconds. Peers are handed out as soon as
+# any tracker returns them, de-duplicated across the trackers of a round.
+#
+# While a download runs, start() keeps announcing in the background. Each
+# tier runs on its own schedule: it re-announces every `interval` seconds
+# its tracker gave (never sooner than `min interval`), so a dead tracker
+# stuck in UDP retries only delays its own tier. Every tier sends
+# `completed` as soon as the download finishes, abandoning an announce in
+# flight, and `stopped` when it is shut down; every peer a tier gets is
+# pushed onto the downloader's queue.
+# Peers are not de-duplicated across rounds: the connection manager ignores
+# addresses it already knows, and one it dropped after repeated failures
+# gets another chance when a tracker still lists it.
+
+import asyncio
+import logging
+import random
+
+from get_peers import announce, make_peer_id
+from metainfo import as_metainfo
+from udp_parser import UDPTrackerClient
+
+log = logging.getLogger(__name__)
+
+# Re-announce interval when trackers don't give one
+DEFAULT_INTERVAL = 1800
+# First retry delay after a round in which no tracker answered (doubles up to the interval)
+RETRY_INTERVAL = 60
+# How long shutdown waits for the `stopped` announce
+STOPPED_TIMEOUT = 5
+# Returned when the download completes while a tier is being announced to
+_INTERRUPTED = object()
+
+
+class AnnounceManager:
+    """Concurrent multi-tracker announces for one torrent."""
+
+    def __init__(self, torrent, peer_id=None, port=6881, numwant=50, udp_client=None, stagger=2.0):
+        """
+        Args:
+            torrent: A Metainfo, or the path to a .torrent file.
+            peer_id: Our 20-byte peer ID (random if omitted).
+            port: The port we accept peers on.
+            numwant: Peers to ask each tracker for.
+            udp_client: A UDPTrackerClient to share with other torrents.
+            stagger: Seconds to wait on a tracker before also trying the
+                next one in its tier.
+        """
+        self.metainfo = as_metainfo(torrent)
+        self.peer_id = peer_id or make_peer_id()
+        self.port = port
+        self.numwant = numwant
+        self.stagger = stagger
+        self.owns_udp_client = udp_client is None
+        self.udp_client = udp_client or UDPTrackerClient()
+
+        # BEP 12: announce-list replaces announce when present
+        if self.metainfo.announce_list:
+            self.tiers = [list(tier) for tier in self.metainfo.announce_list if tier]
+        elif self.metainfo.announce:
+            self.tiers = [[self.metainfo.announce]]
+        else:
+            raise ValueError("Torrent file has no trackers")
+        for tier in self.tiers:
+            random.shuffle(tier)
+
+        # Every peer seen so far, and the last answer from each tracker
+        self.peers = set()
+        self.results = {}
+
+        # Background announcing while a download runs
+        self._task = None
+        self._completed = asyncio.Event()
+        # Tiers already sent `completed`, and the shielded announces sending it
+        self._completed_tiers = set()
+        self._completing = {}
+
+    async def announce_iter(self, event='started', left=None, downloaded=0, uploaded=0):
+        """
+        Announce to all tiers at once, yielding peers as trackers answer.
+
+        Yields:
+            list: (ip, port) tuples not yielded before in this round.
+        """
+        if left is None:
+            left = self.metainfo.total_length
+        results = asyncio.Queue()
+        tasks = [asyncio.create_task(self._announce_tier(tier, results, event, left, downloaded, uploaded))
+                 for tier in self.tiers]
+        remaining = len(tasks)
+        seen = set()
+        try:
+            while remaining:
+                result = await results.get()
+                if result is None:
+                    remaining -= 1
+                    continue
+                new_peers = [peer for peer in result.peers if peer not in seen]
+                seen.update(new_peers)
+                self.peers.update(new_peers)
+                if new_peers:
+                    yield new_peers
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def announce_all(self, event='started', left=None, downloaded=0, uploaded=0, enough=None):
+        """
+        Announce and collect the merged peer list.
+
+        Args:
+            enough: Return as soon as this many peers are known instead of
+                waiting for every tier (default: numwant).
+
+        Returns:
+            list: De-duplicated (ip, port) tuples.
+        """
+        enough = self.numwant if enough is None else enough
+        peers = []
+        async for new_peers in self.announce_iter(event, left, downloaded, uploaded):
+            peers.extend(new_peers)
+            if len(peers) >= enough:
+                break
+        return peers
+
+    async def _announce_tier(self, tier, results, event, left, downloaded, uploaded):
+        """Announce to one tier, putting its result (if any) and then None on `results`."""
+        try:
+            result = await self._announce_to_tier(tier, event, left, downloaded, uploaded)
+            if result is not None:
+                results.put_nowait(result)
+        finally:
+            results.put_nowait(None)
+
+    async def _announce_to_tier(self, tier, event, left, downloaded, uploaded):
+        """Announce to one tier; returns the first successful result, or None."""
+        pending = {}
+        try:
+            for url in list(tier):
+                task = asyncio.create_task(announce(url, self.metainfo.info_hash, self.peer_id, left,
+                                                    self.port, self.numwant, downloaded, uploaded,
+                                                    event, udp_client=self.udp_client))
+                pending[task] = url
+                # Give this tracker `stagger` seconds before starting the next one,
+                # but keep waiting on every tracker already started
+                winner = await self._first_success(pending, self.stagger)
+                if winner is not None:
+                    break
+            else:
+                winner = await self._first_success(pending, None)
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        if winner is None:
+            return None
+        url, result = winner
+        self.results[url] = result
+        # Promote the tracker that answered to the front of its tier
+        tier.remove(url)
+        tier.insert(0, url)
+        return result
+
+    async def _first_success(self, pending, timeout):
+        """Wait for one of `pending` to succeed; failed ones are dropped from it."""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while pending:
+            wait = None if deadline is None else max(0, deadline - loop.time())
+            done, _ = await asyncio.wait(pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                return None
+            for task in done:
+                url = pending.pop(task)
+                try:
+                    return url, task.result()
+                except Exception as e:
+                    log.warning("Tracker %s failed: %s", url, e)
+        return None
+
+    def start(self, peer_queue, get_stats):
+        """
+        Announce in the background until stop() is called.
+
+        Args:
+            peer_queue: asyncio.Queue that receives every new (ip, port).
+            get_stats: Callable returning (downloaded, uploaded, left) in bytes.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(peer_queue, get_stats))
+        return self._task
+
+    def completed(self):
+        """Tell the trackers, right away, that the download has finished."""
+        self._completed.set()
+
+    async def stop(self, get_stats=None):
+        """Stop announcing and send a best-effort `stopped` event."""
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        downloaded, uploaded, left = get_stats() if get_stats else (0, 0, None)
+        # Every tier gets its own timeout, so a dead one can't hold up the rest
+        await asyncio.gather(*(self._stop_tier(i, tier, downloaded, uploaded, left)
+                               for i, tier in enumerate(self.tiers)))
+
+    async def _stop_tier(self, i, tier, downloaded, uploaded, left):
+        # The download may finish and shut down before this tier was sent `completed`
+        events = ['stopped']
+        if self._completed.is_set() and i not in self._completed_tiers:
+            completing = self._completing.get(i)
+            if completing is not None:
+                try:
+                    await asyncio.wait_for(completing, STOPPED_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.CancelledError):
+                    pass
+            else:
+                events.insert(0, 'completed')
+            self._completed_tiers.add(i)
+        for event in events:
+            try:
+                await asyncio.wait_for(self._announce_to_tier(tier, event, left, downloaded, uploaded),
+                                       STOPPED_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self, peer_queue, get_stats):
+        tasks = [asyncio.create_task(self._run_tier(i, tier, peer_queue, get_stats))
+                 for i, tier in enumerate(self.tiers)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run_tier(self, i, tier, peer_queue, get_stats):
+        """Re-announce to one tier on its own interval."""
+        # If announce_all() already sent `started` here, wait one interval first
+        result = next((self.results[url] for url in tier if url in self.results), None)
+        announce_now = result is None
+        event = 'started'
+        retry = RETRY_INTERVAL
+        while True:
+            if announce_now:
+                downloaded, uploaded, left = get_stats()
+                if self._completed.is_set() and i not in self._completed_tiers:
+                    # Shielded, so stop() can let it finish instead of sending it twice
+                    completing = self._completing[i] = asyncio.ensure_future(
+                        self._announce_to_tier(tier, 'completed', left, downloaded, uploaded))
+                    result = await asyncio.shield(completing)
+                    self._completed_tiers.add(i)
+                else:
+                    result = await self._until_completed(
+                        self._announce_to_tier(tier, event, left, downloaded, uploaded))
+                    if result is _INTERRUPTED:
+                        # The download finished mid-announce: send `completed` instead
+                        continue
+                if result is not None:
+                    self.peers.update(result.peers)
+                    for peer in result.peers:
+                        peer_queue.put_nowait(peer)
+            announce_now = True
+            event = None
+
+            if result is not None:
+                interval = self.next_interval([result])
+                retry = RETRY_INTERVAL
+            else:
+                interval = retry
+                retry = min(retry * 2, DEFAULT_INTERVAL)
+            # Sleep until the next announce is due, waking early to send `completed`
+            wake = self._completed if i not in self._completed_tiers else asyncio.Event()
+            try:
+                await asyncio.wait_for(wake.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _until_completed(self, coro):
+        """Run `coro`, returning _INTERRUPTED if the download completes first."""
+        if self._completed.is_set():
+            return await coro
+        task = asyncio.ensure_future(coro)
+        waiter = asyncio.ensure_future(self._completed.wait())
+        try:
+            await asyncio.wait((task, waiter), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        return task.result() if not task.cancelled() else _INTERRUPTED
+
+    @staticmethod
+    def next_interval(results):
+        """Seconds until the next announce: the shortest interval, but not below any min interval."""
+        interval = min((r.interval for r in results if r.interval), default=DEFAULT_INTERVAL)
+        min_interval = max((r.min_interval for r in results if r.min_interval), default=0)
+        return max(interval, min_interval)
+
+    def close(self):
+        if self.owns_udp_client:
+            self.udp_client.close()
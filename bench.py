@@ -0,0 +1,384 @@
+# In this file we benchmark the download path without touching the network.
+# A synthetic torrent is generated on local disk, N in-process seeders serve
+# it over loopback using the same wire framing as AsyncBitTorrentPeer, and
+# a stand-in HTTP tracker hands their addresses out. TorrentDownloader then
+# fetches the torrent through the normal tracker + peer code path and we
+# report throughput, per-piece latency, CPU time and peak memory.
+#
+# Usage:
+#   python bench.py --size 512M --piece-length 1M --seeders 4
+#   python bench.py --size 512M --profile before.json   (see profiling.py)
+
+import argparse
+import asyncio
+import collections
+import hashlib
+import http.server
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import struct
+import tempfile
+import threading
+import time
+
+from parser import bencode, info_hash_of
+from metainfo import Metainfo
+from storage import PieceStorage
+from peer_protocol import PeerWireProtocol
+from profiling import RunProfiler
+from announce_manager import AnnounceManager
+from connect_to_peer_async import TorrentDownloader
+from piece_picker import _full_bitfield
+
+_SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+# Blocks a bench seeder sends per loop iteration, so cancels read in
+# between can still take back requests that are queued
+_SERVE_BATCH = 16
+
+
+def parse_size(text):
+    """Parse sizes such as '256K', '64M' or '1G' into bytes."""
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in _SIZE_SUFFIXES:
+        return int(float(text[:-1]) * _SIZE_SUFFIXES[text[-1]])
+    return int(text)
+
+
+def make_synthetic_torrent(directory, size, piece_length, num_files=1, seed=0):
+    """
+    Write `size` bytes of pseudo-random data under `directory` and build
+    a matching metainfo dictionary.
+
+    Args:
+        directory: Where the source data is written.
+        size: Total payload size in bytes.
+        piece_length: Piece length in bytes.
+        num_files: Split the payload over this many files (multi-file if > 1).
+        seed: Seed for the data generator, so runs are reproducible.
+
+    Returns:
+        tuple: (metainfo dict, path the data was written under)
+    """
+    rng = random.Random(seed)
+    name = b'bench'
+    base, extra = divmod(size, num_files)
+    lengths = [base + (1 if i < extra else 0) for i in range(num_files)]
+
+    if num_files == 1:
+        paths = [os.path.join(directory, 'bench')]
+    else:
+        paths = [os.path.join(directory, 'bench', f'file{i:04d}.bin') for i in range(num_files)]
+        os.makedirs(os.path.join(directory, 'bench'), exist_ok=True)
+
+    # Hash pieces as the data streams out, so memory stays at one piece
+    pieces = bytearray()
+    piece = hashlib.sha1()
+    piece_fill = 0
+    for path, length in zip(paths, lengths):
+        with open(path, 'wb') as f:
+            remaining = length
+            while remaining:
+                chunk = rng.randbytes(min(remaining, piece_length - piece_fill))
+                f.write(chunk)
+                piece.update(chunk)
+                piece_fill += len(chunk)
+                remaining -= len(chunk)
+                if piece_fill == piece_length:
+                    pieces += piece.digest()
+                    piece = hashlib.sha1()
+                    piece_fill = 0
+    if piece_fill:
+        pieces += piece.digest()
+
+    info = {b'name': name, b'piece length': piece_length, b'pieces': bytes(pieces)}
+    if num_files == 1:
+        info[b'length'] = size
+    else:
+        info[b'files'] = [{b'length': length, b'path': [os.path.basename(path).encode()]}
+                          for path, length in zip(paths, lengths)]
+    root = paths[0] if num_files == 1 else os.path.join(directory, 'bench')
+    return {b'info': info}, root
+
+
+class _SeederConnection:
+    """One inbound connection to a LoopbackSeeder."""
+
+    def __init__(self, seeder):
+        self.seeder = seeder
+        self.protocol = None
+        self.requests = collections.deque()
+        self._serving = False
+
+    def handshake_received(self, data):
+        if data[28:48] != self.seeder.info_hash:
+            self.protocol.transport.close()
+            return
+        reply = data[:28] + self.seeder.info_hash + self.seeder.peer_id
+        bitfield = self.seeder.bitfield
+        self.protocol.write(reply + struct.pack(">IB", 1 + len(bitfield), 5) + bitfield)
+
+    def message_received(self, msg_id, payload):
+        if msg_id == 2:
+            # Interested: seeders in the bench never choke
+            self.protocol.write(struct.pack(">IB", 1, 1))
+        elif msg_id == 6:
+            self.requests.append(struct.unpack_from(">III", payload))
+            if not self._serving:
+                self._serving = True
+                asyncio.get_running_loop().call_soon(self._serve)
+        elif msg_id == 8:
+            try:
+                self.requests.remove(struct.unpack_from(">III", payload))
+            except ValueError:
+                # Already sent
+                pass
+
+    def _serve(self):
+        for _ in range(min(_SERVE_BATCH, len(self.requests))):
+            index, begin, length = self.requests.popleft()
+            block = self.seeder.storage.read_block(index, begin, length)
+            self.protocol.write(struct.pack(">IBII", 9 + length, 7, index, begin))
+            self.protocol.write(block)
+        if self.requests and not self.protocol.transport.is_closing():
+            asyncio.get_running_loop().call_soon(self._serve)
+        else:
+            self._serving = False
+
+    def block_destination(self, index, begin, length):
+        return None
+
+    def block_received(self, index, begin, length):
+        pass
+
+    def connection_lost(self, exc):
+        self.requests.clear()
+
+
+class LoopbackSeeder:
+    """A minimal seed serving a torrent from local files over loopback."""
+
+    def __init__(self, info, data_path, info_hash, number=0):
+        self.storage = PieceStorage.from_info(info, data_path)
+        self.info_hash = info_hash
+        self.peer_id = b'-PYBNCH-' + f'{number:012d}'.encode()
+        num_pieces = len(info[b'pieces']) // 20
+        self.bitfield = _full_bitfield(num_pieces)
+        self.server = None
+
+    async def start(self, host='127.0.0.1'):
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(
+            lambda: self._new_connection(), host, 0)
+        return self.server.sockets[0].getsockname()[:2]
+
+    def _new_connection(self):
+        connection = _SeederConnection(self)
+        connection.protocol = PeerWireProtocol(connection)
+        return connection.protocol
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.storage.close()
+
+
+class _TrackerHandler(http.server.BaseHTTPRequestHandler):
+    """Answers every announce with the compact list of bench seeders."""
+
+    def do_GET(self):
+        peers = b''.join(bytes(map(int, ip.split('.'))) + struct.pack(">H", port)
+                         for ip, port in self.server.peers)
+        body = bencode({b'interval': 1800, b'peers': peers})
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LoopbackSwarm:
+    """Seeders plus a stand-in tracker, running on their own event loop thread."""
+
+    def __init__(self, info, data_path, info_hash, num_seeders):
+        self.seeders = [LoopbackSeeder(info, data_path, info_hash, i) for i in range(num_seeders)]
+        self.tracker = None
+        self.loop = None
+        self._thread = None
+
+    def start(self):
+        ready = threading.Event()
+        self.loop = asyncio.new_event_loop()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            ready.set()
+            self.loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name='bench-swarm', daemon=True)
+        self._thread.start()
+        ready.wait()
+
+        addresses = []
+        for seeder in self.seeders:
+            future = asyncio.run_coroutine_threadsafe(seeder.start(), self.loop)
+            addresses.append(future.result())
+
+        self.tracker = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _TrackerHandler)
+        self.tracker.peers = addresses
+        threading.Thread(target=self.tracker.serve_forever, name='bench-tracker', daemon=True).start()
+        host, port = self.tracker.server_address
+        return f'http://{host}:{port}/announce'
+
+    def stop(self):
+        self.tracker.shutdown()
+        self.tracker.server_close()
+        for seeder in self.seeders:
+            asyncio.run_coroutine_threadsafe(seeder.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+async def run_download(torrent_path, output_path, max_peers, profile=None):
+    """Announce to the local tracker and download the torrent; returns the downloader."""
+    if profile is not None:
+        async with RunProfiler(profile):
+            return await run_download(torrent_path, output_path, max_peers)
+    metainfo = Metainfo.load(torrent_path)
+    # Peers reach the downloader through the announcer, as in a real session;
+    # port 0 listens on a free port instead of the default 6881
+    trackers = AnnounceManager(metainfo, port=0)
+    try:
+        downloader = TorrentDownloader(metainfo, [], max_peers=max_peers, resume=False,
+                                       announcer=trackers)
+        await downloader.download(output_path)
+    finally:
+        trackers.close()
+    return downloader
+
+
+def run_benchmark(size, piece_length, num_seeders=4, num_files=1, max_peers=50,
+                  workdir=None, profile=None):
+    """
+    Run one loopback download and collect its measurements.
+
+    Returns:
+        dict: Throughput, latency percentiles, CPU time and peak RSS.
+    """
+    workdir = workdir or tempfile.mkdtemp(prefix='bt-bench-')
+    source_dir = os.path.join(workdir, 'source')
+    os.makedirs(source_dir, exist_ok=True)
+    metainfo, data_path = make_synthetic_torrent(source_dir, size, piece_length, num_files)
+    info_hash = info_hash_of(metainfo[b'info'])
+
+    swarm = LoopbackSwarm(metainfo[b'info'], data_path, info_hash, num_seeders)
+    metainfo[b'announce'] = swarm.start().encode()
+    torrent_path = os.path.join(workdir, 'bench.torrent')
+    with open(torrent_path, 'wb') as f:
+        f.write(bencode(metainfo))
+    output_path = os.path.join(workdir, 'download')
+
+    try:
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        loop_cpu_start = time.thread_time()
+        downloader = asyncio.run(run_download(torrent_path, output_path, max_peers, profile))
+        loop_cpu = time.thread_time() - loop_cpu_start
+        cpu = time.process_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+    finally:
+        swarm.stop()
+
+    latencies = sorted(downloader.piece_latencies)
+    return {
+        'completed': downloader.is_complete(),
+        'size_bytes': size,
+        'piece_length': piece_length,
+        'pieces': downloader.num_pieces,
+        'seeders': num_seeders,
+        'files': num_files,
+        'wall_seconds': round(wall, 3),
+        'throughput_mb_s': round(size / wall / 1e6, 2),
+        'piece_latency_ms': {
+            'p50': round(percentile(latencies, 0.50) * 1000, 2),
+            'p90': round(percentile(latencies, 0.90) * 1000, 2),
+            'p99': round(percentile(latencies, 0.99) * 1000, 2),
+            'max': round(downloader.max_piece_latency * 1000, 2),
+        },
+        'wasted_bytes': downloader.wasted_bytes,
+        'disk': downloader.disk_queue.stats(),
+        # Seeders run in this process too; the event loop thread is the downloader alone
+        'cpu_seconds': round(cpu, 3),
+        'event_loop_cpu_seconds': round(loop_cpu, 3),
+        'peak_rss_mb': round(_peak_rss_bytes() / 1e6, 1),
+        'workdir': workdir,
+    }
+
+
+def _peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Benchmark TorrentDownloader against loopback seeders.")
+    arg_parser.add_argument('--size', default='256M', help="Torrent payload size (e.g. 64M, 2G)")
+    arg_parser.add_argument('--piece-length', default='1M', help="Piece length (e.g. 256K, 4M)")
+    arg_parser.add_argument('--seeders', type=int, default=4, help="Number of in-process seeders")
+    arg_parser.add_argument('--files', type=int, default=1, help="Split the payload over this many files")
+    arg_parser.add_argument('--max-peers', type=int, default=50)
+    arg_parser.add_argument('--workdir', help="Directory for generated data (default: a temp dir)")
+    arg_parser.add_argument('--keep', action='store_true', help="Keep the generated data afterwards")
+    arg_parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    arg_parser.add_argument('--profile', metavar='REPORT',
+                            help="Profile the download and write a JSON report here")
+    arg_parser.add_argument('--verbose', action='store_true', help="Show the downloader's log")
+    args = arg_parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    report = run_benchmark(parse_size(args.size), parse_size(args.piece_length),
+                           num_seeders=args.seeders, num_files=args.files,
+                           max_peers=args.max_peers, workdir=args.workdir,
+                           profile=args.profile)
+    if not args.keep:
+        shutil.rmtree(report['workdir'], ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        latency = report['piece_latency_ms']
+        print(f"Downloaded {report['size_bytes'] / 1e6:.1f} MB in {report['pieces']} pieces "
+              f"from {report['seeders']} seeders: {'complete' if report['completed'] else 'INCOMPLETE'}")
+        print(f"  Throughput:     {report['throughput_mb_s']} MB/s ({report['wall_seconds']} s)")
+        print(f"  Piece latency:  p50 {latency['p50']} ms, p90 {latency['p90']} ms, "
+              f"p99 {latency['p99']} ms, max {latency['max']} ms")
+        print(f"  CPU time:       {report['cpu_seconds']} s total, "
+              f"{report['event_loop_cpu_seconds']} s on the event loop")
+        print(f"  Peak RSS:       {report['peak_rss_mb']} MB")
+        print(f"  Wasted:         {report['wasted_bytes'] / 1e6:.2f} MB of duplicate blocks")
+        disk = report['disk']
+        print(f"  Disk writes:    {disk['pieces_written']} pieces in {disk['write_calls']} writes, "
+              f"flush latency avg {disk['avg_flush_latency'] * 1e3:.2f} ms, "
+              f"max {disk['max_flush_latency'] * 1e3:.2f} ms")
+    return 0 if report['completed'] else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
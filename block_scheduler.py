@@ -0,0 +1,352 @@
+# In this file we hand out work to peers one 16 KiB block at a time.
+# A piece is no longer owned by the peer that started it: its buffer is
+# shared, and any peer that has the piece can fill its unrequested blocks.
+# When a peer asks for work it gets, in this order:
+#   1. unrequested blocks of pieces already being assembled (oldest first),
+#      so partial pieces finish instead of piling up,
+#   2. blocks of a fresh piece chosen by the PiecePicker,
+#   3. in endgame, the blocks other peers are still fetching, as duplicate
+#      requests. Endgame starts once every missing block has been requested
+#      and no more than ENDGAME_BLOCKS of them are still outstanding (deep
+#      request pipelines would otherwise start it with much of the torrent
+#      missing), and a peer holds at most MAX_DUPLICATES duplicates at once.
+# Every block remembers which peer delivered it. When a piece fails its hash
+# check and a single peer sent all of it, that peer is to blame. Otherwise
+# we keep a digest of every block and fetch the piece again from one peer
+# only: if that fails, the peer is to blame; if it verifies, the peers whose
+# blocks differ from the good copy are the ones that sent corrupt data.
+# Those block digests are computed on the hashing pool, like piece hashes.
+
+import asyncio
+import hashlib
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+BLOCK_SIZE = 16384
+# Outstanding blocks at or below which endgame starts
+ENDGAME_BLOCKS = 64
+# Duplicate requests each peer may have outstanding in endgame
+MAX_DUPLICATES = 1
+
+
+class PieceBuffer:
+    """Assembles the blocks of one piece in a preallocated buffer."""
+
+    def __init__(self, index, length, block_size=BLOCK_SIZE):
+        self.index = index
+        self.length = length
+        self.block_size = block_size
+        self.data = bytearray(length)
+        self.num_blocks = -(-length // block_size)
+        self.received = bytearray(self.num_blocks)
+        self.remaining = self.num_blocks
+        self._view = memoryview(self.data)
+        # When the piece was started, for per-piece latency
+        self.started = time.monotonic()
+        # block index -> peers with an outstanding request for it
+        self.requesters = {}
+        # Address of the peer each block came from
+        self.contributors = [None] * self.num_blocks
+        # Blocks before this index are all requested or received
+        self._cursor = 0
+        # A piece that failed its hash check is retried from a single peer
+        self.exclusive = False
+        self.owner = None
+
+    @property
+    def complete(self):
+        return self.remaining == 0
+
+    def blocks(self):
+        """List the (piece_index, begin, length) requests still missing."""
+        return [(self.index, i * self.block_size, self.block_length(i))
+                for i in range(self.num_blocks) if not self.received[i]]
+
+    def block_length(self, block_idx):
+        return min(self.block_size, self.length - block_idx * self.block_size)
+
+    def has_block(self, begin):
+        return bool(self.received[begin // self.block_size])
+
+    def block_view(self, begin, length):
+        """Writable view of a missing block, for receiving it in place."""
+        block_idx, misaligned = divmod(begin, self.block_size)
+        if misaligned or block_idx >= self.num_blocks or self.received[block_idx]:
+            return None
+        if length != self.block_length(block_idx):
+            return None
+        return self._view[begin:begin + length]
+
+    def take_unrequested(self, peer, limit, out):
+        """Assign up to `limit` blocks nobody has requested to `peer`."""
+        if self.exclusive:
+            if self.owner is None:
+                self.owner = peer
+            elif self.owner is not peer:
+                return 0
+        block_idx = self._cursor
+        taken = 0
+        while block_idx < self.num_blocks and taken < limit:
+            if not self.received[block_idx] and block_idx not in self.requesters:
+                self.requesters[block_idx] = {peer}
+                out.append((self, block_idx * self.block_size, self.block_length(block_idx)))
+                taken += 1
+            if block_idx == self._cursor and (self.received[block_idx] or block_idx in self.requesters):
+                self._cursor += 1
+            block_idx += 1
+        return taken
+
+    def all_requested(self):
+        """Whether every block is requested or received (moves the cursor past them)."""
+        while self._cursor < self.num_blocks and \
+                (self.received[self._cursor] or self._cursor in self.requesters):
+            self._cursor += 1
+        return self._cursor == self.num_blocks
+
+    def take_duplicates(self, peer, limit, out):
+        """Assign up to `limit` missing blocks that other peers are already fetching."""
+        if self.exclusive:
+            return 0
+        taken = 0
+        for block_idx, requesters in self.requesters.items():
+            if taken >= limit:
+                break
+            if peer not in requesters:
+                requesters.add(peer)
+                out.append((self, block_idx * self.block_size, self.block_length(block_idx)))
+                taken += 1
+        return taken
+
+    def unassign(self, peer, begin):
+        """`peer` will not deliver this block after all (choke, cancel, disconnect)."""
+        block_idx = begin // self.block_size
+        requesters = self.requesters.get(block_idx)
+        if requesters is None:
+            return
+        requesters.discard(peer)
+        if not requesters:
+            del self.requesters[block_idx]
+            self._cursor = min(self._cursor, block_idx)
+
+    def mark_received(self, begin, contributor=None):
+        """
+        Record a block that was received in place through block_view().
+
+        Returns:
+            set or None: The other peers that had requested the block (so
+            their requests can be cancelled), or None if it was a duplicate.
+        """
+        block_idx = begin // self.block_size
+        if self.received[block_idx]:
+            return None
+        self.received[block_idx] = 1
+        self.remaining -= 1
+        self.contributors[block_idx] = contributor
+        return self.requesters.pop(block_idx, set())
+
+    def add_block(self, begin, block, contributor=None):
+        """
+        Copy a received block into place.
+
+        Returns:
+            set or None: As for mark_received(); None if the block was a
+            duplicate or malformed.
+        """
+        block_idx, misaligned = divmod(begin, self.block_size)
+        if misaligned or block_idx >= self.num_blocks:
+            return None
+        if self.received[block_idx]:
+            return None
+        if len(block) != self.block_length(block_idx):
+            # The request it answered is gone, so let the block be requested again
+            self.requesters.pop(block_idx, None)
+            self._cursor = min(self._cursor, block_idx)
+            return None
+        self.data[begin:begin + len(block)] = block
+        return self.mark_received(begin, contributor)
+
+
+class BlockScheduler:
+    """Block-granularity work distribution on top of a PiecePicker."""
+
+    def __init__(self, picker, piece_size, block_size=BLOCK_SIZE, hash_pool=None,
+                 endgame_blocks=ENDGAME_BLOCKS, max_duplicates=MAX_DUPLICATES):
+        """
+        Args:
+            picker: PiecePicker choosing which new pieces to start.
+            piece_size: Callable returning the length of a piece.
+            block_size: Request size in bytes.
+            hash_pool: HashPool the block digests of failed pieces are
+                computed on (default: the event loop's default executor).
+            endgame_blocks: Start endgame once every missing block is
+                requested and at most this many are outstanding.
+            max_duplicates: Duplicate requests a peer may have outstanding.
+        """
+        self.picker = picker
+        self.piece_size = piece_size
+        self.block_size = block_size
+        self.hash_pool = hash_pool
+        self.endgame_blocks = endgame_blocks
+        self.max_duplicates = max_duplicates
+        # peer -> {(piece index, block index)} of the duplicates it was given
+        self.duplicates = {}
+        # Pieces being assembled, and complete ones waiting for their hash check
+        self.partial = {}
+        self.hashing = set()
+        self.endgame = False
+        # piece index -> a future of [(block digest, contributor), ...] for
+        # each failed attempt
+        self.failed_attempts = {}
+
+    def next_blocks(self, peer, count):
+        """
+        Assign up to `count` blocks for `peer` to request.
+
+        Returns:
+            list: (buffer, begin, length) tuples.
+        """
+        blocks = []
+        for buffer in self.partial.values():
+            if len(blocks) >= count:
+                return blocks
+            if peer.has_piece(buffer.index):
+                buffer.take_unrequested(peer, count - len(blocks), blocks)
+
+        while len(blocks) < count:
+            piece_idx = self.picker.pick(peer.has_piece, peer)
+            if piece_idx is None:
+                break
+            buffer = PieceBuffer(piece_idx, self.piece_size(piece_idx), self.block_size)
+            buffer.exclusive = piece_idx in self.failed_attempts
+            self.partial[piece_idx] = buffer
+            buffer.take_unrequested(peer, count - len(blocks), blocks)
+
+        if len(blocks) < count and self.in_endgame():
+            limit = min(count - len(blocks), self.max_duplicates - self._count_duplicates(peer))
+            first = len(blocks)
+            for buffer in self.partial.values():
+                if len(blocks) - first >= limit:
+                    break
+                if peer.has_piece(buffer.index):
+                    buffer.take_duplicates(peer, limit - (len(blocks) - first), blocks)
+            if len(blocks) > first:
+                taken = self.duplicates.setdefault(peer, set())
+                for buffer, begin, _ in blocks[first:]:
+                    taken.add((buffer.index, begin // buffer.block_size))
+        return blocks
+
+    def _count_duplicates(self, peer):
+        """Duplicates `peer` still has outstanding, forgetting the settled ones."""
+        taken = self.duplicates.get(peer)
+        if not taken:
+            return 0
+        for key in list(taken):
+            buffer = self.partial.get(key[0])
+            if buffer is None or peer not in buffer.requesters.get(key[1], ()):
+                taken.discard(key)
+        return len(taken)
+
+    def in_endgame(self):
+        """
+        Whether every missing block is requested, with few enough still
+        outstanding that duplicating them is worth it.
+        """
+        if not self.endgame:
+            started = self.picker.num_have + len(self.partial) + len(self.hashing)
+            if started < self.picker.num_pieces:
+                return False
+            outstanding = 0
+            for buffer in self.partial.values():
+                if not buffer.all_requested():
+                    return False
+                outstanding += buffer.remaining
+                if outstanding > self.endgame_blocks:
+                    return False
+            self.endgame = True
+            log.info("Entering endgame with %d blocks outstanding in %d pieces", outstanding,
+                     len(self.partial))
+        return self.endgame
+
+    def unassign(self, peer, piece_idx, begin):
+        """Give a block `peer` won't deliver back to the pool."""
+        buffer = self.partial.get(piece_idx)
+        if buffer is not None:
+            buffer.unassign(peer, begin)
+
+    def peer_gone(self, peer):
+        """Return every block assigned to a departing peer to the pool."""
+        for buffer in self.partial.values():
+            for block_idx in [i for i, requesters in buffer.requesters.items() if peer in requesters]:
+                buffer.unassign(peer, block_idx * buffer.block_size)
+            # Let another peer take over a piece it was retrying on its own
+            if buffer.owner is peer:
+                buffer.owner = None
+        self.duplicates.pop(peer, None)
+
+    def piece_complete(self, buffer):
+        """A piece has all its blocks; it is hashed next and must not change."""
+        del self.partial[buffer.index]
+        self.hashing.add(buffer.index)
+
+    async def piece_verified(self, buffer):
+        """
+        Record a piece that passed its hash check.
+
+        The piece is marked as had right away; comparing it with earlier
+        failed attempts waits for their block digests.
+
+        Returns:
+            set: Addresses of peers that sent corrupt blocks for an earlier,
+            failed attempt at this piece.
+        """
+        self.hashing.discard(buffer.index)
+        self.picker.mark_have(buffer.index)
+        attempts = self.failed_attempts.pop(buffer.index, None)
+        if attempts is None:
+            return set()
+        good = await self._digests(buffer)
+        culprits = set()
+        for attempt in await asyncio.gather(*attempts, return_exceptions=True):
+            if isinstance(attempt, BaseException):
+                continue
+            for good_digest, (digest, contributor) in zip(good, attempt):
+                if digest != good_digest and contributor is not None:
+                    culprits.add(contributor)
+        return culprits
+
+    def piece_failed(self, buffer):
+        """
+        Throw a piece away after a bad hash so it is downloaded again.
+
+        Returns:
+            set: The address of the peer that sent the whole piece, if a
+            single peer did; otherwise empty until piece_verified() can
+            tell which blocks were bad.
+        """
+        self.hashing.discard(buffer.index)
+        self.picker.release(buffer.index)
+        contributors = set(buffer.contributors)
+        contributors.discard(None)
+        if len(contributors) == 1:
+            return contributors
+        # Registered now, so the retry is exclusive even before the digests are in
+        attempt = asyncio.ensure_future(self._attempt(buffer))
+        self.failed_attempts.setdefault(buffer.index, []).append(attempt)
+        return set()
+
+    async def _attempt(self, buffer):
+        return list(zip(await self._digests(buffer), buffer.contributors))
+
+    async def _digests(self, buffer):
+        """The SHA-1 of every block of a piece, computed off the event loop."""
+        if self.hash_pool is not None:
+            return await self.hash_pool.run(self._block_digests, buffer)
+        return await asyncio.get_running_loop().run_in_executor(None, self._block_digests, buffer)
+
+    @staticmethod
+    def _block_digests(buffer):
+        view = memoryview(buffer.data)
+        return [hashlib.sha1(view[i * buffer.block_size:(i + 1) * buffer.block_size]).digest()
+                for i in range(buffer.num_blocks)]
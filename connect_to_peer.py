@@ -5,7 +5,8 @@ import socket
 import struct
 import hashlib
 import time
-from parser import bdecode, bencode
+from metainfo import Metainfo, as_metainfo
+from storage import PieceStorage
 
 class BitTorrentPeer:
     """Handles communication with a single BitTorrent peer."""
@@ -284,100 +285,83 @@ def download_piece(peer, piece_index, piece_length, piece_hash, block_size=16384
     return complete_piece
 
 
-def download_from_peers(torrent_file_path, peers, output_file):
+def download_from_peers(torrent, peers, output_file):
     """
     Download a torrent file from peers.
     
     Args:
-        torrent_file_path: Path to .torrent file
+        torrent: A Metainfo, or the path to a .torrent file
         peers: List of (ip, port) tuples
-        output_file: Path to save downloaded file
+        output_file: Path to save the downloaded file (a directory for multi-file torrents)
     """
-    # Read torrent metadata
-    with open(torrent_file_path, 'rb') as f:
-        torrent_data = bdecode(f.read())
-    
-    info = torrent_data[b'info']
-    info_hash = hashlib.sha1(bencode(info)).digest()
-    piece_length = info[b'piece length']
-    pieces_hash = info[b'pieces']
-    
-    # Calculate number of pieces
-    num_pieces = len(pieces_hash) // 20
-    
-    # Get total length
-    if b'length' in info:
-        total_length = info[b'length']
-    else:
-        total_length = sum(f[b'length'] for f in info[b'files'])
+    metainfo = as_metainfo(torrent)
+    info = metainfo.info
+    info_hash = metainfo.info_hash
+    num_pieces = metainfo.num_pieces
+    total_length = metainfo.total_length
     
     print(f"Torrent info: {num_pieces} pieces, {total_length} bytes total")
     
     # Generate peer_id
     peer_id = b'-PY0001-' + b'0' * 12
     
-    # Storage for downloaded pieces
-    downloaded_pieces = [None] * num_pieces
+    # Verified pieces go straight to disk; we only remember which ones we have
+    downloaded_pieces = [False] * num_pieces
+    storage = PieceStorage.from_info(info, output_file)
+    storage.open()
     
-    # Try to download from each peer
-    for ip, port in peers:
-        print(f"\nTrying peer {ip}:{port}")
-        
-        peer = BitTorrentPeer(ip, port, info_hash, peer_id)
-        
-        if not peer.connect():
-            continue
-        
-        if not peer.handshake():
-            peer.close()
-            continue
-        
-        # Try to download missing pieces
-        for piece_idx in range(num_pieces):
-            if downloaded_pieces[piece_idx] is not None:
+    try:
+        # Try to download from each peer
+        for ip, port in peers:
+            print(f"\nTrying peer {ip}:{port}")
+            
+            peer = BitTorrentPeer(ip, port, info_hash, peer_id)
+            
+            if not peer.connect():
                 continue
             
-            # Calculate piece length (last piece may be smaller)
-            if piece_idx == num_pieces - 1:
-                current_piece_length = total_length - (piece_idx * piece_length)
-            else:
-                current_piece_length = piece_length
+            if not peer.handshake():
+                peer.close()
+                continue
             
-            # Get piece hash
-            piece_hash = pieces_hash[piece_idx * 20:(piece_idx + 1) * 20]
+            # Try to download missing pieces
+            for piece_idx in range(num_pieces):
+                if downloaded_pieces[piece_idx]:
+                    continue
+                
+                # Download piece (the last piece may be smaller)
+                piece_data = download_piece(peer, piece_idx, metainfo.piece_size(piece_idx),
+                                            metainfo.piece_hash(piece_idx))
+                
+                if piece_data:
+                    storage.write_piece(piece_idx, piece_data)
+                    downloaded_pieces[piece_idx] = True
+                    print(f"Progress: {sum(downloaded_pieces)}/{num_pieces} pieces")
             
-            # Download piece
-            piece_data = download_piece(peer, piece_idx, current_piece_length, piece_hash)
+            peer.close()
             
-            if piece_data:
-                downloaded_pieces[piece_idx] = piece_data
-                print(f"Progress: {sum(1 for p in downloaded_pieces if p is not None)}/{num_pieces} pieces")
-        
-        peer.close()
-        
-        # Check if complete
-        if all(p is not None for p in downloaded_pieces):
-            print("\nDownload complete!")
-            break
-    
-    # Write to file
-    if all(p is not None for p in downloaded_pieces):
-        with open(output_file, 'wb') as f:
-            for piece in downloaded_pieces:
-                f.write(piece)
+            # Check if complete
+            if all(downloaded_pieces):
+                print("\nDownload complete!")
+                break
+    finally:
+        storage.close()
+    
+    if all(downloaded_pieces):
         print(f"File saved to {output_file}")
     else:
-        print(f"Download incomplete: {sum(1 for p in downloaded_pieces if p is not None)}/{num_pieces} pieces")
+        print(f"Download incomplete: {sum(downloaded_pieces)}/{num_pieces} pieces")
 
 from get_peers import get_peers_from_tracker
 
 # Example usage
 if __name__ == "__main__":
-    peers = get_peers_from_tracker('test.torrent')
+    metainfo = Metainfo.load('test.torrent')
+    peers = get_peers_from_tracker(metainfo)
     print(peers[:10])
     
     try:
-        download_from_peers('test.torrent', peers, 'downloaded_file.bin')
+        download_from_peers(metainfo, peers, 'downloaded_file.bin')
     except Exception as e:
         print(f"Error: {e}")
         import traceback
@@ -1,22 +1,62 @@
 import asyncio
-import socket
+import logging
+import random
 import struct
-import hashlib
 import time
-from parser import bdecode, bencode
-from collections import defaultdict
+from metainfo import Metainfo, as_metainfo
+from collections import defaultdict, deque
+from storage import PieceStorage
+from piece_picker import PiecePicker, RAREST_FIRST
+from hash_pool import HashPool
+from resume import resume_path_for, load_resume_data, save_resume_data, recheck_pieces
+from peer_protocol import PeerWireProtocol
+from connection_manager import ConnectionManager
+from block_scheduler import BlockScheduler, BLOCK_SIZE
+from seeding import PeerServer, Uploader, UPLOAD_SLOTS
+from read_cache import ReadCache, DEFAULT_CACHE_SIZE
+from disk_io import DiskQueue
+from rate_limit import RateLimits
+from metrics import REGISTRY, Counter, Gauge
+
+log = logging.getLogger(__name__)
+
+# Hot-path metrics, recorded as things happen; the rest are read from the
+# downloaders when metrics are scraped (TorrentDownloader.collect_metrics)
+REQUEST_RTT = REGISTRY.histogram('bt_request_rtt_seconds',
+                                 "Time from requesting a block to receiving it")
+CHOKE_DURATION = REGISTRY.histogram('bt_choke_seconds', "How long peers kept us choked")
+PIECE_LATENCY = REGISTRY.histogram('bt_piece_latency_seconds',
+                                   "Time from starting a piece to having it verified on disk")
+PIECES_FAILED = REGISTRY.counter('bt_pieces_failed_total', "Pieces that failed their hash check",
+                                 ('torrent',))
+
+# Corrupt pieces a peer may send before it is banned
+MAX_HASH_FAILURES = 3
+# Seconds of silence after which we send a keep-alive while seeding
+KEEP_ALIVE_INTERVAL = 120
+# Seconds between progress lines in the log
+PROGRESS_LOG_INTERVAL = 10
+# Seconds we wait for a peer to unchoke us (a few of its choke rounds)
+UNCHOKE_TIMEOUT = 30
+# Piece latencies kept for percentiles (a uniform sample of all of them)
+LATENCY_SAMPLES = 4096
 
 class AsyncBitTorrentPeer:
     """Handles asynchronous communication with a single BitTorrent peer."""
     
-    def __init__(self, ip, port, info_hash, peer_id, timeout=10):
+    # How often (seconds) the download rate estimate is refreshed
+    RATE_WINDOW = 1.0
+    
+    def __init__(self, ip, port, info_hash, peer_id, timeout=10,
+                 request_depth=4, max_request_depth=250, limits=None):
         self.ip = ip
         self.port = port
         self.info_hash = info_hash
         self.peer_id = peer_id
         self.timeout = timeout
-        self.reader = None
-        self.writer = None
+        self.transport = None
+        self.protocol = None
+        # Whether we are choking the peer / interested in it, and the reverse
         self.choked = True
         self.interested = False
         self.peer_choking = True
@@ -24,34 +64,90 @@ class AsyncBitTorrentPeer:
         self.bitfield = None
         self.connected = False
         
+        # Messages are parsed by PeerWireProtocol as they arrive; the ones the
+        # download logic cares about are queued here as events
+        self._events = deque()
+        self._event_waiter = None
+        self._handshake = None
+        # Optional callback run as soon as an event arrives, before it is queued
+        self.on_event = None
+        # State changes worth waiting for: the peer unchoked us (cleared when
+        # it chokes us again), and we know which pieces it has (its bitfield
+        # arrived, or its first message wasn't one, so it isn't sending any)
+        self.unchoked = asyncio.Event()
+        self.bitfield_known = asyncio.Event()
+        
+        # Request pipeline: blocks we asked for and have not received yet,
+        # keyed by (piece_index, begin) -> (length, time sent, destination)
+        self.outstanding = {}
+        self.min_request_depth = request_depth
+        self.max_request_depth = max_request_depth
+        self.request_depth = request_depth
+        
+        # Measurements used to size the pipeline
+        self.download_rate = 0.0
+        self.min_rtt = None
+        self.bytes_received = 0
+        # Block bytes that arrived after we cancelled (or never asked for) them
+        self.discarded_bytes = 0
+        self._rate_bytes = 0
+        self._rate_started = time.monotonic()
+        
+        # Upload side: the Uploader serving this connection, the blocks the
+        # peer asked us for, and the task sending them
+        self.uploader = None
+        self.upload_queue = deque()
+        self.upload_task = None
+        self.bytes_sent = 0
+        # Since when the peer has been choking us (None while it isn't)
+        self.choked_since = None
+        
+        # Bandwidth limits of this connection (nested in its torrent's)
+        self.limits = limits or RateLimits()
+        
     async def connect(self):
         """Establish TCP connection to peer."""
+        loop = asyncio.get_running_loop()
+        self._handshake = loop.create_future()
         try:
-            self.reader, self.writer = await asyncio.wait_for(
-                asyncio.open_connection(self.ip, self.port),
+            self.transport, self.protocol = await asyncio.wait_for(
+                loop.create_connection(lambda: PeerWireProtocol(self), self.ip, self.port),
                 timeout=self.timeout
             )
+            self.protocol.read_limit = self.limits.download
             self.connected = True
+            self.choked_since = time.monotonic()
             return True
         except Exception as e:
-            print(f"Failed to connect to {self.ip}:{self.port} - {e}")
+            log.debug("Failed to connect to %s:%d - %s", self.ip, self.port, e)
             return False
     
+    def accept(self, protocol):
+        """Take over an inbound connection whose handshake we already checked, and answer it."""
+        self.protocol = protocol
+        self.transport = protocol.transport
+        protocol.handler = self
+        protocol.read_limit = self.limits.download
+        self.connected = True
+        self.choked_since = time.monotonic()
+        self.protocol.write(self._handshake_message())
+    
+    def _handshake_message(self):
+        pstr = b"BitTorrent protocol"
+        reserved = b'\x00' * 8
+        return struct.pack("B", len(pstr)) + pstr + reserved + self.info_hash + self.peer_id
+    
     async def handshake(self):
         """Perform BitTorrent handshake."""
         pstr = b"BitTorrent protocol"
-        pstrlen = len(pstr)
-        reserved = b'\x00' * 8
-        
-        handshake_msg = struct.pack("B", pstrlen) + pstr + reserved + self.info_hash + self.peer_id
         
         try:
-            self.writer.write(handshake_msg)
-            await self.writer.drain()
+            self.protocol.write(self._handshake_message())
+            await self.protocol.drain()
             
             # Receive handshake response (68 bytes total)
             response = await asyncio.wait_for(
-                self.reader.readexactly(68),
+                asyncio.shield(self._handshake),
                 timeout=self.timeout
             )
             
@@ -62,60 +158,202 @@ class AsyncBitTorrentPeer:
             
             # Verify the response
             if resp_pstrlen != 19 or resp_pstr != pstr:
-                print(f"Invalid handshake from {self.ip}:{self.port}")
+                log.debug("Invalid handshake from %s:%d", self.ip, self.port)
                 return False
             
             if resp_info_hash != self.info_hash:
-                print(f"Info hash mismatch from {self.ip}:{self.port}")
+                log.debug("Info hash mismatch from %s:%d", self.ip, self.port)
                 return False
             
-            print(f"✓ Handshake successful with {self.ip}:{self.port}")
+            log.debug("Handshake successful with %s:%d", self.ip, self.port)
             return True
             
         except Exception as e:
-            print(f"Handshake failed with {self.ip}:{self.port} - {e}")
+            log.debug("Handshake failed with %s:%d - %s", self.ip, self.port, e)
             return False
     
     async def send_interested(self):
         """Send 'interested' message to peer."""
         msg = struct.pack(">IB", 1, 2)
-        self.writer.write(msg)
-        await self.writer.drain()
+        self.protocol.write(msg)
+        await self.protocol.drain()
         self.interested = True
     
-    async def send_request(self, piece_index, begin, length):
-        """Request a block from peer."""
+    async def send_not_interested(self):
+        """Send 'not interested' message to peer."""
+        self.protocol.write(struct.pack(">IB", 1, 3))
+        await self.protocol.drain()
+        self.interested = False
+    
+    def send_choke(self):
+        self.choked = True
+        # A choke discards every request the peer has queued with us
+        self.upload_queue.clear()
+        self.protocol.write(struct.pack(">IB", 1, 0))
+    
+    def send_unchoke(self):
+        self.choked = False
+        self.protocol.write(struct.pack(">IB", 1, 1))
+    
+    def send_have(self, piece_index):
+        self.protocol.write(struct.pack(">IBI", 5, 4, piece_index))
+    
+    def send_bitfield(self, bitfield):
+        self.protocol.write(struct.pack(">IB", 1 + len(bitfield), 5) + bitfield)
+    
+    def send_block(self, piece_index, begin, block):
+        """Send a block the peer requested (a 'piece' message)."""
+        self.protocol.write(struct.pack(">IBII", 9 + len(block), 7, piece_index, begin))
+        self.protocol.write(block)
+        self.bytes_sent += len(block)
+    
+    async def send_request(self, piece_index, begin, length, dest=None):
+        """
+        Request a block from peer.
+        
+        If `dest` (a writable memoryview of `length` bytes) is given, the
+        block is received straight into it.
+        """
         msg = struct.pack(">IBIII", 13, 6, piece_index, begin, length)
-        self.writer.write(msg)
-        await self.writer.drain()
+        self.outstanding[(piece_index, begin)] = (length, time.monotonic(), dest)
+        self.protocol.write(msg)
+        await self.protocol.drain()
     
-    async def receive_message(self):
-        """Receive and parse a message from peer."""
-        try:
-            # Read message length (4 bytes)
-            length_data = await asyncio.wait_for(
-                self.reader.readexactly(4),
-                timeout=self.timeout
-            )
-            length = struct.unpack(">I", length_data)[0]
-            
-            if length == 0:
-                return None, None
-            
-            # Read message ID and payload
-            msg_data = await asyncio.wait_for(
-                self.reader.readexactly(length),
-                timeout=self.timeout
-            )
-            msg_id = msg_data[0]
-            payload = msg_data[1:] if length > 1 else b''
-            
-            return msg_id, payload
-            
-        except asyncio.TimeoutError:
-            return None, None
-        except Exception as e:
-            return None, None
+    def cancel_request(self, piece_index, begin):
+        """
+        Send 'cancel' for an outstanding request.
+        
+        Returns:
+            bool: False if the block was not outstanding.
+        """
+        request = self.outstanding.pop((piece_index, begin), None)
+        if request is None:
+            return False
+        if self.connected:
+            self.protocol.write(struct.pack(">IBIII", 13, 8, piece_index, begin, request[0]))
+            # The block may be landing in its destination right now
+            self.protocol.divert_block(piece_index, begin)
+        return True
+    
+    def can_request(self):
+        """Whether another block request fits in the pipeline right now."""
+        return not self.peer_choking and len(self.outstanding) < self.request_depth
+    
+    def _record_block(self, length, sent_at):
+        """Update RTT and rate estimates for an arrived block and resize the pipeline."""
+        now = time.monotonic()
+        rtt = now - sent_at
+        REQUEST_RTT.observe(rtt)
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        
+        self.bytes_received += length
+        self._rate_bytes += length
+        elapsed = now - self._rate_started
+        if elapsed < self.RATE_WINDOW:
+            return
+        sample = self._rate_bytes / elapsed
+        if self.download_rate:
+            self.download_rate = 0.7 * self.download_rate + 0.3 * sample
+        else:
+            self.download_rate = sample
+        self._rate_bytes = 0
+        self._rate_started = now
+        
+        # Keep twice the bandwidth-delay product in flight. While the pipe is
+        # the bottleneck this doubles the depth every window (like TCP slow
+        # start); once the link is saturated it settles at 2 x BDP.
+        bdp = self.download_rate * self.min_rtt
+        depth = int(2 * bdp / BLOCK_SIZE) + 1
+        self.request_depth = max(self.min_request_depth, min(self.max_request_depth, depth))
+    
+    # Callbacks from PeerWireProtocol
+    
+    def handshake_received(self, data):
+        if not self._handshake.done():
+            self._handshake.set_result(data)
+    
+    def message_received(self, msg_id, payload):
+        # A bitfield can only be the first message
+        self.bitfield_known.set()
+        event = self.handle_message(msg_id, payload)
+        if event is not None:
+            if self.on_event is not None:
+                self.on_event(self, event)
+            self._push_event(event)
+    
+    def block_destination(self, index, begin, length):
+        """Where an incoming block should be written, if we asked for it."""
+        request = self.outstanding.get((index, begin))
+        if request is None or request[0] != length:
+            return None
+        return request[2]
+    
+    def block_received(self, index, begin, length):
+        """A requested block has been received straight into its destination."""
+        request = self.outstanding.pop((index, begin), None)
+        if request is not None:
+            self._record_block(length, request[1])
+            self._push_event(('block', index, begin, length))
+        else:
+            self.discarded_bytes += length
+    
+    def connection_lost(self, exc):
+        self.connected = False
+        if self._handshake is not None and not self._handshake.done():
+            self._handshake.set_exception(ConnectionResetError("Connection lost"))
+        self._wake_event_waiter()
+    
+    def _push_event(self, event):
+        self._events.append(event)
+        self._wake_event_waiter()
+    
+    def _wake_event_waiter(self):
+        waiter = self._event_waiter
+        self._event_waiter = None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+    
+    def wake(self):
+        """Make a pending next_event() return None now, so its caller looks again."""
+        self._wake_event_waiter()
+    
+    async def wait_until(self, state, timeout=None):
+        """
+        Wait until `state` (one of the peer's asyncio.Events) is set, the
+        connection drops, or `timeout` seconds pass (the peer's timeout by
+        default).
+        
+        Returns:
+            bool: Whether `state` is set.
+        """
+        if not state.is_set() and self.connected:
+            waiter = asyncio.ensure_future(state.wait())
+            try:
+                await asyncio.wait((waiter, self.protocol.closed), timeout=timeout or self.timeout,
+                                   return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiter.cancel()
+        return state.is_set()
+    
+    async def next_event(self, timeout=None):
+        """
+        Wait for the next event worth acting on (up to `timeout` seconds,
+        the peer's timeout by default).
+        
+        Returns:
+            A tuple such as ('block', index, begin, length), ('piece', index,
+            begin, data), ('have', index), ('bitfield', previous), ('choke',
+            dropped_requests) or ('unchoke',); None on timeout or disconnect.
+        """
+        if not self._events and self.connected:
+            self._event_waiter = asyncio.get_running_loop().create_future()
+            # Not wait_for(): it can swallow a cancel that races with an
+            # event arriving, leaving a worker we meant to stop running
+            await asyncio.wait((self._event_waiter,), timeout=timeout or self.timeout)
+        if self._events:
+            return self._events.popleft()
+        return None
     
     def handle_message(self, msg_id, payload):
         """Process received messages."""
@@ -123,24 +361,57 @@ class AsyncBitTorrentPeer:
             return None
         
         if msg_id == 0:
+            if not self.peer_choking:
+                self.choked_since = time.monotonic()
             self.peer_choking = True
+            self.unchoked.clear()
+            # A choke discards every request the peer has not served yet
+            dropped = [(index, begin, request[0])
+                       for (index, begin), request in self.outstanding.items()]
+            self.outstanding.clear()
+            return ('choke', dropped)
         elif msg_id == 1:
+            if self.peer_choking and self.choked_since is not None:
+                CHOKE_DURATION.observe(time.monotonic() - self.choked_since)
+                self.choked_since = None
             self.peer_choking = False
-            print(f"✓ {self.ip}:{self.port} unchoked us")
+            self.unchoked.set()
+            log.debug("%s:%d unchoked us", self.ip, self.port)
+            return ('unchoke',)
         elif msg_id == 2:
             self.peer_interested = True
+            if self.uploader is not None:
+                self.uploader.interest_changed(self)
         elif msg_id == 3:
             self.peer_interested = False
         elif msg_id == 4:
-            piece_index = struct.unpack(">I", payload)[0]
+            piece_index = struct.unpack_from(">I", payload)[0]
+            if not self.has_piece(piece_index):
+                self._set_piece(piece_index)
+                return ('have', piece_index)
         elif msg_id == 5:
-            self.bitfield = payload
-            print(f"✓ Received bitfield from {self.ip}:{self.port}")
+            previous = self.bitfield
+            self.bitfield = bytearray(payload)
+            log.debug("Received bitfield from %s:%d", self.ip, self.port)
+            return ('bitfield', previous)
         elif msg_id == 7:
-            index = struct.unpack(">I", payload[0:4])[0]
-            begin = struct.unpack(">I", payload[4:8])[0]
-            block = payload[8:]
-            return ('piece', index, begin, block)
+            # Only blocks without a destination end up here; payload is a view
+            # of the receive buffer, so keep a copy of anything we requested
+            index, begin = struct.unpack_from(">II", payload)
+            request = self.outstanding.pop((index, begin), None)
+            if request is not None:
+                block = bytes(payload[8:])
+                self._record_block(len(block), request[1])
+                return ('piece', index, begin, block)
+            self.discarded_bytes += len(payload) - 8
+        elif msg_id in (6, 8) and len(payload) == 12:
+            # Requests and cancels for blocks we upload
+            if self.uploader is not None:
+                index, begin, length = struct.unpack_from(">III", payload)
+                if msg_id == 6:
+                    self.uploader.request_received(self, index, begin, length)
+                else:
+                    self.uploader.cancel_received(self, index, begin, length)
         
         return None
     
@@ -154,245 +425,652 @@ class AsyncBitTorrentPeer:
             return False
         return bool((self.bitfield[byte_index] >> bit_index) & 1)
     
+    def _set_piece(self, piece_index):
+        """Mark a piece as available on the peer, growing the bitfield if needed."""
+        byte_index = piece_index // 8
+        if self.bitfield is None:
+            self.bitfield = bytearray()
+        if byte_index >= len(self.bitfield):
+            self.bitfield.extend(bytes(byte_index + 1 - len(self.bitfield)))
+        self.bitfield[byte_index] |= 0x80 >> (piece_index % 8)
+    
     async def close(self):
         """Close connection to peer."""
-        if self.writer:
-            self.writer.close()
-            await self.writer.wait_closed()
+        if self.transport:
+            # Messages still queued for this loop iteration go out first
+            self.protocol.flush()
+            self.transport.close()
+            await self.protocol.closed
         self.connected = False
 
 
-async def download_piece_from_peer(peer, piece_index, piece_length, block_size=16384):
-    """
-    Download a single piece from a peer.
-    Returns dict of {offset: block_data} or None if failed.
-    """
-    if not peer.has_piece(piece_index):
-        return None
-    
-    # Send interested
-    if not peer.interested:
-        await peer.send_interested()
-    
-    # Wait for unchoke with timeout
-    wait_time = 0
-    while peer.peer_choking and wait_time < 5:
-        msg_id, payload = await peer.receive_message()
-        if msg_id is not None:
-            peer.handle_message(msg_id, payload)
-        await asyncio.sleep(0.1)
-        wait_time += 0.1
-    
-    if peer.peer_choking:
-        return None
-    
-    # Request all blocks
-    blocks_needed = []
-    for begin in range(0, piece_length, block_size):
-        length = min(block_size, piece_length - begin)
-        blocks_needed.append((begin, length))
-        await peer.send_request(piece_index, begin, length)
-    
-    # Collect blocks
-    piece_data = {}
-    timeout_counter = 0
-    max_timeout = 100
-    
-    while len(piece_data) < len(blocks_needed) and timeout_counter < max_timeout:
-        msg_id, payload = await peer.receive_message()
-        
-        if msg_id is None:
-            timeout_counter += 1
-            await asyncio.sleep(0.1)
-            continue
-        
-        result = peer.handle_message(msg_id, payload)
-        if result and result[0] == 'piece':
-            _, idx, begin, block = result
-            if idx == piece_index:
-                piece_data[begin] = block
-                timeout_counter = 0
-    
-    if len(piece_data) < len(blocks_needed):
-        return None
-    
-    return piece_data
-
-
 class TorrentDownloader:
     """Manages concurrent downloading from multiple peers."""
     
-    def __init__(self, torrent_file_path, peers, max_peers=5):
-        self.torrent_file_path = torrent_file_path
+    def __init__(self, torrent, peers, max_peers=5, piece_policy=RAREST_FIRST,
+                 hash_pool=None, disk_queue=None, resume=True, resume_interval=30, announcer=None,
+                 seed=False, port=None, upload_slots=UPLOAD_SLOTS, cache_size=DEFAULT_CACHE_SIZE,
+                 server=None, connection_slots=None, peer_id=None, rate_limits=None,
+                 peer_download_rate=0, peer_upload_rate=0):
         self.peers = peers
         self.max_peers = max_peers
         
-        # Load torrent metadata
-        with open(torrent_file_path, 'rb') as f:
-            torrent_data = bdecode(f.read())
+        # New peers arrive on peer_queue, from `peers` and from the announcer;
+        # the connection manager decides which of them we are connected to
+        self.announcer = announcer
+        self.peer_queue = asyncio.Queue()
+        self.add_peers(peers)
+        # connection_slots (a Semaphore) is a connection limit shared with
+        # the other torrents of a Session
+        self.connections = ConnectionManager(self.peer_worker, max_connections=max_peers,
+                                             get_progress=self.peer_progress,
+                                             shared_slots=connection_slots,
+                                             on_finished=self._state_changed)
         
-        self.info = torrent_data[b'info']
-        self.info_hash = hashlib.sha1(bencode(self.info)).digest()
-        self.piece_length = self.info[b'piece length']
-        self.pieces_hash = self.info[b'pieces']
-        self.num_pieces = len(self.pieces_hash) // 20
+        # Torrent metadata, parsed once and shared with the tracker client
+        self.metainfo = as_metainfo(torrent)
+        self.info = self.metainfo.info
+        self.info_hash = self.metainfo.info_hash
+        self.piece_length = self.metainfo.piece_length
+        self.num_pieces = self.metainfo.num_pieces
+        self.total_length = self.metainfo.total_length
         
-        # Calculate total length
-        if b'length' in self.info:
-            self.total_length = self.info[b'length']
-        else:
-            self.total_length = sum(f[b'length'] for f in self.info[b'files'])
+        # Generate peer_id (the one the trackers know us by, if we announce)
+        if peer_id is None:
+            peer_id = announcer.peer_id if announcer else b'-PY0001-' + b'0' * 12
+        self.peer_id = peer_id
         
-        # Generate peer_id
-        self.peer_id = b'-PY0001-' + b'0' * 12
+        # Piece management (verified pieces live on disk, we only track indices)
+        self.downloaded_pieces = set()
+        self.storage = None
         
-        # Piece management
-        self.downloaded_pieces = {}
-        self.piece_locks = {i: asyncio.Lock() for i in range(self.num_pieces)}
-        self.pieces_in_progress = set()
+        # Fast resume: trust a matching resume file, otherwise recheck the disk
+        self.resume = resume
+        self.resume_interval = resume_interval
+        self.resume_file = None
+        self.picker = PiecePicker(self.num_pieces, policy=piece_policy)
+        # Duplicate or cancelled blocks that arrived anyway
+        self.wasted_bytes = 0
+        # Bad pieces each peer address sent corrupt blocks for
+        self.hash_failures = defaultdict(int)
         self.connected_peers = []
+        # Peers waiting for work the scheduler had none of; woken as soon as
+        # blocks are given back (a choke, a departing peer, a bad piece)
+        self.idle_peers = set()
+        # The download loop sleeps on this until a piece lands or a peer leaves
+        self._state_waiter = None
         
-        print(f"Torrent: {self.num_pieces} pieces, {self.total_length} bytes total")
+        # Pieces are hashed off the event loop; verify_tasks holds the ones in flight
+        self.owns_hash_pool = hash_pool is None
+        self.hash_pool = hash_pool or HashPool()
+        self.verify_tasks = set()
+        # Work is handed out per block, so several peers can fill one piece;
+        # in endgame missing blocks are requested from every peer that has
+        # them and wasted_bytes counts the duplicates that arrive anyway
+        self.scheduler = BlockScheduler(self.picker, self.get_piece_length,
+                                        hash_pool=self.hash_pool)
+        # Verified pieces are written by the disk queue's I/O threads, which
+        # merge adjacent pieces into large writes; when it falls behind,
+        # completed pieces wait before hashing and the download slows down
+        self.owns_disk_queue = disk_queue is None
+        self.disk_queue = disk_queue or DiskQueue()
+        
+        # Seconds from claiming each piece to having it verified on disk:
+        # a bounded sample, the longest, and how many there were
+        self.piece_latencies = []
+        self.max_piece_latency = 0.0
+        self.pieces_timed = 0
+        # Payload bytes downloaded and verified in this session (for announces)
+        self.bytes_downloaded = 0
+        
+        # Uploading: verified pieces are served on every connection while we
+        # download, and with seed=True after the download completes as well.
+        # Inbound peers are accepted on `port` (the announced one by default),
+        # or through a PeerServer shared with other torrents.
+        self.seed = seed
+        self.owns_server = server is None
+        self.server = server
+        if server is not None:
+            port = server.port
+        self.port = port if port is not None else (announcer.port if announcer else None)
+        self.uploader = Uploader(self.num_pieces, self.get_piece_length, self.downloaded_pieces,
+                                 self.is_complete, upload_slots=upload_slots)
+        self.cache_size = cache_size
+        self.read_cache = None
+        
+        # Bandwidth limits: the torrent's own (rate_limits, nested in the
+        # session's when there is one) and a default for each connection
+        self.limits = rate_limits or RateLimits()
+        self.peer_download_rate = peer_download_rate
+        self.peer_upload_rate = peer_upload_rate
+        self.inbound_tasks = set()
+        self.feeder = None
+        self._stopping = False
+        self.stopped = asyncio.Event()
+        
+        log.info("Torrent %s: %d pieces, %d bytes total", self.metainfo.name, self.num_pieces,
+                 self.total_length)
+    
+    def add_peers(self, peers):
+        """Queue peer addresses for connecting."""
+        for peer in peers:
+            self.peer_queue.put_nowait(peer)
+    
+    def transfer_stats(self):
+        """(downloaded, uploaded, left) in bytes, as trackers want them."""
+        left = sum(self.get_piece_length(i) for i in range(self.num_pieces)
+                   if i not in self.downloaded_pieces)
+        return self.bytes_downloaded, self.uploader.bytes_uploaded, left
+    
+    def collect_metrics(self):
+        """Metrics about this torrent and its peers, read when metrics are scraped."""
+        torrent = (self.info_hash.hex(),)
+        pieces = Gauge('bt_torrent_pieces_verified', "Pieces verified and on disk", ('torrent',))
+        pieces.set(len(self.downloaded_pieces), torrent)
+        peers = Gauge('bt_torrent_peers', "Connected peers", ('torrent',))
+        peers.set(len(self.uploader.peers), torrent)
+        downloaded = Counter('bt_torrent_downloaded_bytes_total',
+                             "Payload bytes downloaded and verified", ('torrent',))
+        downloaded.inc(self.bytes_downloaded, torrent)
+        uploaded = Counter('bt_torrent_uploaded_bytes_total', "Payload bytes uploaded", ('torrent',))
+        uploaded.inc(self.uploader.bytes_uploaded, torrent)
+        # Blocks still sitting in connected peers' counters are added in
+        wasted = Counter('bt_torrent_wasted_bytes_total',
+                         "Bytes of duplicate, cancelled or unrequested blocks", ('torrent',))
+        wasted.inc(self.wasted_bytes + sum(peer.discarded_bytes for peer in self.uploader.peers), torrent)
+        received = Counter('bt_peer_bytes_received_total',
+                           "Payload bytes received from each connected peer", ('torrent', 'peer'))
+        sent = Counter('bt_peer_bytes_sent_total',
+                       "Payload bytes sent to each connected peer", ('torrent', 'peer'))
+        for peer in self.uploader.peers:
+            labels = torrent + (f"{peer.ip}:{peer.port}",)
+            received.inc(peer.bytes_received, labels)
+            sent.inc(peer.bytes_sent, labels)
+        metrics = [pieces, peers, downloaded, uploaded, wasted, received, sent]
+        if self.read_cache is not None:
+            cache_hits = Counter('bt_read_cache_hits_total', "Blocks served from memory", ('torrent',))
+            cache_hits.inc(self.read_cache.hits, torrent)
+            cache_misses = Counter('bt_read_cache_misses_total', "Blocks read from disk", ('torrent',))
+            cache_misses.inc(self.read_cache.misses, torrent)
+            metrics += [cache_hits, cache_misses]
+        return metrics
+    
+    def is_complete(self):
+        return len(self.downloaded_pieces) == self.num_pieces
     
     def get_piece_length(self, piece_idx):
         """Get the length of a specific piece."""
-        if piece_idx == self.num_pieces - 1:
-            return self.total_length - (piece_idx * self.piece_length)
-        return self.piece_length
+        return self.metainfo.piece_size(piece_idx)
     
     def get_piece_hash(self, piece_idx):
         """Get the hash of a specific piece."""
-        return self.pieces_hash[piece_idx * 20:(piece_idx + 1) * 20]
-    
-    def verify_piece(self, piece_idx, piece_data):
-        """Verify a piece's hash."""
-        calculated_hash = hashlib.sha1(piece_data).digest()
-        expected_hash = self.get_piece_hash(piece_idx)
-        return calculated_hash == expected_hash
+        return self.metainfo.piece_hashes[piece_idx]
     
     async def peer_worker(self, ip, port):
-        """Worker coroutine for a single peer."""
-        peer = AsyncBitTorrentPeer(ip, port, self.info_hash, self.peer_id)
+        """
+        Worker coroutine for a single peer.
+        
+        Returns:
+            int or None: Payload bytes received, or None if we never got
+            past the handshake.
+        """
+        peer = AsyncBitTorrentPeer(ip, port, self.info_hash, self.peer_id, limits=self._peer_limits())
+        # The bitfield often arrives together with the handshake, so hook up
+        # the availability index before anything is read
+        peer.on_event = self.process_event
         
         # Connect and handshake
         if not await peer.connect():
-            return
+            return None
         
         if not await peer.handshake():
+            self.forget_peer(peer)
             await peer.close()
+            return None
+        
+        return await self.run_peer(peer)
+    
+    def accept_peer(self, protocol, handshake):
+        """Adopt an inbound connection whose handshake asked for this torrent."""
+        # Inbound peers count against the same budget as the ones we dial
+        if self._stopping or not self.connections.has_room():
+            protocol.transport.close()
             return
+        ip, port = protocol.transport.get_extra_info('peername')[:2]
+        peer = AsyncBitTorrentPeer(ip, port, self.info_hash, self.peer_id, limits=self._peer_limits())
+        peer.on_event = self.process_event
+        peer.accept(protocol)
+        task = asyncio.create_task(self._run_inbound(peer))
+        self.inbound_tasks.add(task)
+        task.add_done_callback(self.inbound_tasks.discard)
+        task.add_done_callback(lambda _: self._state_changed())
+    
+    def _peer_limits(self):
+        return self.limits.child(self.peer_download_rate, self.peer_upload_rate)
+    
+    async def _run_inbound(self, peer):
+        async with self.connections.slot():
+            return await self.run_peer(peer)
+    
+    async def run_peer(self, peer):
+        """
+        Download from (and upload to) a peer that completed its handshake.
         
-        # Wait for bitfield
-        for _ in range(10):
-            msg_id, payload = await peer.receive_message()
-            if msg_id is not None:
-                peer.handle_message(msg_id, payload)
-            if peer.bitfield is not None:
-                break
-            await asyncio.sleep(0.1)
+        Returns:
+            int: Payload bytes received from the peer.
+        """
+        # Our bitfield has to be the first message after the handshake
+        self.uploader.add_peer(peer)
         
-        self.connected_peers.append(peer)
+        # Wait for bitfield (its events stay queued for the download loop)
+        await peer.wait_until(peer.bitfield_known)
         
+        self.connected_peers.append(peer)
+
         try:
-            # Download pieces
-            while len(self.downloaded_pieces) < self.num_pieces:
-                # Find a piece to download
-                piece_idx = None
-                for i in range(self.num_pieces):
-                    if (i not in self.downloaded_pieces and 
-                        i not in self.pieces_in_progress and 
-                        peer.has_piece(i)):
-                        async with self.piece_locks[i]:
-                            if i not in self.pieces_in_progress:
-                                self.pieces_in_progress.add(i)
-                                piece_idx = i
-                                break
-                
-                if piece_idx is None:
-                    # No pieces available, wait a bit
-                    await asyncio.sleep(1)
-                    continue
-                
-                # Download the piece
-                piece_length = self.get_piece_length(piece_idx)
-                piece_blocks = await download_piece_from_peer(peer, piece_idx, piece_length)
-                
-                if piece_blocks:
-                    # Assemble piece
-                    complete_piece = b''.join(piece_blocks[offset] for offset in sorted(piece_blocks.keys()))
-                    
-                    # Verify
-                    if self.verify_piece(piece_idx, complete_piece):
-                        async with self.piece_locks[piece_idx]:
-                            self.downloaded_pieces[piece_idx] = complete_piece
-                            self.pieces_in_progress.discard(piece_idx)
-                        
-                        progress = len(self.downloaded_pieces)
-                        print(f"✓ Piece {piece_idx} downloaded from {ip}:{port} ({progress}/{self.num_pieces})")
-                    else:
-                        print(f"✗ Piece {piece_idx} failed verification from {ip}:{port}")
-                        async with self.piece_locks[piece_idx]:
-                            self.pieces_in_progress.discard(piece_idx)
-                else:
-                    # Failed to download
-                    async with self.piece_locks[piece_idx]:
-                        self.pieces_in_progress.discard(piece_idx)
-                    await asyncio.sleep(0.5)
-        
+            await self.download_from_peer(peer)
+            if self.seed and self.is_complete():
+                await self.upload_to_peer(peer)
         except Exception as e:
-            print(f"Error in peer worker {ip}:{port}: {e}")
+            log.debug("Error in peer worker %s:%d: %s", peer.ip, peer.port, e)
         finally:
+            # Stop receiving first: its blocks' buffers are about to be handed
+            # to other peers. Blocks we have stay in their piece.
+            if peer.transport:
+                peer.protocol.flush()
+                peer.transport.close()
+            self.uploader.remove_peer(peer)
+            self.scheduler.peer_gone(peer)
+            self._wake_idle_peers()
+            self.wasted_bytes += peer.discarded_bytes
+            self.forget_peer(peer)
             await peer.close()
             if peer in self.connected_peers:
                 self.connected_peers.remove(peer)
+        return peer.bytes_received
+    
+    async def upload_to_peer(self, peer):
+        """Once we have everything, keep the connection for as long as the peer wants our data."""
+        if peer.interested:
+            await peer.send_not_interested()
+        while peer.connected:
+            if peer.bitfield is not None and \
+                    int.from_bytes(peer.bitfield, 'big').bit_count() >= self.num_pieces:
+                # Two seeds have nothing to trade
+                return
+            if await peer.next_event(timeout=KEEP_ALIVE_INTERVAL) is None and peer.connected:
+                peer.protocol.write(b'\x00\x00\x00\x00')
+    
+    def peer_progress(self):
+        """Payload bytes received so far from each connected peer, by address."""
+        return {(peer.ip, peer.port): peer.bytes_received for peer in self.connected_peers}
+    
+    def hash_failed(self, addrs):
+        """Count a bad piece against the peers that corrupted it, banning repeat offenders."""
+        for addr in addrs:
+            self.hash_failures[addr] += 1
+            if self.hash_failures[addr] == MAX_HASH_FAILURES:
+                log.warning("Banning %s:%d after %d bad pieces", addr[0], addr[1], MAX_HASH_FAILURES)
+                self.connections.ban(addr)
+
+    def _record_latency(self, latency):
+        """Keep a reservoir sample of piece latencies, so memory stays bounded."""
+        self.pieces_timed += 1
+        self.max_piece_latency = max(self.max_piece_latency, latency)
+        if len(self.piece_latencies) < LATENCY_SAMPLES:
+            self.piece_latencies.append(latency)
+        else:
+            slot = random.randrange(self.pieces_timed)
+            if slot < LATENCY_SAMPLES:
+                self.piece_latencies[slot] = latency
+
+    def _wake_idle_peers(self):
+        """Blocks went back to the pool (or we are done): idle peers should look again."""
+        for peer in self.idle_peers:
+            peer.wake()
+    
+    def _state_changed(self):
+        """Wake the download loop to check whether it is complete or out of peers."""
+        waiter = self._state_waiter
+        self._state_waiter = None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+    
+    def forget_peer(self, peer):
+        """Drop a departing peer's pieces from the availability index."""
+        if peer.bitfield is not None:
+            self.picker.remove_peer_bitfield(peer, peer.bitfield)
+    
+    def process_event(self, peer, event):
+        """
+        Keep the availability index in sync with a peer's have/bitfield
+        messages, and hand blocks a choke dropped to other peers right away.
+        """
+        if event[0] == 'choke':
+            for index, begin, _ in event[1]:
+                self.scheduler.unassign(peer, index, begin)
+            if event[1]:
+                self._wake_idle_peers()
+        elif event[0] == 'have':
+            self.picker.add_have(peer, event[1])
+        elif event[0] == 'bitfield':
+            if event[1] is not None:
+                self.picker.remove_peer_bitfield(peer, event[1])
+            self.picker.add_peer_bitfield(peer, peer.bitfield)
+    
+    def wants_pieces_from(self, peer):
+        """Whether the peer has a piece we still need, counting ones in progress."""
+        if self.picker.is_interesting(peer):
+            return True
+        return any(peer.has_piece(index) for index in self.scheduler.partial)
+    
+    async def wait_for_unchoke(self, peer):
+        """Declare interest and wait (up to UNCHOKE_TIMEOUT) for the peer to unchoke us."""
+        if not peer.interested:
+            if not self.wants_pieces_from(peer):
+                # Nothing to ask it for; only a have can change that
+                await peer.next_event(timeout=UNCHOKE_TIMEOUT)
+                if not self.wants_pieces_from(peer):
+                    return False
+            await peer.send_interested()
+        return await peer.wait_until(peer.unchoked, UNCHOKE_TIMEOUT)
+    
+    async def fill_pipeline(self, peer):
+        """
+        Top the peer's request queue up to its current depth.
+        
+        Blocks come from the scheduler, which runs across piece boundaries
+        (and shares pieces between peers) so the pipe never drains between
+        pieces.
+        """
+        while peer.can_request():
+            # Hold new requests back while reads are being throttled, so
+            # requests don't pile up faster than the limit lets blocks in
+            delay = peer.limits.download.debt_delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            blocks = self.scheduler.next_blocks(peer, peer.request_depth - len(peer.outstanding))
+            if not blocks:
+                break
+            for buffer, begin, length in blocks:
+                await peer.send_request(buffer.index, begin, length,
+                                        dest=buffer.block_view(begin, length))
+    
+    async def download_from_peer(self, peer, max_timeouts=3):
+        """Keep a pipelined stream of block requests going to one peer."""
+        timeouts = 0
+        while len(self.downloaded_pieces) < self.num_pieces and peer.connected:
+            if peer.peer_choking and not await self.wait_for_unchoke(peer):
+                if not peer.peer_interested:
+                    return
+                # It wants our pieces, so keep the connection while it chokes us
+                continue
+            
+            await self.fill_pipeline(peer)
+            idle = not peer.outstanding
+            
+            # With nothing requested there is nothing to time out on: wait for
+            # the peer to get new pieces (a have), or for the scheduler to get
+            # blocks back, and look again
+            if idle:
+                self.idle_peers.add(peer)
+                try:
+                    event = await peer.next_event()
+                finally:
+                    self.idle_peers.discard(peer)
+            else:
+                event = await peer.next_event()
+            if event is None:
+                # A peer we stopped reading from to stay under a limit isn't stuck
+                if idle or peer.limits.download.throttled_within(peer.timeout):
+                    continue
+                timeouts += 1
+                if timeouts >= max_timeouts:
+                    log.debug("%s:%d stopped sending blocks", peer.ip, peer.port)
+                    return
+                continue
+            timeouts = 0
+            
+            if event[0] in ('block', 'piece'):
+                _, piece_idx, begin, data = event
+                length = data if event[0] == 'block' else len(data)
+                buffer = self.scheduler.partial.get(piece_idx)
+                if buffer is None:
+                    self.wasted_bytes += length
+                    continue
+                addr = (peer.ip, peer.port)
+                if event[0] == 'block':
+                    # Already received in place
+                    requesters = buffer.mark_received(begin, addr)
+                else:
+                    requesters = buffer.add_block(begin, data, addr)
+                if requesters is None:
+                    self.wasted_bytes += length
+                    continue
+                # Endgame duplicates of this block are no longer needed
+                for other in requesters:
+                    if other is not peer:
+                        other.cancel_request(piece_idx, begin)
+                if buffer.complete:
+                    # No one may write into the buffer while it is hashed
+                    self.scheduler.piece_complete(buffer)
+                    await self.submit_piece(peer, buffer)
+    
+    async def submit_piece(self, peer, buffer):
+        """
+        Hand a fully assembled piece to the hashing pool.
+        
+        This only waits when too many pieces are already queued for hashing
+        or writing; the result is handled by finish_piece in its own task so the peer
+        can keep downloading meanwhile.
+        """
+        try:
+            await self.disk_queue.wait_for_room()
+            digest = await self.hash_pool.submit(buffer.data)
+        except asyncio.CancelledError:
+            # The worker is being stopped; the piece is complete, so hash it anyway
+            self._track_verify(self.finish_piece(peer, buffer))
+            raise
+        self._track_verify(self.finish_piece(peer, buffer, digest))
+    
+    def _track_verify(self, coro):
+        task = asyncio.create_task(coro)
+        self.verify_tasks.add(task)
+        task.add_done_callback(self.verify_tasks.discard)
+    
+    async def finish_piece(self, peer, buffer, digest=None):
+        """Check a piece's hash once it is computed and write it to storage."""
+        piece_idx = buffer.index
+        if digest is None:
+            digest = await self.hash_pool.submit(buffer.data)
+        if await digest == self.get_piece_hash(piece_idx):
+            try:
+                await self.disk_queue.write_piece(self.storage, piece_idx, buffer.data)
+            except OSError as e:
+                log.error("Cannot write piece %d: %s", piece_idx, e)
+                self.scheduler.hashing.discard(piece_idx)
+                self.picker.release(piece_idx)
+                self._wake_idle_peers()
+                return
+            # Only pieces that are on disk are served and saved as resume data
+            self.downloaded_pieces.add(piece_idx)
+            self.uploader.piece_verified(piece_idx, buffer.data)
+            # Peers whose blocks differ from the good copy corrupted an earlier attempt
+            self.hash_failed(await self.scheduler.piece_verified(buffer))
+            latency = time.monotonic() - buffer.started
+            self._record_latency(latency)
+            PIECE_LATENCY.observe(latency)
+            self.bytes_downloaded += buffer.length
+            
+            log.debug("Piece %d downloaded from %s:%d (%d/%d)", piece_idx, peer.ip, peer.port,
+                      len(self.downloaded_pieces), self.num_pieces)
+            if self.is_complete():
+                self._wake_idle_peers()
+            self._state_changed()
+        else:
+            log.warning("Piece %d failed verification", piece_idx)
+            PIECES_FAILED.inc(labels=(self.info_hash.hex(),))
+            self.hash_failed(self.scheduler.piece_failed(buffer))
+            self._wake_idle_peers()
     
     async def download(self, output_file):
-        """Start concurrent download from multiple peers."""
-        # Create worker tasks for peers
-        tasks = []
-        for ip, port in self.peers[:self.max_peers * 2]:  # Try more peers than max
-            task = asyncio.create_task(self.peer_worker(ip, port))
-            tasks.append(task)
-            await asyncio.sleep(0.1)  # Stagger connections
-        
-        # Wait for completion or all tasks to finish
-        while len(self.downloaded_pieces) < self.num_pieces and any(not t.done() for t in tasks):
-            await asyncio.sleep(1)
-            print(f"Progress: {len(self.downloaded_pieces)}/{self.num_pieces} pieces, "
-                  f"{len(self.connected_peers)} peers connected")
-        
-        # Cancel remaining tasks
-        for task in tasks:
-            if not task.done():
-                task.cancel()
+        """
+        Start concurrent download from multiple peers.
         
-        await asyncio.gather(*tasks, return_exceptions=True)
+        Returns:
+            bool: Whether the torrent is complete. With seed=True a complete
+            torrent keeps uploading after this returns, until stop().
+        """
+        # Preallocate the output file(s); pieces are written as soon as they verify
+        self.storage = PieceStorage.from_info(self.info, output_file)
+        self.storage.open()
+        try:
+            if self.resume:
+                await self.restore_state()
+            complete = await self._download()
+        except BaseException:
+            await self.stop()
+            raise
+        if not (complete and self.seed):
+            await self.stop()
+        return complete
+
+    async def restore_state(self):
+        """Mark the pieces we already have, from the resume file or a recheck."""
+        self.resume_file = resume_path_for(self.storage)
+        pieces = load_resume_data(self.resume_file, self.info_hash, self.storage)
+        if pieces is not None:
+            log.info("Resume data: %d/%d pieces already verified", len(pieces), self.num_pieces)
+        else:
+            started = time.monotonic()
+            pieces = await recheck_pieces(self.storage, self.get_piece_hash, self.hash_pool)
+            log.info("Rechecked existing data in %.1fs: %d/%d pieces valid",
+                     time.monotonic() - started, len(pieces), self.num_pieces)
+        
+        for piece_idx in pieces:
+            self.downloaded_pieces.add(piece_idx)
+            self.picker.mark_have(piece_idx)
+    
+    def out_of_peers(self):
+        """Whether every worker has stopped and no new peers can show up."""
+        if self.connections.active or self.connections.has_candidates() or not self.peer_queue.empty():
+            return False
+        if self.inbound_tasks:
+            return False
+        return self.announcer is None
+    
+    def save_state(self):
+        """Write the resume file for the pieces verified so far."""
+        if self.resume_file is not None:
+            save_resume_data(self.resume_file, self.info_hash, self.downloaded_pieces, self.storage)
+    
+    async def _download(self):
+        """Run the peer workers until the torrent is complete or they all stop."""
+        # Workers are started from the peer queue, so peers found by later
+        # announces join the download too
+        self.feeder = asyncio.create_task(self.connections.run(self.peer_queue))
+        self.read_cache = ReadCache(self.storage, max_bytes=self.cache_size,
+                                    executor=self.disk_queue.executor)
+        self.uploader.start(self.read_cache)
+        REGISTRY.add_collector(self.collect_metrics)
+        if self.owns_server and self.port is not None:
+            self.server = PeerServer(self.port)
+            await self.server.start()
+        if self.server is not None:
+            self.server.add_torrent(self.info_hash, self)
+        if self.announcer is not None:
+            self.announcer.start(self.peer_queue, self.transfer_stats)
+        
+        # Wait for completion, or until no worker is left and no more peers
+        # can arrive; verified pieces and finished workers wake us up
+        last_save = last_progress = time.monotonic()
+        while len(self.downloaded_pieces) < self.num_pieces and not self.out_of_peers():
+            deadline = last_progress + PROGRESS_LOG_INTERVAL
+            if self.resume:
+                deadline = min(deadline, last_save + self.resume_interval)
+            self._state_waiter = asyncio.get_running_loop().create_future()
+            await asyncio.wait((self._state_waiter,), timeout=max(0, deadline - time.monotonic()))
+            if time.monotonic() - last_progress >= PROGRESS_LOG_INTERVAL:
+                log.info("Progress: %d/%d pieces, %d peers connected", len(self.downloaded_pieces),
+                         self.num_pieces, len(self.connected_peers))
+                last_progress = time.monotonic()
+            if self.resume and time.monotonic() - last_save >= self.resume_interval:
+                self.save_state()
+                last_save = time.monotonic()
+        # Pieces still being hashed count towards completion
+        await asyncio.gather(*self.verify_tasks, return_exceptions=True)
         
-        # Write to file if complete
         if len(self.downloaded_pieces) == self.num_pieces:
-            print("\n✓ Download complete! Writing to file...")
-            with open(output_file, 'wb') as f:
-                for i in range(self.num_pieces):
-                    f.write(self.downloaded_pieces[i])
-            print(f"✓ File saved to {output_file}")
+            if self.announcer is not None:
+                self.announcer.completed()
+            log.info("Download complete! File saved to %s", self.storage.output_path)
+            if self.wasted_bytes:
+                log.info("%d bytes of duplicate or cancelled blocks discarded", self.wasted_bytes)
             return True
         else:
-            print(f"\n✗ Download incomplete: {len(self.downloaded_pieces)}/{self.num_pieces} pieces")
+            log.warning("Download incomplete: %d/%d pieces", len(self.downloaded_pieces), self.num_pieces)
             return False
+    
+    async def stop(self):
+        """Disconnect every peer, send the `stopped` announce and close the files."""
+        if self._stopping:
+            await self.stopped.wait()
+            return
+        self._stopping = True
+        REGISTRY.remove_collector(self.collect_metrics)
+        try:
+            if self.server is not None:
+                self.server.remove_torrent(self.info_hash)
+                if self.owns_server:
+                    self.server.close()
+            tasks = list(self.inbound_tasks)
+            if self.feeder is not None:
+                tasks.append(self.feeder)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.uploader.stop()
+            # Let pieces that are still being hashed land on disk
+            await asyncio.gather(*self.verify_tasks, return_exceptions=True)
+            if self.announcer is not None:
+                await self.announcer.stop(self.transfer_stats)
+        finally:
+            if self.owns_disk_queue:
+                await self.disk_queue.close()
+            else:
+                await self.disk_queue.flush()
+            if self.storage is not None:
+                if self.resume:
+                    self.save_state()
+                self.storage.close()
+            if self.owns_hash_pool:
+                self.hash_pool.close()
+            self.stopped.set()
 
 
-async def download_from_peers_async(torrent_file, peers, output_file, max_peers=5):
+async def download_from_peers_async(torrent, peers, output_file, max_peers=5, announcer=None,
+                                    seed=False):
     """
     Download a torrent using multiple peers concurrently.
     
     Args:
-        torrent_file: Path to .torrent file
+        torrent: A Metainfo, or the path to a .torrent file
         peers: List of (ip, port) tuples
-        output_file: Path to save downloaded file
+        output_file: Path to save the downloaded file (a directory for multi-file torrents)
         max_peers: Maximum number of concurrent peer connections
+        announcer: Optional AnnounceManager that keeps re-announcing and
+            feeds new peers into the download
+        seed: Keep uploading after the download completes, until cancelled
     """
-    downloader = TorrentDownloader(torrent_file, peers, max_peers)
-    success = await downloader.download(output_file)
+    downloader = TorrentDownloader(torrent, peers, max_peers, announcer=announcer, seed=seed)
+    try:
+        success = await downloader.download(output_file)
+        if success and seed:
+            log.info("Seeding; press Ctrl+C to stop")
+            await downloader.stopped.wait()
+    finally:
+        await downloader.stop()
     return success
 
 from get_peers import get_peers_from_tracker
@@ -400,11 +1078,12 @@ from get_peers import get_peers_from_tracker
 # Example usage
 if __name__ == "__main__":
     async def main():
-        peers = get_peers_from_tracker('test.torrent')
+        metainfo = Metainfo.load('test.torrent')
+        peers = get_peers_from_tracker(metainfo)
         print(peers)
         
         success = await download_from_peers_async(
-            'test.torrent',
+            metainfo,
             peers,
             'downloaded_file.bin',
             max_peers=50
@@ -0,0 +1,253 @@
+# In this file we decide which peers to be connected to.
+# Every address we learn about goes into a candidate pool. A semaphore holds
+# the connection budget, and whenever a slot is free the best candidate
+# that isn't backing off gets it. Addresses that fail to connect wait
+# 15 s, 30 s, 60 s, ... before they are retried and are dropped after a few
+# failures. Connected peers are ranked by the throughput they delivered
+# over the last interval; when the budget is full and fresh candidates are
+# waiting, the slowest peer is disconnected to make room for one of them.
+# Peers caught sending corrupt data are banned for the rest of the session.
+# Several managers (one per torrent) can also share a global connection
+# limit: a connection then needs a slot from both budgets. Peers that
+# connect to us take their slots from the same budgets.
+
+import asyncio
+import contextlib
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+class PeerCandidate:
+    """What we know about one peer address."""
+
+    __slots__ = ('addr', 'failures', 'next_attempt', 'connected', 'rate', 'downloaded')
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.failures = 0
+        self.next_attempt = 0.0
+        self.connected = False
+        # Best throughput seen from this peer (bytes/s) and bytes received overall
+        self.rate = 0.0
+        self.downloaded = 0
+
+    def score(self):
+        """Higher is better: proven fast peers first, then untried ones."""
+        return (self.rate, -self.failures)
+
+
+class ConnectionManager:
+    """Keeps up to `max_connections` peer workers running from a candidate pool."""
+
+    def __init__(self, worker, max_connections=50, get_progress=None, backoff_base=15,
+                 max_backoff=900, max_failures=3, replace_interval=30, replace_ratio=0.25,
+                 shared_slots=None, on_finished=None):
+        """
+        Args:
+            worker: Coroutine function (ip, port) run for each connection. It
+                returns the payload bytes received (None or 0 counts as a failure).
+            max_connections: Connection budget.
+            get_progress: Callable returning {addr: bytes received} for the
+                connected peers, used to rank them.
+            backoff_base: Seconds before the first retry of a failed address.
+            max_backoff: Upper limit for the retry delay.
+            max_failures: Consecutive failures after which an address is dropped.
+            replace_interval: Seconds between rankings (and the grace period
+                a new connection gets before it can be replaced).
+            replace_ratio: Replace a peer slower than this fraction of the
+                median rate of the others.
+            shared_slots: asyncio.Semaphore shared with other managers, for a
+                limit on connections across torrents.
+            on_finished: Callable run after a connection has ended and been
+                accounted for.
+        """
+        self.worker = worker
+        self.max_connections = max_connections
+        self.get_progress = get_progress
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.max_failures = max_failures
+        self.replace_interval = replace_interval
+        self.replace_ratio = replace_ratio
+
+        self._slots = asyncio.Semaphore(max_connections)
+        self.shared_slots = shared_slots
+        self.on_finished = on_finished
+        self.candidates = {}
+        # addr -> (worker task, connected since)
+        self.active = {}
+        # Connections holding a slot that we didn't start
+        self.inbound = 0
+        self.banned = set()
+        self._last_progress = {}
+        self._wakeup = asyncio.Event()
+
+    def add(self, addr):
+        """Add an address to the pool (no-op if it is already known or banned)."""
+        if addr not in self.candidates and addr not in self.banned:
+            self.candidates[addr] = PeerCandidate(addr)
+            self._wakeup.set()
+
+    def ban(self, addr):
+        """Disconnect an address and never connect to it again."""
+        self.banned.add(addr)
+        self.candidates.pop(addr, None)
+        entry = self.active.get(addr)
+        if entry is not None:
+            entry[0].cancel()
+
+    def has_candidates(self):
+        """Whether any address may still be (re)tried."""
+        return any(not c.connected for c in self.candidates.values())
+
+    async def run(self, peer_queue):
+        """Fill connection slots from the pool, taking new addresses from `peer_queue`."""
+        feeder = asyncio.create_task(self._feed(peer_queue))
+        ranker = asyncio.create_task(self._replace_slow_peers())
+        try:
+            while True:
+                # Only take slots once we have someone to connect to, so an
+                # idle loop leaves them free for inbound peers
+                await self._wait_for_candidate()
+                await self._slots.acquire()
+                if self.shared_slots is not None:
+                    await self.shared_slots.acquire()
+                candidate = self._next_candidate()
+                if candidate is None:
+                    self._release()
+                    continue
+                self._start(candidate)
+        finally:
+            feeder.cancel()
+            ranker.cancel()
+            tasks = [task for task, _ in self.active.values()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(feeder, ranker, *tasks, return_exceptions=True)
+
+    def has_room(self):
+        """Whether a connection could start right now without waiting for a slot."""
+        return not self._slots.locked() and \
+            (self.shared_slots is None or not self.shared_slots.locked())
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Hold a connection slot for a connection we didn't start (an inbound peer)."""
+        await self._slots.acquire()
+        try:
+            if self.shared_slots is not None:
+                await self.shared_slots.acquire()
+        except BaseException:
+            self._slots.release()
+            raise
+        self.inbound += 1
+        try:
+            yield
+        finally:
+            self.inbound -= 1
+            self._release()
+
+    def _release(self):
+        self._slots.release()
+        if self.shared_slots is not None:
+            self.shared_slots.release()
+
+    async def _feed(self, peer_queue):
+        while True:
+            self.add(await peer_queue.get())
+
+    async def _wait_for_candidate(self):
+        candidate = self._next_candidate()
+        while candidate is None:
+            # Sleep until a backoff runs out or a new address shows up
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._until_next_ready())
+            except asyncio.TimeoutError:
+                pass
+            candidate = self._next_candidate()
+        return candidate
+
+    def _next_candidate(self):
+        now = time.monotonic()
+        ready = [c for c in self.candidates.values() if not c.connected and c.next_attempt <= now]
+        if not ready:
+            return None
+        return max(ready, key=PeerCandidate.score)
+
+    def _until_next_ready(self):
+        waiting = [c.next_attempt for c in self.candidates.values() if not c.connected]
+        if not waiting:
+            return None
+        return max(0.0, min(waiting) - time.monotonic())
+
+    def _start(self, candidate):
+        candidate.connected = True
+        task = asyncio.create_task(self.worker(*candidate.addr))
+        self.active[candidate.addr] = (task, time.monotonic())
+        task.add_done_callback(lambda t: self._finished(candidate, t))
+
+    def _finished(self, candidate, task):
+        self._account(candidate, task)
+        if self.on_finished is not None:
+            self.on_finished()
+
+    def _account(self, candidate, task):
+        self.active.pop(candidate.addr, None)
+        self._last_progress.pop(candidate.addr, None)
+        candidate.connected = False
+        self._release()
+        if candidate.addr in self.banned:
+            return
+
+        received = None if task.cancelled() or task.exception() else task.result()
+        if not received:
+            # Failed to connect, sent us nothing, or we dropped it for being slow
+            candidate.failures += 1
+            if candidate.failures >= self.max_failures and not task.cancelled():
+                del self.candidates[candidate.addr]
+                return
+            delay = self.backoff_base * 2 ** (candidate.failures - 1)
+        else:
+            # A normal disconnect; the peer may take us back after a while
+            candidate.failures = 0
+            candidate.downloaded += received
+            delay = self.backoff_base
+        candidate.next_attempt = time.monotonic() + min(delay, self.max_backoff)
+        self._wakeup.set()
+
+    async def _replace_slow_peers(self):
+        """Every replace_interval, swap the slowest connected peer for a waiting candidate."""
+        while True:
+            await asyncio.sleep(self.replace_interval)
+            if self.get_progress is None:
+                continue
+            progress = self.get_progress()
+            now = time.monotonic()
+            rates = {}
+            for addr, received in progress.items():
+                previous = self._last_progress.get(addr)
+                self._last_progress[addr] = received
+                entry = self.active.get(addr)
+                if previous is None or entry is None or now - entry[1] < self.replace_interval:
+                    # Too new to judge
+                    continue
+                rate = (received - previous) / self.replace_interval
+                rates[addr] = rate
+                candidate = self.candidates.get(addr)
+                if candidate is not None:
+                    candidate.rate = max(candidate.rate, rate)
+
+            if len(self.active) + self.inbound < self.max_connections or self._next_candidate() is None:
+                continue
+            if len(rates) < 2:
+                continue
+            slowest = min(rates, key=rates.get)
+            others = sorted(rate for addr, rate in rates.items() if addr != slowest)
+            median = others[len(others) // 2]
+            if rates[slowest] < self.replace_ratio * median:
+                log.debug("Replacing slow peer %s:%d (%.1f KiB/s vs median %.1f KiB/s)",
+                          slowest[0], slowest[1], rates[slowest] / 1024, median / 1024)
+                self.active[slowest][0].cancel()
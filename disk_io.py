@@ -0,0 +1,196 @@
+# In this file we get disk writes off the event loop. Verified pieces are
+# queued on a DiskQueue (one can be shared by several torrents); a flusher
+# hands them to a small pool of I/O threads in batches. Each batch is sorted
+# by offset and pieces that sit next to each other in the torrent are merged
+# into one write (a single pwritev() per file), so sequential downloads turn
+# into a few large writes instead of many small ones. While a batch is being
+# written the next one collects, so the slower the disk, the bigger (and
+# cheaper) the writes get.
+#
+# The queue holds at most `max_pending_bytes`; past that, wait_for_room()
+# makes the downloader wait, which stops it requesting more data until the
+# disk catches up.
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import REGISTRY
+
+DEFAULT_MAX_PENDING_BYTES = 64 * 1024 * 1024
+
+WRITE_LATENCY = REGISTRY.histogram('bt_disk_write_seconds',
+                                   "Time from queueing a verified piece to having it on disk")
+WRITE_CALLS = REGISTRY.counter('bt_disk_write_calls_total',
+                               "Coalesced writes issued (each covers one or more pieces)")
+QUEUE_DEPTH = REGISTRY.gauge('bt_disk_queue_pieces', "Pieces queued or being written")
+QUEUE_BYTES = REGISTRY.gauge('bt_disk_queue_bytes', "Bytes queued or being written")
+
+
+class DiskQueue:
+    """Asynchronous, write-coalescing piece writer with bounded memory."""
+
+    def __init__(self, max_workers=2, max_pending_bytes=DEFAULT_MAX_PENDING_BYTES):
+        """
+        Args:
+            max_workers: I/O threads (batches written concurrently).
+            max_pending_bytes: Queued and in-flight bytes above which
+                wait_for_room() blocks.
+        """
+        self.max_workers = max_workers
+        self.max_pending_bytes = max_pending_bytes
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='disk-io')
+
+        # (storage, offset, data, future, queued_at) waiting for the flusher
+        self._queue = []
+        self._queued = asyncio.Event()
+        self._slots = asyncio.Semaphore(max_workers)
+        self._room = asyncio.Event()
+        self._room.set()
+        self._flusher = None
+        self._batches = set()
+
+        # Pieces and bytes queued or being written
+        self.pending = 0
+        self.pending_bytes = 0
+        # Counters: pieces written, write calls they took, and seconds from
+        # queueing to being on disk
+        self.pieces_written = 0
+        self.bytes_written = 0
+        self.write_calls = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self._total_flush_latency = 0.0
+
+    def write_piece(self, storage, piece_idx, data):
+        """
+        Queue a verified piece for writing; `data` must not change until it is written.
+
+        Args:
+            storage: The opened PieceStorage the piece belongs to.
+
+        Returns:
+            asyncio.Future: Done once the piece is on disk.
+        """
+        if len(data) != storage.piece_size(piece_idx):
+            raise ValueError(f"Piece {piece_idx} has the wrong length ({len(data)} bytes)")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.append((storage, piece_idx * storage.piece_length, data, future, time.monotonic()))
+        self.pending += 1
+        self.pending_bytes += len(data)
+        QUEUE_DEPTH.inc()
+        QUEUE_BYTES.inc(len(data))
+        self._queued.set()
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+        return future
+
+    async def wait_for_room(self):
+        """Wait while more than max_pending_bytes are queued (backpressure)."""
+        while self.pending_bytes >= self.max_pending_bytes:
+            self._room.clear()
+            await self._room.wait()
+
+    async def flush(self):
+        """Wait until everything queued so far is on disk."""
+        waiting = [entry[3] for entry in self._queue]
+        await asyncio.gather(*waiting, *self._batches, return_exceptions=True)
+
+    async def run(self, func, *args):
+        """Run another disk operation (e.g. a read) on the I/O threads."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def close(self):
+        """Write out what is queued and stop the I/O threads."""
+        await self.flush()
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        self.executor.shutdown(wait=True)
+
+    def stats(self):
+        """Queue depth, throughput and latency counters."""
+        return {
+            'queue_depth': self.pending,
+            'pending_bytes': self.pending_bytes,
+            'pieces_written': self.pieces_written,
+            'bytes_written': self.bytes_written,
+            'write_calls': self.write_calls,
+            'avg_flush_latency': (self._total_flush_latency / self.pieces_written
+                                  if self.pieces_written else 0.0),
+            'max_flush_latency': self.max_flush_latency,
+            'last_flush_latency': self.last_flush_latency,
+        }
+
+    async def _flush_loop(self):
+        while True:
+            await self._queued.wait()
+            # Take everything queued once an I/O thread is free; the longer
+            # we wait here, the more pieces the batch can merge
+            await self._slots.acquire()
+            batch, self._queue = self._queue, []
+            self._queued.clear()
+            task = asyncio.create_task(self._write_batch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _write_batch(self, batch):
+        try:
+            runs = _coalesce(batch)
+            loop = asyncio.get_running_loop()
+            for storage, offset, buffers, entries in runs:
+                try:
+                    await loop.run_in_executor(self.executor, storage.writev_at, offset, buffers)
+                    error = None
+                except OSError as e:
+                    error = e
+                self.write_calls += 1
+                WRITE_CALLS.inc()
+                self._finish(entries, error)
+        finally:
+            self._slots.release()
+
+    def _finish(self, entries, error):
+        now = time.monotonic()
+        for _, _, data, future, queued_at in entries:
+            self.pending -= 1
+            self.pending_bytes -= len(data)
+            QUEUE_DEPTH.dec()
+            QUEUE_BYTES.dec(len(data))
+            if error is None:
+                latency = now - queued_at
+                WRITE_LATENCY.observe(latency)
+                self.pieces_written += 1
+                self.bytes_written += len(data)
+                self.last_flush_latency = latency
+                self.max_flush_latency = max(self.max_flush_latency, latency)
+                self._total_flush_latency += latency
+            if not future.done():
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+        if self.pending_bytes < self.max_pending_bytes:
+            self._room.set()
+
+
+def _coalesce(batch):
+    """
+    Merge writes that are adjacent in the same torrent's byte stream.
+
+    Returns:
+        list: (storage, offset, [buffers], [entries]) runs in offset order.
+    """
+    runs = []
+    for entry in sorted(batch, key=lambda entry: (id(entry[0]), entry[1])):
+        storage, offset, data = entry[0], entry[1], entry[2]
+        if runs and runs[-1][0] is storage and runs[-1][1] + runs[-1][4] == offset:
+            run = runs[-1]
+            run[2].append(data)
+            run[3].append(entry)
+            run[4] += len(data)
+        else:
+            runs.append([storage, offset, [data], [entry], len(data)])
+    return [run[:4] for run in runs]
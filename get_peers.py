@@ -1,18 +1,46 @@
 # In this file we fetch the IP list of peers from tracker
 
+import asyncio
+import functools
+import logging
 import urllib.parse
 import urllib.request
-import hashlib
 import os
-import random
-from parser import bdecode, bencode
+from collections import namedtuple
+from parser import bdecode
+from metainfo import as_metainfo
 
-def get_peers_from_tracker(torrent_file_path, port=6881, numwant=50):
+log = logging.getLogger(__name__)
+
+# What a tracker told us: the peers plus when to come back
+AnnounceResult = namedtuple('AnnounceResult', ['peers', 'interval', 'min_interval', 'seeders', 'leechers'])
+
+
+def make_peer_id(prefix=b'-PY0001-'):
+    """Generate a peer_id (20 bytes, e.g., '-PY0001-' + random)."""
+    return prefix + os.urandom(20 - len(prefix))
+
+
+def parse_compact_peers(peers_data):
+    """Decode the compact peer format: 4 bytes IP + 2 bytes port per peer."""
+    if len(peers_data) % 6 != 0:
+        raise ValueError("Invalid compact peers format")
+    peers = []
+    for i in range(0, len(peers_data), 6):
+        ip = '.'.join(map(str, peers_data[i:i+4]))
+        port = int.from_bytes(peers_data[i+4:i+6], 'big')
+        peers.append((ip, port))
+    return peers
+
+
+def get_peers_from_tracker(torrent, port=6881, numwant=50):
     """
     Communicate with the tracker to fetch a list of peers for the torrent.
     
+    Only HTTP trackers are supported here; use get_peers_async for udp://.
+    
     Args:
-        torrent_file_path (str): Path to the .torrent file.
+        torrent: A Metainfo, or the path to a .torrent file.
         port (int): The port your client is listening on (default: 6881).
         numwant (int): Number of peers to request (default: 50).
         
@@ -23,44 +51,39 @@ def get_peers_from_tracker(torrent_file_path, port=6881, numwant=50):
         ValueError: If required keys are missing or request fails.
         urllib.error.URLError: If network issues occur.
     """
-    # Read and decode the torrent file
-    with open(torrent_file_path, 'rb') as f:
-        torrent_data = f.read()
-    decoded = bdecode(torrent_data)
-    
-    if b'announce' not in decoded:
+    metainfo = as_metainfo(torrent)
+    if metainfo.announce is None:
         raise ValueError("Torrent file missing 'announce' key")
-    announce_url = decoded[b'announce'].decode('utf-8')
-    
-    info = decoded[b'info']
-    # Re-encode info to compute info_hash
-    info_bencoded = bencode(info)
-    info_hash = hashlib.sha1(info_bencoded).digest()
-    
-    # Calculate total bytes left (for single or multi-file torrents)
-    if b'length' in info:
-        left = info[b'length']
-    elif b'files' in info:
-        left = sum(f[b'length'] for f in info[b'files'])
-    else:
-        raise ValueError("Invalid info dictionary: missing 'length' or 'files'")
-    
-    # Generate a peer_id (20 bytes, e.g., '-PY0001-' + random)
-    peer_id_prefix = b'-PY0001-'
-    peer_id = peer_id_prefix + os.urandom(20 - len(peer_id_prefix))
+    result = http_announce(metainfo.announce, metainfo.info_hash, make_peer_id(),
+                           metainfo.total_length, port, numwant)
+    return result.peers
+
+
+def http_announce(announce_url, info_hash, peer_id, left, port=6881, numwant=50,
+                  downloaded=0, uploaded=0, event='started', timeout=10):
+    """
+    Send one announce to an HTTP tracker (blocking).
     
+    Returns:
+        AnnounceResult: The peers plus the tracker's interval and swarm counts.
+        
+    Raises:
+        ValueError: If the request fails or the response is invalid.
+        urllib.error.URLError: If network issues occur.
+    """
     # Prepare parameters for the announce request
     params = {
         'info_hash': info_hash,
         'peer_id': peer_id,
         'port': port,
-        'uploaded': 0,
-        'downloaded': 0,
+        'uploaded': uploaded,
+        'downloaded': downloaded,
         'left': left,
         'compact': 1,
-        'event': 'started',
         'numwant': numwant,
     }
+    if event:
+        params['event'] = event
     
     # URL-encode binary values properly
     query_parts = []
@@ -81,22 +104,20 @@ def get_peers_from_tracker(torrent_file_path, port=6881, numwant=50):
     else:
         full_url = announce_url + '?' + query_string
     
-    print(f"Announce URL: {announce_url}")
-    print(f"Full announce URL: {full_url}")
-    # print(f"Requesting: {announce_url}")
+    log.debug("Announcing to %s", full_url)
     
     # Send HTTP GET request
     req = urllib.request.Request(full_url)
     req.add_header('User-Agent', 'Python-BitTorrent-Client/1.0')
     
     try:
-        with urllib.request.urlopen(req, timeout=10) as response:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
             tracker_data = response.read()
     except urllib.error.HTTPError as e:
         error_body = e.read().decode('utf-8', errors='ignore')
         raise ValueError(f"Tracker returned error: {e.code} - {error_body}")
     
-    print(f"Received tracker response: {tracker_data}")
+    log.debug("Received tracker response: %r", tracker_data)
     # Decode the tracker response (bencoded)
     tracker_decoded = bdecode(tracker_data)
     
@@ -109,23 +130,13 @@ def get_peers_from_tracker(torrent_file_path, port=6881, numwant=50):
         raise ValueError("Tracker response missing 'peers' key")
     
     peers_data = tracker_decoded[b'peers']
-    # print(f"Received peers from tracker: ", peers_data)
     
     # Handle both compact and non-compact peer formats
-    peers = []
     if isinstance(peers_data, bytes):
-        # Compact format: 4 bytes IP + 2 bytes port per peer
-        if len(peers_data) % 6 != 0:
-            raise ValueError("Invalid compact peers format")
-        
-        for i in range(0, len(peers_data), 6):
-            ip_bytes = peers_data[i:i+4]
-            port_bytes = peers_data[i+4:i+6]
-            ip = '.'.join(map(str, ip_bytes))
-            port = int.from_bytes(port_bytes, 'big')
-            peers.append((ip, port))
+        peers = parse_compact_peers(peers_data)
     elif isinstance(peers_data, list):
         # Non-compact format: sometimes the tracker might send a list of dictionaries
+        peers = []
         for peer_dict in peers_data:
             ip = peer_dict[b'ip'].decode('utf-8')
             port = peer_dict[b'port']
@@ -133,7 +144,53 @@ def get_peers_from_tracker(torrent_file_path, port=6881, numwant=50):
     else:
         raise ValueError("Unknown peers format")
     
-    return peers
+    return AnnounceResult(peers, tracker_decoded.get(b'interval'), tracker_decoded.get(b'min interval'),
+                          tracker_decoded.get(b'complete'), tracker_decoded.get(b'incomplete'))
+
+
+async def announce(announce_url, info_hash, peer_id, left, port=6881, numwant=50,
+                   downloaded=0, uploaded=0, event='started', udp_client=None):
+    """
+    Announce to an HTTP or UDP tracker without blocking the event loop.
+    
+    Args:
+        udp_client: A UDPTrackerClient shared by all udp:// announces; a
+            temporary one is used if omitted.
+    
+    Returns:
+        AnnounceResult: The peers plus the tracker's interval and swarm counts.
+    """
+    scheme = urllib.parse.urlparse(announce_url).scheme
+    if scheme == 'udp':
+        from udp_parser import UDPTrackerClient
+        if udp_client is not None:
+            return await udp_client.announce(announce_url, info_hash, peer_id, left, port, numwant,
+                                             downloaded, uploaded, event)
+        async with UDPTrackerClient() as client:
+            return await client.announce(announce_url, info_hash, peer_id, left, port, numwant,
+                                         downloaded, uploaded, event)
+    if scheme in ('http', 'https'):
+        # urllib is blocking, so the HTTP request runs on a worker thread
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(
+            http_announce, announce_url, info_hash, peer_id, left, port, numwant,
+            downloaded, uploaded, event))
+    raise ValueError(f"Unsupported tracker URL: {announce_url}")
+
+
+async def get_peers_async(torrent, port=6881, numwant=50, udp_client=None):
+    """
+    Fetch the peer list from the torrent's tracker, HTTP or UDP.
+    
+    Returns:
+        list: List of tuples (ip_str, port_int) for peers.
+    """
+    metainfo = as_metainfo(torrent)
+    if metainfo.announce is None:
+        raise ValueError("Torrent file missing 'announce' key")
+    result = await announce(metainfo.announce, metainfo.info_hash, make_peer_id(),
+                            metainfo.total_length, port, numwant, udp_client=udp_client)
+    return result.peers
 
 # Example usage
 if __name__ == "__main__":
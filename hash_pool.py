@@ -0,0 +1,86 @@
+# In this file we hash pieces on a pool of worker threads so SHA-1 never
+# runs on the event loop thread. hashlib releases the GIL while it hashes
+# large buffers, so the threads really do use several cores in parallel.
+# A semaphore caps how many pieces may be queued for hashing at once; when
+# the hashers fall behind, submit() makes the downloader wait.
+
+import asyncio
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import REGISTRY
+
+HASH_TIME = REGISTRY.histogram('bt_hash_seconds', "Time a hashing thread spent on one piece")
+HASH_PENDING = REGISTRY.gauge('bt_hash_pending', "Pieces queued or being hashed")
+
+
+def _timed_sha1_digest(data):
+    started = time.perf_counter()
+    digest = hashlib.sha1(data).digest()
+    return digest, time.perf_counter() - started
+
+
+class HashPool:
+    """Thread pool for SHA-1 piece verification with a bounded backlog."""
+
+    def __init__(self, max_workers=None, max_pending=None):
+        """
+        Args:
+            max_workers: Number of hashing threads (default: CPU count).
+            max_pending: Pieces that may be queued or hashing at once
+                (default: twice the number of threads).
+        """
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or 2 * self.max_workers
+        self.pending = 0
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                            thread_name_prefix='sha1')
+
+    async def submit(self, data):
+        """
+        Queue `data` for hashing, waiting first if the backlog is full.
+
+        The buffer must not be modified until the returned future is done.
+
+        Returns:
+            asyncio.Future: Resolves to the 20-byte SHA-1 digest.
+        """
+        await self._slots.acquire()
+        self.pending += 1
+        HASH_PENDING.inc()
+        loop = asyncio.get_running_loop()
+        # The time is taken in the thread, so it doesn't include queueing
+        timed = loop.run_in_executor(self._executor, _timed_sha1_digest, data)
+        future = loop.create_future()
+        timed.add_done_callback(lambda done: self._release(done, future))
+        return future
+
+    def _release(self, timed, future):
+        self.pending -= 1
+        HASH_PENDING.dec()
+        self._slots.release()
+        if future.cancelled():
+            return
+        if timed.cancelled():
+            future.cancel()
+        elif timed.exception() is not None:
+            future.set_exception(timed.exception())
+        else:
+            digest, seconds = timed.result()
+            HASH_TIME.observe(seconds)
+            future.set_result(digest)
+
+    async def run(self, func, *args):
+        """Run other hashing work (e.g. per-block digests) on the pool's threads."""
+        await self._slots.acquire()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Stop the worker threads, dropping any hashing not yet started."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -1,30 +1,69 @@
+import argparse
+import asyncio
+import logging
+from metainfo import Metainfo
+from metrics import MetricsServer
+from profiling import RunProfiler
+from session import Session
 
+async def main(args):
+    # Parse every torrent up front so a bad file fails before anything starts
+    torrents = [Metainfo.load(path) for path in args.torrents]
 
-import asyncio
-from get_peers import get_peers_from_tracker
-from connect_to_peer_async import download_from_peers_async
+    # Counters, gauges and histograms for Prometheus (or as JSON)
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = MetricsServer(port=args.metrics_port)
+        await metrics_server.start()
+
+    def completed(downloader):
+        print(f"{downloader.metainfo.name}: download successful!")
+        if downloader.seed:
+            print(f"{downloader.metainfo.name}: seeding; press Ctrl+C to stop")
+
+    # All torrents run in one session: they share the listening port, the
+    # tracker socket, the hashing and disk threads and the connection limit.
+    # Each keeps re-announcing to its trackers, downloads from every peer
+    # they return and, once complete, keeps seeding until interrupted (or,
+    # with --no-seed, stops; the program exits when every torrent has).
+    try:
+        async with Session(port=args.port) as session:
+            for metainfo in torrents:
+                session.add_torrent(metainfo, seed=args.seed, on_complete=completed)
+                print(f"Added {metainfo.name}")
+            results = await session.wait()
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+
+    # Completed torrents were reported as they finished
+    for metainfo in torrents:
+        if results.get(metainfo.info_hash) is not True:
+            print(f"{metainfo.name}: download failed or incomplete")
 
-async def main():    
-    #  Get peers
-    peers = get_peers_from_tracker('test.torrent')
-    if len(peers) == 0:
-        print("No peers found in tracker. Exiting...")
-        return
-    
-    # Connect with peers and start downloading
-    success = await download_from_peers_async(
-        'test.torrent',
-        peers,
-        'downloaded_file.mkv',
-        max_peers=50
-    )
-    
-    if success:
-        print("Download successful!")
-    else:
-        print("Download failed or incomplete")
+async def profiled(coroutine_function, args):
+    # Times the engine's coroutines, samples event-loop lag and runs cProfile
+    async with RunProfiler(args.profile):
+        await coroutine_function(args)
 
-try:
-    asyncio.run(main())
-except KeyboardInterrupt:
-    print("\nDownload interrupted by user")
\ No newline at end of file
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Download and seed torrents.")
+    arg_parser.add_argument('torrents', nargs='*', default=['test.torrent'], help=".torrent files")
+    arg_parser.add_argument('--port', type=int, default=6881, help="Port to accept peers on")
+    arg_parser.add_argument('--no-seed', dest='seed', action='store_false',
+                            help="Stop each torrent once it is downloaded instead of seeding it")
+    arg_parser.add_argument('--metrics-port', type=int,
+                            help="Serve /metrics and /metrics.json on this port")
+    arg_parser.add_argument('--profile', nargs='?', const='profile.json', metavar='REPORT',
+                            help="Profile the run and write a JSON report (default: profile.json)")
+    arg_parser.add_argument('--log-level', default='INFO',
+                            choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    try:
+        if args.profile:
+            asyncio.run(profiled(main, args))
+        else:
+            asyncio.run(main(args))
+    except KeyboardInterrupt:
+        print("\nDownload interrupted by user")
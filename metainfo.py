@@ -0,0 +1,122 @@
+# In this file we parse a .torrent once into a Metainfo object.
+# Everything that used to re-read and re-hash the torrent on its own (the
+# tracker client, the downloaders, calc_hash) takes this object instead, so
+# per-torrent setup is one bdecode plus one SHA-1 over the original bytes of
+# the info dictionary. Piece hashes stay a view into the decoded file data.
+
+import os
+from parser import bdecode, info_hash_of
+
+HASH_LENGTH = 20
+
+
+class PieceHashes:
+    """Indexable, zero-copy sequence of the 20-byte piece hashes."""
+
+    __slots__ = ('view',)
+
+    def __init__(self, pieces):
+        if len(pieces) % HASH_LENGTH:
+            raise ValueError("Length of 'pieces' is not a multiple of 20")
+        self.view = memoryview(pieces)
+
+    def __len__(self):
+        return len(self.view) // HASH_LENGTH
+
+    def __getitem__(self, piece_idx):
+        if piece_idx < 0:
+            piece_idx += len(self)
+        if not 0 <= piece_idx < len(self):
+            raise IndexError("Piece index out of range")
+        start = piece_idx * HASH_LENGTH
+        return self.view[start:start + HASH_LENGTH].tobytes()
+
+    def __iter__(self):
+        for start in range(0, len(self.view), HASH_LENGTH):
+            yield self.view[start:start + HASH_LENGTH].tobytes()
+
+
+class Metainfo:
+    """A parsed .torrent with everything the client needs precomputed."""
+
+    __slots__ = ('path', 'announce', 'announce_list', 'info', 'info_hash', 'name',
+                 'piece_length', 'piece_hashes', 'num_pieces', 'total_length',
+                 'last_piece_length', 'files')
+
+    def __init__(self, torrent, path=None):
+        """
+        Args:
+            torrent: The decoded torrent dictionary.
+            path: Where it was loaded from, if anywhere.
+
+        Raises:
+            ValueError: If required keys are missing or inconsistent.
+        """
+        if b'info' not in torrent:
+            raise ValueError("Torrent file does not contain 'info' dictionary")
+        info = torrent[b'info']
+        self.path = path
+        self.info = info
+        self.info_hash = info_hash_of(info)
+
+        announce = torrent.get(b'announce')
+        self.announce = announce.decode('utf-8') if announce else None
+        self.announce_list = [[url.decode('utf-8') for url in tier]
+                              for tier in torrent.get(b'announce-list', [])]
+
+        self.name = bytes(info.get(b'name', b'')).decode('utf-8', errors='replace')
+        self.piece_length = info[b'piece length']
+        self.piece_hashes = PieceHashes(info[b'pieces'])
+        self.num_pieces = len(self.piece_hashes)
+
+        # File layout as (path components, length), in torrent order
+        if b'length' in info:
+            self.files = [((self.name,), info[b'length'])]
+        elif b'files' in info:
+            self.files = [(tuple(bytes(c).decode('utf-8', errors='replace') for c in f[b'path']),
+                           f[b'length']) for f in info[b'files']]
+        else:
+            raise ValueError("Invalid info dictionary: missing 'length' or 'files'")
+        self.total_length = sum(length for _, length in self.files)
+
+        if self.num_pieces != -(-self.total_length // self.piece_length):
+            raise ValueError(f"Torrent has {self.num_pieces} piece hashes for {self.total_length} bytes")
+        self.last_piece_length = self.total_length - (self.num_pieces - 1) * self.piece_length
+
+    @classmethod
+    def load(cls, torrent_file_path):
+        """Read and parse a .torrent file."""
+        with open(torrent_file_path, 'rb') as f:
+            data = f.read()
+        return cls.from_bytes(data, path=torrent_file_path)
+
+    @classmethod
+    def from_bytes(cls, data, path=None):
+        """Parse the raw contents of a .torrent file."""
+        return cls(bdecode(data, lazy=True), path=path)
+
+    @property
+    def is_multi_file(self):
+        return b'files' in self.info
+
+    def piece_size(self, piece_idx):
+        """Length of a piece in bytes (the last piece may be shorter)."""
+        if piece_idx == self.num_pieces - 1:
+            return self.last_piece_length
+        return self.piece_length
+
+    def piece_hash(self, piece_idx):
+        """Expected SHA-1 of a piece."""
+        return self.piece_hashes[piece_idx]
+
+    def __repr__(self):
+        return f"Metainfo({self.name!r}, {self.num_pieces} pieces, {self.total_length} bytes)"
+
+
+def as_metainfo(torrent):
+    """Accept either a Metainfo or a path to a .torrent file."""
+    if isinstance(torrent, Metainfo):
+        return torrent
+    if isinstance(torrent, (str, bytes, os.PathLike)):
+        return Metainfo.load(torrent)
+    raise TypeError(f"Expected a Metainfo or a .torrent path, got {type(torrent).__name__}")
@@ -0,0 +1,306 @@
+# In this file we keep counters, gauges and histograms about the download
+# engine and export them, in the Prometheus text format or as JSON, from a
+# small HTTP endpoint.
+#
+# Updating a metric is meant to be cheap enough for the hot path: a label
+# set is a plain tuple of values, and a histogram observation is a bisect
+# and two additions. Values the engine already tracks (bytes per peer,
+# wasted bytes, queue depths) are not copied into metrics on every change;
+# a collector callback reads them when the metrics are scraped.
+
+import asyncio
+import json
+import logging
+from bisect import bisect_left
+
+log = logging.getLogger(__name__)
+
+# Seconds, from sub-millisecond (hashing, disk writes) to minutes (chokes)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Metric:
+    """A named family of samples, one per label set."""
+
+    type = 'untyped'
+
+    def __init__(self, name, help, labelnames=()):
+        """
+        Args:
+            name: Metric name (Prometheus naming, e.g. `bt_wasted_bytes_total`).
+            help: One line describing it.
+            labelnames: Names of the labels; samples are keyed by a tuple of
+                values in the same order.
+        """
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def remove(self, labels):
+        """Forget the sample of one label set (e.g. a peer that left)."""
+        self.values.pop(labels, None)
+
+    def samples(self):
+        """Yield (suffix, labels dict, value) for every sample."""
+        for labels, value in self.values.items():
+            yield '', dict(zip(self.labelnames, labels)), value
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    type = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return self.values.get(labels, 0)
+
+
+class Gauge(Metric):
+    """A value that goes up and down."""
+
+    type = 'gauge'
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def value(self, labels=()):
+        return self.values.get(labels, 0)
+
+
+class Histogram(Metric):
+    """Counts observations in buckets, plus their sum and count."""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        state = self.values.get(labels)
+        if state is None:
+            # Per-bucket counts (the last one is +Inf), sum, count
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def snapshot(self, labels=()):
+        """
+        Returns:
+            dict: Cumulative bucket counts keyed by upper bound, sum and count.
+        """
+        counts, total, count = self.values.get(labels, ([0] * (len(self.buckets) + 1), 0.0, 0))
+        cumulative = {}
+        running = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            running += bucket_count
+            cumulative[bound] = running
+        return {'buckets': cumulative, 'sum': total, 'count': count}
+
+    def samples(self):
+        for labels in self.values:
+            label_dict = dict(zip(self.labelnames, labels))
+            snapshot = self.snapshot(labels)
+            for bound, count in snapshot['buckets'].items():
+                yield '_bucket', dict(label_dict, le=_format_value(bound)), count
+            yield '_sum', label_dict, snapshot['sum']
+            yield '_count', label_dict, snapshot['count']
+
+
+class Registry:
+    """The metrics of a process, and the callbacks that sample the rest at scrape time."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def counter(self, name, help, labelnames=()):
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get_or_create(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = Histogram(name, help, labelnames, buckets)
+        return metric
+
+    def _get_or_create(self, cls, name, help, labelnames):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, help, labelnames)
+        elif not isinstance(metric, cls):
+            raise ValueError(f"Metric {name} is already registered as a {metric.type}")
+        return metric
+
+    def add_collector(self, collector):
+        """
+        Register a callable run at every scrape.
+
+        It returns Metric objects filled with the current values of things
+        tracked elsewhere; metrics of the same name from several collectors
+        are merged.
+        """
+        self._collectors.append(collector)
+
+    def remove_collector(self, collector):
+        try:
+            self._collectors.remove(collector)
+        except ValueError:
+            pass
+
+    def collect(self):
+        """Every metric, with the collectors' merged in by name."""
+        merged = {}
+        for metric in self._metrics.values():
+            merged[metric.name] = metric
+        for collector in list(self._collectors):
+            try:
+                collected = list(collector())
+            except Exception:
+                log.exception("Metrics collector %r failed", collector)
+                continue
+            for metric in collected:
+                existing = merged.get(metric.name)
+                if existing is None:
+                    merged[metric.name] = metric
+                else:
+                    if existing is self._metrics.get(metric.name):
+                        # Don't write collected samples into the registered metric
+                        existing = merged[metric.name] = _copy(existing)
+                    existing.values.update(metric.values)
+        return list(merged.values())
+
+    def render_text(self):
+        """The Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in self.collect():
+            lines.append(f"# HELP {metric.name} {_escape_help(metric.help)}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labels, value in metric.samples():
+                if labels:
+                    label_text = ','.join(f'{key}="{_escape_label(val)}"' for key, val in labels.items())
+                    lines.append(f"{metric.name}{suffix}{{{label_text}}} {_format_value(value)}")
+                else:
+                    lines.append(f"{metric.name}{suffix} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def as_dict(self):
+        """Every metric as a JSON-serialisable dict."""
+        result = {}
+        for metric in self.collect():
+            samples = []
+            for labels in metric.values:
+                label_dict = dict(zip(metric.labelnames, labels))
+                if isinstance(metric, Histogram):
+                    snapshot = metric.snapshot(labels)
+                    snapshot['buckets'] = {_format_value(bound): count
+                                           for bound, count in snapshot['buckets'].items()}
+                    samples.append({'labels': label_dict, **snapshot})
+                else:
+                    samples.append({'labels': label_dict, 'value': metric.values[labels]})
+            result[metric.name] = {'type': metric.type, 'help': metric.help, 'samples': samples}
+        return result
+
+
+def _copy(metric):
+    if isinstance(metric, Histogram):
+        copy = Histogram(metric.name, metric.help, metric.labelnames, metric.buckets)
+    else:
+        copy = type(metric)(metric.name, metric.help, metric.labelnames)
+    copy.values = dict(metric.values)
+    return copy
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return str(int(value)) if value.is_integer() and abs(value) < 1e15 else repr(value)
+    return str(value)
+
+
+def _escape_help(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# The registry the engine's modules record into
+REGISTRY = Registry()
+
+
+class MetricsServer:
+    """Serves a registry over HTTP: /metrics (Prometheus text) and /metrics.json."""
+
+    def __init__(self, registry=REGISTRY, port=9100, host='127.0.0.1'):
+        self.registry = registry
+        self.port = port
+        self.host = host
+        self.server = None
+
+    async def start(self):
+        """
+        Start serving.
+
+        Returns:
+            bool: False if the port could not be bound.
+        """
+        if self.server is not None:
+            return True
+        try:
+            self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        except OSError as e:
+            log.error("Cannot serve metrics on port %d: %s", self.port, e)
+            return False
+        log.info("Serving metrics on http://%s:%d/metrics", self.host, self.port)
+        return True
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            # Skip the headers; we don't need any of them
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 10)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            parts = request.split()
+            path = parts[1].decode('latin-1').split('?')[0] if len(parts) >= 2 else ''
+            if parts[:1] != [b'GET']:
+                status, content_type, body = '405 Method Not Allowed', 'text/plain', b'GET only\n'
+            elif path == '/metrics':
+                status, content_type = '200 OK', 'text/plain; version=0.0.4; charset=utf-8'
+                body = self.registry.render_text().encode()
+            elif path == '/metrics.json':
+                status, content_type = '200 OK', 'application/json'
+                body = json.dumps(self.registry.as_dict()).encode()
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain', b'Not found\n'
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode())
+            writer.write(body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
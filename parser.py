@@ -1,67 +1,136 @@
 # In this file we write helper functions to parse .torrent data
-import pprint
-
-def parse_int(data, i):
-    assert data[i] == ord('i')
-    i += 1
-    j = data.index(b'e', i)
-    val = int(data[i:j].decode())
-    return val, j+1
-
-def parse_str(data, i):
-    j = data.index(b':', i)
-    length = int(data[i:j])
-    j += 1
-    s = data[j:j+length]
-    return s, j+length
-
-def parse_list(data, i):
-    assert data[i] == ord('l')
-    i += 1
-    arr = []
-    while i<len(data) and data[i] != ord('e'):
-        val, i = parse_any(data, i)
-        arr.append(val)
-    return arr, i+1
-
-def parse_dict(data, i):
-    assert data[i] == ord('d')
-    i += 1
-    d = {}
-    while i<len(data) and data[i] != ord('e'):
-        key, i = parse_str(data, i)
-        val, i = parse_any(data, i)
-        d[key] = val
-    return d, i+1
-
-def parse_any(data, i):
-    if data[i] == ord('i'):
-        return parse_int(data, i)
-    elif data[i] == ord('l'):
-        return parse_list(data, i)
-    elif data[i] == ord('d'):
-        return parse_dict(data, i)
-    elif chr(data[i]).isdigit():
-        return parse_str(data, i)
-    else:
-        raise ValueError(f"Invalid bencode type at index {i}: {chr(data[i])}")
+import hashlib
+
+# Decoding is iterative (an explicit stack instead of recursion) and every
+# dictionary remembers the exact bytes it was decoded from in `.raw`, so the
+# info hash is a SHA-1 over the original span instead of a re-encode. With
+# lazy=True, long strings such as the 20*N byte `pieces` value come back as
+# memoryview slices of the input instead of copies.
+
+# Strings at least this long are returned as memoryviews when decoding lazily
+LAZY_MIN_LENGTH = 1024
+
+_DIGITS = frozenset(b'0123456789')
+
+
+class BDict(dict):
+    """A decoded dictionary that keeps a view of its original encoding."""
+    __slots__ = ('raw',)
+
+
+def bdecode(data, lazy=False):
+    """
+    Decode bencoded data.
+
+    Args:
+        data: The encoded bytes (bytearray and memoryview are copied to bytes).
+        lazy: Return strings of LAZY_MIN_LENGTH bytes or more as memoryview
+            slices of `data` instead of copying them.
+
+    Returns:
+        The decoded value; dictionaries are BDict instances.
 
-def bdecode(data):
-    if not isinstance(data, bytes):
+    Raises:
+        ValueError: If the data is not valid bencode.
+    """
+    if isinstance(data, (bytearray, memoryview)):
+        data = bytes(data)
+    elif not isinstance(data, bytes):
         raise ValueError("Input must be a byte string")
     if not data:
         raise ValueError("Empty input")
-    
-    result, index = parse_any(data, 0)
-    if index < len(data):
-        raise ValueError(f"Extra data after parsing at index {index}")
-    return result
+
+    view = memoryview(data)
+    size = len(data)
+    find = data.index
+    lazy_min = LAZY_MIN_LENGTH if lazy else size + 1
+
+    # Open containers, where each one started, and each dict's pending key
+    stack = []
+    starts = []
+    keys = []
+    i = 0
+    try:
+        while True:
+            c = data[i]
+            if c == 0x64:  # 'd'
+                stack.append(BDict())
+                starts.append(i)
+                keys.append(None)
+                i += 1
+                continue
+            if c == 0x6c:  # 'l'
+                stack.append([])
+                starts.append(i)
+                keys.append(None)
+                i += 1
+                continue
+
+            if c == 0x65:  # 'e'
+                if not stack:
+                    raise ValueError(f"Unexpected end marker at index {i}")
+                value = stack.pop()
+                start = starts.pop()
+                if keys.pop() is not None:
+                    raise ValueError(f"Dictionary key without a value at index {i}")
+                i += 1
+                if type(value) is BDict:
+                    value.raw = view[start:i]
+            elif c in _DIGITS:
+                j = find(b':', i)
+                length = int(data[i:j])
+                j += 1
+                i = j + length
+                if i > size:
+                    raise ValueError(f"String at index {j} runs past the end of the data")
+                value = view[j:i] if length >= lazy_min else data[j:i]
+            elif c == 0x69:  # 'i'
+                j = find(b'e', i)
+                value = int(data[i + 1:j])
+                i = j + 1
+            else:
+                raise ValueError(f"Invalid bencode type at index {i}: {chr(c)}")
+
+            if not stack:
+                break
+            container = stack[-1]
+            if type(container) is list:
+                container.append(value)
+            elif keys[-1] is None:
+                if type(value) is memoryview:
+                    value = bytes(value)
+                elif type(value) is not bytes:
+                    raise ValueError(f"Dictionary key at index {i} is not a string")
+                keys[-1] = value
+            else:
+                container[keys[-1]] = value
+                keys[-1] = None
+    except IndexError:
+        raise ValueError("Truncated bencode data") from None
+
+    if i < size:
+        raise ValueError(f"Extra data after parsing at index {i}")
+    return value
+
+
+def info_hash_of(info):
+    """
+    SHA-1 info hash of an info dictionary.
+
+    Decoded dictionaries are hashed over their original bytes; anything
+    else (e.g. a dict built in code) is bencoded first.
+    """
+    raw = getattr(info, 'raw', None)
+    return hashlib.sha1(raw if raw is not None else bencode(info)).digest()
+
 
 def bencode(data):
     if isinstance(data, int):
         return b'i' + str(data).encode() + b'e'
-    elif isinstance(data, bytes):
+    elif isinstance(data, (bytes, bytearray)):
         return str(len(data)).encode() + b':' + data
+    elif isinstance(data, memoryview):
+        return str(data.nbytes).encode() + b':' + data.tobytes()
     elif isinstance(data, str):
         # Convert string to bytes (assuming UTF-8)
         data = data.encode('utf-8')
@@ -84,9 +153,3 @@ def bencode(data):
         return b''.join(result)
     else:
         raise ValueError(f"Unsupported type for bencoding: {type(data)}")
-    
-with open('test.torrent', 'rb') as f:
-    torrent_data = f.read()
-
-decoded = bdecode(torrent_data)
-pprint.pprint(decoded[b'info'])
\ No newline at end of file
@@ -0,0 +1,286 @@
+# In this file we frame the peer wire protocol on top of asyncio's
+# BufferedProtocol. Incoming bytes land in one preallocated receive buffer
+# and length-prefixed messages are parsed in place; handlers get memoryview
+# slices of that buffer, so nothing is copied just to be parsed.
+#
+# Piece payloads get special treatment: as soon as a piece header (13 bytes)
+# is in, the handler is asked where the block should go. If it answers with
+# a writable memoryview (a slice of the piece being assembled), whatever
+# part of the block is already buffered is copied there once, and the rest
+# is received by the socket directly into that slice.
+#
+# With a read limit (a TokenBucket) set, every read is charged to it and the
+# socket stops being read from while the bucket is in debt.
+#
+# Outgoing messages are not written one by one: write() queues them and they
+# go out together, in a single transport write, at the end of the current
+# event loop iteration (or as soon as WRITE_COALESCE_BYTES are queued). A
+# burst of requests, haves and cancels then costs one send() instead of one
+# per 17-byte message.
+
+import asyncio
+import struct
+
+HANDSHAKE_LENGTH = 68
+PIECE_HEADER_LENGTH = 13
+
+# Anything larger than this is not a sane peer message
+MAX_MESSAGE_LENGTH = 1 << 22
+# Queued outgoing bytes that are written right away instead of at the end of the loop iteration
+WRITE_COALESCE_BYTES = 64 * 1024
+
+_LENGTH = struct.Struct(">I")
+_PIECE_INDEX_BEGIN = struct.Struct(">II")
+
+
+class PeerWireProtocol(asyncio.BufferedProtocol):
+    """
+    Zero-copy framing for one peer connection.
+
+    The handler must provide:
+        handshake_received(data)
+        message_received(msg_id, payload)  # payload is only valid during the call
+        block_destination(index, begin, length)  # -> writable memoryview or None
+        block_received(index, begin, length)
+        connection_lost(exc)
+    """
+
+    def __init__(self, handler, buffer_size=256 * 1024):
+        self.handler = handler
+        self.transport = None
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._handshake_done = False
+
+        # Block currently being received straight into its destination
+        self._dest = None
+        self._dest_pos = 0
+        self._dest_block = None
+
+        # Outgoing messages waiting for the end of the loop iteration
+        self._outbound = []
+        self._outbound_bytes = 0
+        self._flush_scheduled = False
+
+        # Write flow control, so callers can wait for the send buffer to drain
+        self._paused = False
+        self._drain_waiter = None
+        self.closed = asyncio.get_running_loop().create_future()
+
+        # Optional TokenBucket that incoming bytes are charged to
+        self.read_limit = None
+        self._reading_paused = False
+
+    # asyncio.BaseProtocol
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self._dest = None
+        self._outbound.clear()
+        self._outbound_bytes = 0
+        if not self.closed.done():
+            self.closed.set_result(exc)
+        self._wake_drain(exc)
+        self.handler.connection_lost(exc)
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self._wake_drain(None)
+
+    # asyncio.BufferedProtocol
+
+    def get_buffer(self, sizehint):
+        if self._dest is not None:
+            return self._dest[self._dest_pos:]
+
+        free = len(self._buffer) - self._end
+        if free < PIECE_HEADER_LENGTH + 16 * 1024:
+            self._make_room()
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        if self.read_limit is not None:
+            delay = self.read_limit.consume(nbytes)
+            if delay > 0:
+                self._pause_reading(delay)
+
+        if self._dest is not None:
+            self._dest_pos += nbytes
+            if self._dest_pos == len(self._dest):
+                index, begin = self._dest_block
+                length = len(self._dest)
+                self._dest = None
+                self._dest_block = None
+                self.handler.block_received(index, begin, length)
+            return
+
+        self._end += nbytes
+        try:
+            self._parse()
+        except ValueError:
+            # Protocol violation; drop the connection
+            self.transport.close()
+
+    def _pause_reading(self, delay):
+        if self._reading_paused or self.transport.is_closing():
+            return
+        self._reading_paused = True
+        self.transport.pause_reading()
+        asyncio.get_running_loop().call_later(delay, self._resume_reading)
+
+    def _resume_reading(self):
+        self._reading_paused = False
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    # Parsing
+
+    def _parse(self):
+        buffer = self._buffer
+        view = self._view
+        start = self._start
+        end = self._end
+        handler = self.handler
+
+        while self._dest is None and not self.transport.is_closing():
+            available = end - start
+            if not self._handshake_done:
+                if available < HANDSHAKE_LENGTH:
+                    break
+                self._handshake_done = True
+                handler.handshake_received(bytes(view[start:start + HANDSHAKE_LENGTH]))
+                start += HANDSHAKE_LENGTH
+                # An inbound connection is handed to its torrent's handler here
+                handler = self.handler
+                continue
+
+            if available < 4:
+                break
+            length = _LENGTH.unpack_from(buffer, start)[0]
+            if length == 0:
+                # Keep-alive
+                start += 4
+                continue
+            if length > MAX_MESSAGE_LENGTH:
+                raise ValueError(f"Message of {length} bytes is too large")
+            if available < 5:
+                break
+            msg_id = buffer[start + 4]
+
+            if msg_id == 7 and length > 9:
+                if available < PIECE_HEADER_LENGTH:
+                    break
+                index, begin = _PIECE_INDEX_BEGIN.unpack_from(buffer, start + 5)
+                block_length = length - 9
+                dest = handler.block_destination(index, begin, block_length)
+                if dest is not None:
+                    body = start + PIECE_HEADER_LENGTH
+                    buffered = min(block_length, end - body)
+                    dest[:buffered] = view[body:body + buffered]
+                    start = body + buffered
+                    if buffered == block_length:
+                        handler.block_received(index, begin, block_length)
+                    else:
+                        # The rest of the block goes straight into dest
+                        self._dest = dest
+                        self._dest_pos = buffered
+                        self._dest_block = (index, begin)
+                    continue
+
+            if available < 4 + length:
+                break
+            handler.message_received(msg_id, view[start + 5:start + 4 + length])
+            start += 4 + length
+
+        if start == end:
+            start = end = 0
+        self._start = start
+        self._end = end
+
+    def divert_block(self, index, begin):
+        """
+        Stop receiving a block into its destination (e.g. it was cancelled).
+
+        If the block is arriving right now, the rest of it goes into a
+        scratch buffer instead, so its destination can be handed elsewhere.
+        """
+        if self._dest is not None and self._dest_block == (index, begin):
+            self._dest = memoryview(bytearray(len(self._dest)))
+
+    def _make_room(self):
+        """Move unparsed bytes to the front, growing the buffer for large messages."""
+        pending = self._end - self._start
+        needed = pending
+        if self._handshake_done and pending >= 4:
+            needed = 4 + _LENGTH.unpack_from(self._buffer, self._start)[0]
+
+        if needed > len(self._buffer):
+            size = len(self._buffer)
+            while size < needed:
+                size *= 2
+            buffer = bytearray(size)
+            buffer[:pending] = self._view[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        elif self._start:
+            # Only a partial message is left here, so this copy is small;
+            # bytes() avoids an overlapping in-place copy
+            self._buffer[:pending] = bytes(self._view[self._start:self._end])
+        self._start = 0
+        self._end = pending
+
+    # Writing
+
+    def write(self, data):
+        """Queue `data` to be sent with everything else written in this loop iteration."""
+        self._outbound.append(data)
+        self._outbound_bytes += len(data)
+        if self._outbound_bytes >= WRITE_COALESCE_BYTES:
+            self.flush()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._scheduled_flush)
+
+    def _scheduled_flush(self):
+        self._flush_scheduled = False
+        self.flush()
+
+    def flush(self):
+        """Hand every queued message to the transport now, in one write."""
+        if not self._outbound:
+            return
+        outbound = self._outbound
+        self._outbound = []
+        self._outbound_bytes = 0
+        if self.transport.is_closing():
+            return
+        if len(outbound) == 1:
+            self.transport.write(outbound[0])
+        else:
+            self.transport.writelines(outbound)
+
+    async def drain(self):
+        """Wait until the transport's send buffer is below its high-water mark."""
+        if self.transport.is_closing():
+            raise ConnectionResetError("Connection lost")
+        if not self._paused:
+            return
+        if self._drain_waiter is None:
+            self._drain_waiter = asyncio.get_running_loop().create_future()
+        await self._drain_waiter
+
+    def _wake_drain(self, exc):
+        waiter = self._drain_waiter
+        self._drain_waiter = None
+        if waiter is not None and not waiter.done():
+            if exc is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(exc)
@@ -0,0 +1,305 @@
+# In this file we decide which piece to download next.
+# Every connected peer's bitfield and have messages feed a per-piece
+# availability count. Candidate pieces (not yet downloaded and not being
+# downloaded) are kept in buckets keyed by that count, so updates are O(1)
+# and a rarest-first pick only walks buckets from the rarest upwards until
+# it finds a piece the asking peer has. Seeds are counted separately: they
+# raise every piece's availability equally, so they never change the
+# rarest-first order and adding one costs O(1) instead of O(pieces).
+#
+# For every other peer we also keep the set of pieces it has and how many of
+# them are still candidates, so a pick for a peer with nothing we want
+# returns at once, and a peer with only a few pieces is served from its own
+# set instead of a bucket walk that would mostly find pieces it lacks.
+
+import random
+from array import array
+
+RAREST_FIRST = 'rarest-first'
+SEQUENTIAL = 'sequential'
+
+
+class PiecePicker:
+    """Availability index and piece selection policies."""
+
+    def __init__(self, num_pieces, policy=RAREST_FIRST, random_first_pieces=4):
+        """
+        Args:
+            num_pieces: Number of pieces in the torrent.
+            policy: RAREST_FIRST or SEQUENTIAL (for streaming).
+            random_first_pieces: With rarest-first, pick this many pieces at
+                random first so we quickly have something to trade.
+        """
+        if policy not in (RAREST_FIRST, SEQUENTIAL):
+            raise ValueError(f"Unknown piece picking policy: {policy}")
+        self.num_pieces = num_pieces
+        self.policy = policy
+        self.random_first_pieces = random_first_pieces
+        self.num_have = 0
+
+        # How many connected non-seed peers have each piece, plus the seeds
+        self.availability = array('I', bytes(4 * num_pieces))
+        self.seeds = set()
+        self._full_bitfield = _full_bitfield(num_pieces)
+        self.have = bytearray(num_pieces)
+
+        # buckets[c] holds the candidate pieces with availability c, and
+        # position[p] is p's index inside its bucket (-1 if not a candidate)
+        self.buckets = [list(range(num_pieces))]
+        self.position = array('i', range(num_pieces))
+        self.num_candidates = num_pieces
+        self._sequential_cursor = 0
+
+        # Non-seed peers: the pieces each one has, and how many of those
+        # are candidates
+        self.peer_pieces = {}
+        self.interesting = {}
+
+    # Availability updates
+
+    def add_peer_bitfield(self, peer_key, bitfield):
+        """Count every piece in a peer's bitfield (message id 5)."""
+        if bytes(bitfield[:len(self._full_bitfield)]) == self._full_bitfield:
+            self.seeds.add(peer_key)
+            return
+        pieces = self._peer_pieces(peer_key)
+        interesting = self.interesting[peer_key]
+        for piece_idx in _set_bits(bitfield, self.num_pieces):
+            if piece_idx in pieces:
+                continue
+            pieces.add(piece_idx)
+            self._change_availability(piece_idx, 1)
+            if self.position[piece_idx] >= 0:
+                interesting += 1
+        self.interesting[peer_key] = interesting
+
+    def remove_peer_bitfield(self, peer_key, bitfield):
+        """Forget a disconnected peer's pieces."""
+        if peer_key in self.seeds:
+            self.seeds.discard(peer_key)
+            return
+        pieces = self.peer_pieces.pop(peer_key, None)
+        self.interesting.pop(peer_key, None)
+        if pieces is None:
+            pieces = _set_bits(bitfield, self.num_pieces)
+        for piece_idx in pieces:
+            self._change_availability(piece_idx, -1)
+
+    def piece_availability(self, piece_idx):
+        """Number of connected peers that have a piece."""
+        return self.availability[piece_idx] + len(self.seeds)
+
+    def add_have(self, peer_key, piece_idx):
+        """Count a single piece announced by a have message (message id 4)."""
+        if peer_key in self.seeds or not 0 <= piece_idx < self.num_pieces:
+            return
+        pieces = self._peer_pieces(peer_key)
+        if piece_idx in pieces:
+            return
+        pieces.add(piece_idx)
+        self._change_availability(piece_idx, 1)
+        if self.position[piece_idx] >= 0:
+            self.interesting[peer_key] += 1
+
+    def _peer_pieces(self, peer_key):
+        """A non-seed peer's piece set, creating it (and its count) on first use."""
+        pieces = self.peer_pieces.get(peer_key)
+        if pieces is None:
+            pieces = self.peer_pieces[peer_key] = set()
+            self.interesting[peer_key] = 0
+        return pieces
+
+    def _change_availability(self, piece_idx, delta):
+        count = self.availability[piece_idx]
+        if delta < 0 and count == 0:
+            return
+        if self.position[piece_idx] >= 0:
+            self._bucket_remove(piece_idx)
+            self.availability[piece_idx] = count + delta
+            self._bucket_add(piece_idx)
+        else:
+            self.availability[piece_idx] = count + delta
+
+    # Candidate bookkeeping
+
+    def _bucket_add(self, piece_idx):
+        count = self.availability[piece_idx]
+        while len(self.buckets) <= count:
+            self.buckets.append([])
+        bucket = self.buckets[count]
+        self.position[piece_idx] = len(bucket)
+        bucket.append(piece_idx)
+
+    def _bucket_remove(self, piece_idx):
+        bucket = self.buckets[self.availability[piece_idx]]
+        pos = self.position[piece_idx]
+        last = bucket.pop()
+        if last != piece_idx:
+            bucket[pos] = last
+            self.position[last] = pos
+        self.position[piece_idx] = -1
+
+    def _candidacy_changed(self, piece_idx, delta):
+        self.num_candidates += delta
+        for peer_key, pieces in self.peer_pieces.items():
+            if piece_idx in pieces:
+                self.interesting[peer_key] += delta
+
+    def is_interesting(self, peer_key):
+        """Whether the peer has a candidate piece."""
+        if peer_key in self.seeds:
+            return self.num_candidates > 0
+        return self.interesting.get(peer_key, 0) > 0
+
+    def is_candidate(self, piece_idx):
+        return self.position[piece_idx] >= 0
+
+    def mark_in_progress(self, piece_idx):
+        """Take a piece out of the candidates while it is being downloaded."""
+        if self.position[piece_idx] >= 0:
+            self._bucket_remove(piece_idx)
+            self._candidacy_changed(piece_idx, -1)
+
+    def release(self, piece_idx):
+        """Put a piece back into the candidates (download failed or aborted)."""
+        if not self.have[piece_idx] and self.position[piece_idx] < 0:
+            self._bucket_add(piece_idx)
+            self._candidacy_changed(piece_idx, 1)
+            if piece_idx < self._sequential_cursor:
+                self._sequential_cursor = piece_idx
+
+    def mark_have(self, piece_idx):
+        """Record a verified piece; it will never be picked again."""
+        if self.have[piece_idx]:
+            return
+        self.mark_in_progress(piece_idx)
+        self.have[piece_idx] = 1
+        self.num_have += 1
+
+    # Selection
+
+    def pick(self, has_piece, peer_key=None):
+        """
+        Choose and reserve the next piece to download from a peer.
+
+        Args:
+            has_piece: Callable telling whether the peer has a given piece.
+            peer_key: The key the peer's bitfield and haves were added
+                under, if any; lets the pick skip peers with nothing we need.
+
+        Returns:
+            int or None: The reserved piece index, or None if the peer has
+            nothing we still need.
+        """
+        pieces = self.peer_pieces.get(peer_key) if peer_key is not None else None
+        if pieces is not None and not self.interesting[peer_key]:
+            return None
+
+        if self.policy == SEQUENTIAL:
+            piece_idx = self._pick_sequential(has_piece)
+        else:
+            piece_idx = None
+            if self.num_have < self.random_first_pieces:
+                piece_idx = self._pick_random(has_piece)
+            if piece_idx is None:
+                # A bucket walk checks about num_candidates / interesting
+                # pieces before it finds one the peer has
+                if pieces is not None and \
+                        len(pieces) * self.interesting[peer_key] < self.num_candidates:
+                    piece_idx = self._pick_rarest_of(pieces)
+                else:
+                    piece_idx = self._pick_rarest(has_piece)
+
+        if piece_idx is not None:
+            self.mark_in_progress(piece_idx)
+        return piece_idx
+
+    def _pick_rarest(self, has_piece):
+        # Without seeds bucket 0 holds pieces nobody has, so skip it
+        first = 0 if self.seeds else 1
+        for bucket in self.buckets[first:]:
+            if not bucket:
+                continue
+            # Start at a random spot so peers do not all race for the same piece
+            start = random.randrange(len(bucket))
+            for i in range(start, len(bucket)):
+                if has_piece(bucket[i]):
+                    return bucket[i]
+            for i in range(start):
+                if has_piece(bucket[i]):
+                    return bucket[i]
+        return None
+
+    def _pick_rarest_of(self, pieces):
+        """The rarest candidate among a peer's pieces, ties broken at random."""
+        best = None
+        best_count = None
+        ties = 0
+        for piece_idx in pieces:
+            if self.position[piece_idx] < 0:
+                continue
+            count = self.availability[piece_idx]
+            if best is None or count < best_count:
+                best, best_count, ties = piece_idx, count, 1
+            elif count == best_count:
+                ties += 1
+                if random.randrange(ties) == 0:
+                    best = piece_idx
+        return best
+
+    def _pick_random(self, has_piece, attempts=32):
+        for _ in range(attempts):
+            piece_idx = random.randrange(self.num_pieces)
+            if self.position[piece_idx] >= 0 and has_piece(piece_idx):
+                return piece_idx
+        return None
+
+    def _pick_sequential(self, has_piece):
+        # Everything below the cursor is already downloaded
+        while self._sequential_cursor < self.num_pieces and self.have[self._sequential_cursor]:
+            self._sequential_cursor += 1
+        for piece_idx in range(self._sequential_cursor, self.num_pieces):
+            if self.position[piece_idx] >= 0 and has_piece(piece_idx):
+                return piece_idx
+        return None
+
+
+def _full_bitfield(num_pieces):
+    """The bitfield of a peer that has every piece."""
+    full_bytes, spare_bits = divmod(num_pieces, 8)
+    bitfield = b'\xff' * full_bytes
+    if spare_bits:
+        bitfield += bytes([(0xff << (8 - spare_bits)) & 0xff])
+    return bitfield
+
+
+def _set_bits(bitfield, limit):
+    """Yield the indices of the set bits in a bitfield, MSB first."""
+    for byte_idx, byte in enumerate(bitfield):
+        if not byte:
+            continue
+        base = byte_idx * 8
+        for bit in range(8):
+            if byte & (0x80 >> bit):
+                piece_idx = base + bit
+                if piece_idx >= limit:
+                    return
+                yield piece_idx
+
+
+if __name__ == "__main__":
+    # Regression checks for the per-peer counts
+    picker = PiecePicker(16, random_first_pieces=0)
+    picker.mark_have(5)
+    picker.mark_in_progress(6)
+    # A peer without a bitfield whose haves are all pieces we have or are fetching
+    picker.add_have('x', 5)
+    picker.add_have('x', 6)
+    assert picker.pick(lambda piece_idx: piece_idx in (5, 6), 'x') is None
+    # Other peers' picks and releases update its count without failing
+    picker.add_have('y', 7)
+    assert picker.pick(lambda piece_idx: piece_idx == 7, 'y') == 7
+    picker.release(6)
+    assert picker.interesting['x'] == 1
+    assert picker.pick(lambda piece_idx: piece_idx in (5, 6), 'x') == 6
+    print("ok")
@@ -0,0 +1,288 @@
+# In this file we profile a whole download run, to tell whether a slow
+# download is held up by the event loop, hashing, bencode parsing or the
+# network. RunProfiler is an async context manager that, while active:
+#   - wraps the engine's main coroutines and callbacks (peer workers, the
+#     per-peer download loop, receiving messages, bdecode, ...) and adds up
+#     the wall time and the CPU time of each. A coroutine's CPU time is
+#     measured around every step it runs on the event loop, so time spent
+#     suspended doesn't count; both are inclusive of what they call;
+#   - samples event-loop lag: how late a timer scheduled every few
+#     milliseconds actually fires, which is how long something blocked
+#     the loop;
+#   - runs cProfile on the event loop thread (hashing and disk writes run on
+#     their own threads; their timings are in the metrics snapshot).
+# On exit it writes a JSON report with sorted keys, so two runs (say, two
+# builds against the loopback seeders of bench.py) can be diffed, and the
+# raw cProfile data next to it (<report>.pstats) for pstats or snakeviz.
+
+import asyncio
+import cProfile
+import functools
+import importlib
+import inspect
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import time
+
+from metrics import REGISTRY, Histogram
+
+log = logging.getLogger(__name__)
+
+# (module, attribute) of what gets timed; attributes may be Class.method
+DEFAULT_TARGETS = (
+    ('connect_to_peer_async', 'TorrentDownloader.peer_worker'),
+    ('connect_to_peer_async', 'TorrentDownloader.run_peer'),
+    ('connect_to_peer_async', 'TorrentDownloader.download_from_peer'),
+    ('connect_to_peer_async', 'TorrentDownloader.fill_pipeline'),
+    ('connect_to_peer_async', 'TorrentDownloader.finish_piece'),
+    ('connect_to_peer_async', 'AsyncBitTorrentPeer.next_event'),
+    ('connect_to_peer_async', 'AsyncBitTorrentPeer.handle_message'),
+    ('peer_protocol', 'PeerWireProtocol.buffer_updated'),
+    ('seeding', 'Uploader._serve'),
+    ('parser', 'bdecode'),
+)
+# Functions listed in the report, by time spent in them
+TOP_FUNCTIONS = 40
+# Event loop lag histogram buckets, in seconds (0.01 must be one of them)
+LAG_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class CallStats:
+    """Wall and CPU time of every call to one function."""
+
+    __slots__ = ('calls', 'wall', 'cpu', 'max_wall')
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.max_wall = 0.0
+
+    def record(self, wall):
+        self.calls += 1
+        self.wall += wall
+        self.max_wall = max(self.max_wall, wall)
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'wall_seconds': round(self.wall, 6),
+            'cpu_seconds': round(self.cpu, 6),
+            'avg_wall_seconds': round(self.wall / self.calls, 6) if self.calls else 0.0,
+            'avg_cpu_seconds': round(self.cpu / self.calls, 6) if self.calls else 0.0,
+            'max_wall_seconds': round(self.max_wall, 6),
+        }
+
+
+class _TimedCoroutine:
+    """Runs a coroutine like `await` would, adding up the CPU time of each step."""
+
+    def __init__(self, coro, stats):
+        self._coro = coro
+        self._stats = stats
+
+    def __await__(self):
+        coro = self._coro
+        stats = self._stats
+        value = None
+        error = None
+        while True:
+            started = time.thread_time()
+            try:
+                if error is not None:
+                    yielded = coro.throw(error)
+                else:
+                    yielded = coro.send(value)
+            except StopIteration as e:
+                return e.value
+            finally:
+                stats.cpu += time.thread_time() - started
+            try:
+                value = yield yielded
+                error = None
+            except BaseException as e:
+                # Cancellation (or close()) goes to the coroutine we wrap
+                value = None
+                error = e
+
+
+def _timed(func, stats):
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def timed_coroutine(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await _TimedCoroutine(func(*args, **kwargs), stats)
+            finally:
+                stats.record(time.perf_counter() - started)
+        return timed_coroutine
+
+    @functools.wraps(func)
+    def timed_function(*args, **kwargs):
+        started = time.perf_counter()
+        cpu_started = time.thread_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stats.cpu += time.thread_time() - cpu_started
+            stats.record(time.perf_counter() - started)
+    return timed_function
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop runs a timer, every `interval` seconds.
+
+    Samples go into a fixed-bucket histogram, so a long (or seeding) run
+    takes constant memory; percentiles are reported as the upper bound of
+    the bucket they fall in.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lag = Histogram('event_loop_lag_seconds', "Event loop lag", buckets=LAG_BUCKETS)
+        self.max = 0.0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.lag.observe(lag)
+            self.max = max(self.max, lag)
+
+    def summary(self):
+        snapshot = self.lag.snapshot()
+        count = snapshot['count']
+        if not count:
+            return {'samples': 0}
+
+        def percentile(fraction):
+            for bound, cumulative in snapshot['buckets'].items():
+                if cumulative >= fraction * count:
+                    return round(min(bound, self.max), 6)
+
+        return {
+            'samples': count,
+            'interval_seconds': self.interval,
+            'mean_seconds': round(snapshot['sum'] / count, 6),
+            'p50_seconds': percentile(0.50),
+            'p90_seconds': percentile(0.90),
+            'p99_seconds': percentile(0.99),
+            'max_seconds': round(self.max, 6),
+            # Samples in which the loop had been blocked for over 10 ms
+            'blocked_over_10ms': count - snapshot['buckets'][0.01],
+        }
+
+
+class RunProfiler:
+    """Profiles everything run on the event loop while the context is active."""
+
+    def __init__(self, output_path, targets=DEFAULT_TARGETS, use_cprofile=True, lag_interval=0.01):
+        """
+        Args:
+            output_path: Where to write the JSON report (the cProfile data
+                goes to the same path plus `.pstats`).
+            targets: (module, attribute) pairs of the functions to time.
+            use_cprofile: Also run cProfile (several times slower).
+            lag_interval: Seconds between event-loop lag samples.
+        """
+        self.output_path = output_path
+        self.targets = targets
+        self.use_cprofile = use_cprofile
+        self.lag = LoopLagMonitor(lag_interval)
+        self.stats = {}
+        self.profile = None
+        self._patches = []
+        self._started = None
+        self._cpu_started = None
+
+    async def __aenter__(self):
+        self._patch()
+        self.lag.start()
+        self._started = time.perf_counter()
+        self._cpu_started = time.process_time()
+        if self.use_cprofile:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.profile is not None:
+            self.profile.disable()
+        wall = time.perf_counter() - self._started
+        cpu = time.process_time() - self._cpu_started
+        await self.lag.stop()
+        self._unpatch()
+        self.write_report(wall, cpu)
+
+    def _patch(self):
+        for module_name, attribute in self.targets:
+            owner = importlib.import_module(module_name)
+            *path, name = attribute.split('.')
+            for part in path:
+                owner = getattr(owner, part)
+            original = owner.__dict__[name]
+            wrapped = _timed(original, self.stats.setdefault(f"{module_name}.{attribute}", CallStats()))
+            # `from module import func` copies are patched as well
+            owners = [owner]
+            if not path:
+                owners += [module for module in list(sys.modules.values())
+                           if module is not owner and getattr(module, name, None) is original]
+            for patched in owners:
+                setattr(patched, name, wrapped)
+                self._patches.append((patched, name, original))
+
+    def _unpatch(self):
+        for owner, name, original in reversed(self._patches):
+            setattr(owner, name, original)
+        self._patches.clear()
+
+    def write_report(self, wall, cpu):
+        report = {
+            'python': sys.version.split()[0],
+            'wall_seconds': round(wall, 6),
+            'process_cpu_seconds': round(cpu, 6),
+            'functions': {name: stats.as_dict() for name, stats in self.stats.items()},
+            'event_loop_lag': self.lag.summary(),
+            'metrics': REGISTRY.as_dict(),
+        }
+        if self.profile is not None:
+            pstats_path = self.output_path + '.pstats'
+            self.profile.dump_stats(pstats_path)
+            report['cprofile'] = {'pstats_file': pstats_path, 'top': self._top_functions()}
+        with open(self.output_path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        log.info("Profile written to %s", self.output_path)
+
+    def _top_functions(self):
+        """
+        The functions with the most time of their own, keyed file:line(name)
+        (file names without their directory, so reports diff across machines).
+        """
+        stats = pstats.Stats(self.profile, stream=io.StringIO())
+        entries = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+        top = {}
+        for (filename, line, name), (_, calls, own, cumulative, _) in entries[:TOP_FUNCTIONS]:
+            top[f"{os.path.basename(filename)}:{line}({name})"] = {
+                'calls': calls,
+                'own_seconds': round(own, 6),
+                'cumulative_seconds': round(cumulative, 6),
+            }
+        return top
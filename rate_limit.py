@@ -0,0 +1,144 @@
+# In this file we limit bandwidth with token buckets.
+# A bucket fills at `rate` bytes per second up to `burst` bytes, and traffic
+# takes tokens out of it. Buckets nest: every peer has one for each
+# direction whose parent is its torrent's, whose parent is the session's,
+# so a byte counts against all three and the tightest level sets the pace.
+#
+# Taking tokens never waits by itself. consume() goes into debt and returns
+# how long until the debt is paid off, and callers decide how to wait:
+# sockets we read from are paused for that long, new block requests are held
+# back until the download bucket is out of debt, and uploads sleep before
+# the next block. With no rate set anywhere consume() just returns 0, so an
+# unlimited transfer never touches the event loop for it. Rates can be
+# changed at any time.
+
+import asyncio
+import time
+
+# Seconds of traffic a bucket can save up by default
+DEFAULT_BURST_SECONDS = 1.0
+
+
+class TokenBucket:
+    """Limits one direction of traffic to `rate` bytes/s (0: unlimited)."""
+
+    def __init__(self, rate=0, burst=None, parent=None):
+        """
+        Args:
+            rate: Bytes per second; 0 means no limit at this level.
+            burst: Bytes that may be sent at once after an idle period
+                (default: one second's worth, at least 16 KiB).
+            parent: Enclosing bucket (e.g. the torrent's, for a peer).
+        """
+        self.parent = parent
+        self.rate = 0
+        self.burst = 0
+        self.tokens = 0.0
+        self._last = time.monotonic()
+        # When this bucket last had to hold traffic back
+        self.last_throttled = 0.0
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        """Change the limit; takes effect for the next bytes consumed."""
+        self._refill(time.monotonic())
+        self.rate = max(0, rate or 0)
+        if burst is None:
+            burst = max(16 * 1024, self.rate * DEFAULT_BURST_SECONDS)
+        self.burst = burst
+        self.tokens = min(self.tokens, self.burst) if self.rate else 0.0
+
+    @property
+    def limited(self):
+        """Whether this bucket or one of its parents has a rate set."""
+        bucket = self
+        while bucket is not None:
+            if bucket.rate:
+                return True
+            bucket = bucket.parent
+        return False
+
+    def consume(self, nbytes):
+        """
+        Take `nbytes` of tokens from this bucket and its parents.
+
+        Returns:
+            float: Seconds to hold back further traffic (0 if none).
+        """
+        delay = 0.0
+        now = None
+        bucket = self
+        while bucket is not None:
+            if bucket.rate:
+                if now is None:
+                    now = time.monotonic()
+                bucket._refill(now)
+                bucket.tokens -= nbytes
+                if bucket.tokens < 0:
+                    bucket.last_throttled = now
+                    delay = max(delay, -bucket.tokens / bucket.rate)
+            bucket = bucket.parent
+        return delay
+
+    def debt_delay(self):
+        """Seconds until every level is out of debt, without consuming anything."""
+        delay = 0.0
+        now = None
+        bucket = self
+        while bucket is not None:
+            if bucket.rate:
+                if now is None:
+                    now = time.monotonic()
+                bucket._refill(now)
+                if bucket.tokens < 0:
+                    delay = max(delay, -bucket.tokens / bucket.rate)
+            bucket = bucket.parent
+        return delay
+
+    async def throttle(self, nbytes):
+        """Consume `nbytes` and sleep if that put any level in debt."""
+        delay = self.consume(nbytes)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def throttled_within(self, seconds):
+        """Whether any level held traffic back in the last `seconds`."""
+        now = time.monotonic()
+        bucket = self
+        while bucket is not None:
+            if bucket.rate and now - bucket.last_throttled < seconds:
+                return True
+            bucket = bucket.parent
+        return False
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+
+class RateLimits:
+    """A download and an upload bucket for one level (session, torrent or peer)."""
+
+    def __init__(self, download_rate=0, upload_rate=0, parent=None):
+        """
+        Args:
+            download_rate: Ingress limit in bytes/s (0: unlimited).
+            upload_rate: Egress limit in bytes/s (0: unlimited).
+            parent: The enclosing level's RateLimits.
+        """
+        self.download = TokenBucket(download_rate,
+                                    parent=parent.download if parent is not None else None)
+        self.upload = TokenBucket(upload_rate,
+                                  parent=parent.upload if parent is not None else None)
+
+    def child(self, download_rate=0, upload_rate=0):
+        """Limits for a level inside this one (a torrent's peer, say)."""
+        return RateLimits(download_rate, upload_rate, parent=self)
+
+    def set_rates(self, download_rate=None, upload_rate=None):
+        """Change either limit at runtime (None leaves it as it is, 0 removes it)."""
+        if download_rate is not None:
+            self.download.set_rate(download_rate)
+        if upload_rate is not None:
+            self.upload.set_rate(upload_rate)
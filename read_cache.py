@@ -0,0 +1,121 @@
+# In this file we keep popular pieces in memory for uploading.
+# Peers request pieces in 16 KiB blocks, and when many peers pull the same
+# piece we would otherwise read it from disk block by block, once per peer.
+# ReadCache reads a whole piece the first time any block of it is asked for
+# (read-ahead: the rest of the piece is almost always requested next) and
+# keeps whole pieces under a byte budget, evicting the least recently used.
+# Concurrent misses on one piece share a single disk read, which runs on a
+# thread (the disk I/O pool's, if given) so the event loop never waits on
+# the disk.
+#
+# Pieces we have just downloaded and verified can be inserted directly:
+# they are the ones other peers ask for next, and we already hold them.
+
+import asyncio
+from collections import OrderedDict
+
+DEFAULT_CACHE_SIZE = 32 * 1024 * 1024
+
+
+class ReadCache:
+    """LRU cache of whole pieces in front of PieceStorage reads."""
+
+    def __init__(self, storage, max_bytes=DEFAULT_CACHE_SIZE, read_ahead=True, executor=None):
+        """
+        Args:
+            storage: The PieceStorage to read from.
+            max_bytes: Memory budget for cached pieces.
+            read_ahead: Read (and cache) the whole piece on a miss; if
+                False only the requested block is read and nothing is cached.
+            executor: Executor for disk reads (the loop's default if None).
+        """
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.read_ahead = read_ahead
+        self.executor = executor
+        self.size = 0
+        # piece index -> bytes-like, least recently used first
+        self._pieces = OrderedDict()
+        # piece index -> future of a disk read in progress
+        self._loading = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_reads = 0
+        self.disk_bytes = 0
+
+    async def read_block(self, piece_idx, begin, length):
+        """
+        Return a block of a verified piece.
+
+        Returns:
+            A bytes-like object (a view of the cached piece on a hit).
+        """
+        piece = self._pieces.get(piece_idx)
+        if piece is not None:
+            self.hits += 1
+            self._pieces.move_to_end(piece_idx)
+            return memoryview(piece)[begin:begin + length]
+
+        self.misses += 1
+        if not self.read_ahead or self.storage.piece_size(piece_idx) > self.max_bytes:
+            return await self._read(self.storage.read_block, piece_idx, begin, length)
+
+        loading = self._loading.get(piece_idx)
+        if loading is None:
+            loading = asyncio.ensure_future(self._read(self.storage.read_piece, piece_idx))
+            self._loading[piece_idx] = loading
+            loading.add_done_callback(lambda future: self._loaded(piece_idx, future))
+        # Other peers may be waiting on the same read; don't cancel it for them
+        piece = await asyncio.shield(loading)
+        return memoryview(piece)[begin:begin + length]
+
+    async def _read(self, read, *args):
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(self.executor, read, *args)
+        self.disk_reads += 1
+        self.disk_bytes += len(data)
+        return data
+
+    def _loaded(self, piece_idx, future):
+        self._loading.pop(piece_idx, None)
+        if not future.cancelled() and future.exception() is None:
+            self.insert(piece_idx, future.result())
+
+    def insert(self, piece_idx, data):
+        """Cache a whole piece; it must not be modified afterwards."""
+        if len(data) > self.max_bytes:
+            return
+        old = self._pieces.pop(piece_idx, None)
+        if old is not None:
+            self.size -= len(old)
+        self._pieces[piece_idx] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self._pieces.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def invalidate(self, piece_idx):
+        data = self._pieces.pop(piece_idx, None)
+        if data is not None:
+            self.size -= len(data)
+
+    def clear(self):
+        self._pieces.clear()
+        self.size = 0
+
+    def stats(self):
+        """Counters for monitoring how well the cache works."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'cached_pieces': len(self._pieces),
+            'cached_bytes': self.size,
+            'disk_reads': self.disk_reads,
+            'disk_bytes': self.disk_bytes,
+        }
@@ -0,0 +1,144 @@
+# In this file we make restarts cheap.
+# A resume file records which pieces were verified plus the size and mtime
+# of every output file. If the files are untouched on the next start we
+# trust the bitfield and skip hashing entirely; otherwise recheck_pieces
+# re-verifies whatever data is already on disk, reading it in large
+# sequential chunks and hashing the pieces in parallel on the HashPool.
+
+import asyncio
+import os
+from parser import bdecode, bencode
+
+RESUME_SUFFIX = '.resume'
+
+
+def resume_path_for(storage):
+    """Where the resume file for a storage lives (next to the output)."""
+    return storage.output_path.rstrip(os.sep) + RESUME_SUFFIX
+
+
+def pieces_to_bitfield(pieces, num_pieces):
+    """Pack a collection of piece indices into a BitTorrent bitfield."""
+    bitfield = bytearray((num_pieces + 7) // 8)
+    for piece_idx in pieces:
+        bitfield[piece_idx // 8] |= 0x80 >> (piece_idx % 8)
+    return bytes(bitfield)
+
+
+def bitfield_to_pieces(bitfield, num_pieces):
+    """Unpack a bitfield into the set of piece indices it contains."""
+    return {i for i in range(num_pieces) if bitfield[i // 8] & (0x80 >> (i % 8))}
+
+
+def save_resume_data(path, info_hash, pieces, storage):
+    """
+    Write the resume file for a download.
+
+    Call this only when every piece in `pieces` has been written, since
+    the file mtimes recorded here are what vouches for the data.
+
+    Args:
+        path: Resume file path.
+        info_hash: The torrent's 20-byte info hash.
+        pieces: Indices of the verified pieces.
+        storage: The PieceStorage holding them.
+    """
+    stats = storage.file_stats()
+    if stats is None:
+        return
+    resume = {
+        b'info-hash': info_hash,
+        b'pieces': pieces_to_bitfield(pieces, storage.num_pieces),
+        b'files': [[size, mtime_ns] for size, mtime_ns in stats],
+    }
+    # Write to a temporary file first so a crash never leaves a torn resume file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(bencode(resume))
+    os.replace(tmp_path, path)
+
+
+def load_resume_data(path, info_hash, storage):
+    """
+    Load the verified pieces from a resume file.
+
+    Returns:
+        set or None: The piece indices, or None if there is no resume file,
+        it belongs to another torrent, or any output file changed since it
+        was written (in which case the data has to be rechecked).
+    """
+    try:
+        with open(path, 'rb') as f:
+            resume = bdecode(f.read())
+    except (OSError, ValueError):
+        return None
+
+    if resume.get(b'info-hash') != info_hash:
+        return None
+    stats = storage.file_stats()
+    if stats is None or [list(s) for s in stats] != resume.get(b'files'):
+        return None
+    bitfield = resume.get(b'pieces', b'')
+    if len(bitfield) != (storage.num_pieces + 7) // 8:
+        return None
+    return bitfield_to_pieces(bitfield, storage.num_pieces)
+
+
+async def recheck_pieces(storage, get_piece_hash, hash_pool, read_size=16 * 1024 * 1024):
+    """
+    Verify the data already on disk.
+
+    Consecutive pieces are read in large sequential chunks on a reader
+    thread while earlier chunks are hashed on the HashPool, so the disk and
+    every core stay busy. Pieces whose data did not exist before
+    storage.open() are skipped without being read.
+
+    Args:
+        storage: An opened PieceStorage.
+        get_piece_hash: Callable returning the expected hash of a piece.
+        hash_pool: HashPool used for hashing.
+        read_size: Approximate size of each sequential read in bytes.
+
+    Returns:
+        set: Indices of the pieces whose data is valid.
+    """
+    loop = asyncio.get_running_loop()
+    pieces_per_read = max(1, read_size // storage.piece_length)
+    valid = set()
+    checks = []
+
+    async def check(piece_idx, digest):
+        if await digest == get_piece_hash(piece_idx):
+            valid.add(piece_idx)
+
+    for first, count in _on_disk_runs(storage, pieces_per_read):
+        offset = first * storage.piece_length
+        length = min(count * storage.piece_length, storage.total_length - offset)
+        chunk = await loop.run_in_executor(None, storage.readinto_at, offset, bytearray(length))
+        view = memoryview(chunk)
+        for piece_idx in range(first, first + count):
+            start = (piece_idx - first) * storage.piece_length
+            piece = view[start:start + storage.piece_size(piece_idx)]
+            digest = await hash_pool.submit(piece)
+            checks.append(asyncio.ensure_future(check(piece_idx, digest)))
+
+    await asyncio.gather(*checks)
+    return valid
+
+
+def _on_disk_runs(storage, max_count):
+    """Yield (first_piece, count) runs of pieces whose data is on disk."""
+    first = None
+    for piece_idx in range(storage.num_pieces):
+        offset = piece_idx * storage.piece_length
+        if storage.on_disk(offset, storage.piece_size(piece_idx)):
+            if first is None:
+                first = piece_idx
+            if piece_idx - first + 1 == max_count:
+                yield first, max_count
+                first = None
+        elif first is not None:
+            yield first, piece_idx - first
+            first = None
+    if first is not None:
+        yield first, storage.num_pieces - first
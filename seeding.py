@@ -0,0 +1,333 @@
+# In this file we upload. PeerServer listens for inbound connections and
+# hands each one, after its handshake, to the torrent whose info hash it
+# asked for. Uploader serves block requests from the on-disk storage on
+# every connection (inbound or outbound) and decides whom to serve with a
+# tit-for-tat choker: every 10 seconds the interested peers that gave us the
+# most data over the last round (or, once we are seeding, that took the most
+# from us) are unchoked, and every 30 seconds one more peer is unchoked at
+# random, so new peers get a chance to prove themselves and we get to find
+# better ones. Blocks are read through a ReadCache, so a popular piece is
+# read from disk once however many peers want it, and are sent no faster
+# than the connection's upload limit (see rate_limit.py) allows.
+
+import asyncio
+import logging
+import random
+import time
+
+from peer_protocol import PeerWireProtocol
+from resume import pieces_to_bitfield
+
+log = logging.getLogger(__name__)
+
+PROTOCOL_NAME = b"BitTorrent protocol"
+
+# Peers we upload to at once, including the optimistic unchoke
+UPLOAD_SLOTS = 4
+CHOKE_INTERVAL = 10
+# Optimistic unchokes rotate every this many choke rounds (30 s)
+OPTIMISTIC_ROUNDS = 3
+# Peers connected for less than this get three times the optimistic chance
+NEW_PEER_AGE = 60
+
+# Larger requests are refused (16 KiB is what every client sends)
+MAX_REQUEST_LENGTH = 128 * 1024
+# Requests a peer may have queued with us before further ones are dropped
+MAX_QUEUED_REQUESTS = 512
+# Seconds an inbound connection has to send its handshake
+HANDSHAKE_TIMEOUT = 10
+# Inbound connections that may be waiting for their handshake at once
+MAX_PENDING_HANDSHAKES = 64
+
+
+class _InboundProtocol(PeerWireProtocol):
+    """PeerWireProtocol that tells its _InboundHandshake when the connection is made."""
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.handler.connection_made()
+
+
+class _InboundHandshake:
+    """Handler of an inbound connection until its handshake tells us the torrent."""
+
+    def __init__(self, server):
+        self.server = server
+        self.protocol = None
+        self.timer = None
+
+    def connection_made(self):
+        # Every connection holds a receive buffer, so don't let silent ones pile up
+        if len(self.server.pending) >= MAX_PENDING_HANDSHAKES:
+            self.protocol.transport.close()
+            return
+        self.server.pending.add(self)
+        self.timer = asyncio.get_running_loop().call_later(HANDSHAKE_TIMEOUT,
+                                                           self.protocol.transport.close)
+
+    def _done(self):
+        self.server.pending.discard(self)
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def handshake_received(self, data):
+        self._done()
+        if data[0] != len(PROTOCOL_NAME) or data[1:20] != PROTOCOL_NAME:
+            self.protocol.transport.close()
+            return
+        torrent = self.server.lookup(data[28:48])
+        if torrent is None:
+            self.protocol.transport.close()
+            return
+        # The torrent replaces us as the protocol's handler
+        torrent.accept_peer(self.protocol, data)
+
+    def message_received(self, msg_id, payload):
+        pass
+
+    def block_destination(self, index, begin, length):
+        return None
+
+    def block_received(self, index, begin, length):
+        pass
+
+    def connection_lost(self, exc):
+        self._done()
+
+
+class PeerServer:
+    """Listening socket for inbound peer connections."""
+
+    def __init__(self, port=6881, host='0.0.0.0'):
+        self.port = port
+        self.host = host
+        # info_hash -> object with accept_peer(protocol, handshake)
+        self.torrents = {}
+        self.server = None
+        # Inbound connections that haven't sent their handshake yet
+        self.pending = set()
+
+    def add_torrent(self, info_hash, torrent):
+        self.torrents[info_hash] = torrent
+
+    def remove_torrent(self, info_hash):
+        self.torrents.pop(info_hash, None)
+
+    def lookup(self, info_hash):
+        return self.torrents.get(info_hash)
+
+    async def start(self):
+        """
+        Start listening.
+
+        Returns:
+            bool: False if the port could not be bound (we can still download).
+        """
+        if self.server is not None:
+            return True
+        loop = asyncio.get_running_loop()
+        try:
+            self.server = await loop.create_server(self._new_connection, self.host, self.port)
+        except OSError as e:
+            log.error("Cannot listen on port %d: %s", self.port, e)
+            return False
+        log.info("Listening for peers on port %d", self.port)
+        return True
+
+    def _new_connection(self):
+        handler = _InboundHandshake(self)
+        handler.protocol = _InboundProtocol(handler)
+        return handler.protocol
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        for handler in list(self.pending):
+            handler.protocol.transport.close()
+
+
+class Uploader:
+    """Serves our verified pieces to the peers of one torrent and chokes them."""
+
+    def __init__(self, num_pieces, piece_size, have, is_seeding, upload_slots=UPLOAD_SLOTS,
+                 choke_interval=CHOKE_INTERVAL):
+        """
+        Args:
+            num_pieces: Number of pieces in the torrent.
+            piece_size: Callable returning the length of a piece.
+            have: Container of the verified piece indices (only these are served).
+            is_seeding: Callable telling whether the download is complete.
+            upload_slots: Peers unchoked at once, including the optimistic one.
+            choke_interval: Seconds between choke rounds.
+        """
+        self.num_pieces = num_pieces
+        self.piece_size = piece_size
+        self.have = have
+        self.is_seeding = is_seeding
+        self.upload_slots = upload_slots
+        self.choke_interval = choke_interval
+        self.cache = None
+
+        self.peers = {}
+        self.optimistic = None
+        self.bytes_uploaded = 0
+        self._task = None
+        # Per peer: bytes received from / sent to it at the last choke round
+        self._last_received = {}
+        self._last_sent = {}
+
+    def start(self, cache):
+        """Serve blocks through `cache` (a ReadCache) and start choking rounds."""
+        self.cache = cache
+        if self._task is None:
+            self._task = asyncio.create_task(self._choke_loop())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for peer in list(self.peers):
+            self.remove_peer(peer)
+
+    def add_peer(self, peer):
+        """Start uploading on a connection that just finished its handshake."""
+        self.peers[peer] = time.monotonic()
+        peer.uploader = self
+        if self.have:
+            peer.send_bitfield(self.bitfield())
+
+    def remove_peer(self, peer):
+        if self.peers.pop(peer, None) is None:
+            return
+        peer.uploader = None
+        peer.upload_queue.clear()
+        if peer.upload_task is not None:
+            peer.upload_task.cancel()
+            peer.upload_task = None
+        self._last_received.pop(peer, None)
+        self._last_sent.pop(peer, None)
+        if self.optimistic is peer:
+            self.optimistic = None
+
+    def bitfield(self):
+        return pieces_to_bitfield(self.have, self.num_pieces)
+
+    def piece_verified(self, piece_idx, data=None):
+        """
+        Tell every peer that doesn't have it yet about a new piece.
+
+        Args:
+            data: The verified piece, cached (without a copy) if anyone
+                may ask us for it.
+        """
+        wanted = False
+        for peer in self.peers:
+            if peer.connected and not peer.has_piece(piece_idx):
+                peer.send_have(piece_idx)
+                wanted = wanted or peer.peer_interested
+        if data is not None and wanted and self.cache is not None:
+            self.cache.insert(piece_idx, data)
+
+    # Callbacks from AsyncBitTorrentPeer
+
+    def interest_changed(self, peer):
+        """Fill a free upload slot right away instead of waiting for the next round."""
+        if peer.peer_interested and peer.choked and self._unchoked_count() < self.upload_slots:
+            peer.send_unchoke()
+
+    def request_received(self, peer, index, begin, length):
+        if peer.choked or not self._valid_request(index, begin, length):
+            return
+        if len(peer.upload_queue) >= MAX_QUEUED_REQUESTS:
+            return
+        peer.upload_queue.append((index, begin, length))
+        if peer.upload_task is None:
+            peer.upload_task = asyncio.create_task(self._serve(peer))
+
+    def cancel_received(self, peer, index, begin, length):
+        try:
+            peer.upload_queue.remove((index, begin, length))
+        except ValueError:
+            pass
+
+    def _valid_request(self, index, begin, length):
+        if index >= self.num_pieces or index not in self.have:
+            return False
+        if length == 0 or length > MAX_REQUEST_LENGTH:
+            return False
+        return begin + length <= self.piece_size(index)
+
+    async def _serve(self, peer):
+        """Send queued blocks to one peer, waiting whenever its socket is backed up."""
+        try:
+            while peer.upload_queue and peer.connected and not peer.choked:
+                index, begin, length = peer.upload_queue.popleft()
+                block = await self.cache.read_block(index, begin, length)
+                if peer.choked or not peer.connected:
+                    break
+                # Only sleeps when an upload limit is in debt
+                await peer.limits.upload.throttle(length)
+                if peer.choked or not peer.connected:
+                    break
+                peer.send_block(index, begin, block)
+                self.bytes_uploaded += length
+                await peer.protocol.drain()
+        except ConnectionError:
+            pass
+        except OSError as e:
+            # The storage was closed under us (the torrent is stopping), or a read failed
+            log.debug("Cannot serve %s:%d: %s", peer.ip, peer.port, e)
+        finally:
+            peer.upload_task = None
+
+    # Choking
+
+    def _unchoked_count(self):
+        return sum(1 for peer in self.peers if not peer.choked)
+
+    async def _choke_loop(self):
+        rounds = 0
+        while True:
+            await asyncio.sleep(self.choke_interval)
+            self.choke_round(rotate_optimistic=rounds % OPTIMISTIC_ROUNDS == 0)
+            rounds += 1
+
+    def choke_round(self, rotate_optimistic=False):
+        """Unchoke the best reciprocating peers plus one optimistic unchoke."""
+        seeding = self.is_seeding()
+        rates = {}
+        for peer in self.peers:
+            received = peer.bytes_received - self._last_received.get(peer, 0)
+            sent = peer.bytes_sent - self._last_sent.get(peer, 0)
+            self._last_received[peer] = peer.bytes_received
+            self._last_sent[peer] = peer.bytes_sent
+            # Leeching: reward who gives us data. Seeding: prefer who takes it fastest
+            rates[peer] = sent if seeding else received
+
+        interested = [peer for peer in self.peers if peer.connected and peer.peer_interested]
+        interested.sort(key=rates.get, reverse=True)
+        unchoke = set(interested[:max(0, self.upload_slots - 1)])
+
+        if rotate_optimistic or self.optimistic not in self.peers or not self.optimistic.peer_interested:
+            self.optimistic = self._pick_optimistic(interested, unchoke)
+        if self.optimistic is not None:
+            unchoke.add(self.optimistic)
+
+        for peer in self.peers:
+            if not peer.connected:
+                continue
+            if peer in unchoke:
+                if peer.choked:
+                    peer.send_unchoke()
+            elif not peer.choked:
+                peer.send_choke()
+
+    def _pick_optimistic(self, interested, unchoked):
+        candidates = [peer for peer in interested if peer not in unchoked]
+        if not candidates:
+            return None
+        now = time.monotonic()
+        weights = [3 if now - self.peers[peer] < NEW_PEER_AGE else 1 for peer in candidates]
+        return random.choices(candidates, weights)[0]
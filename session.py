@@ -0,0 +1,184 @@
+# In this file we run many torrents in one process and one event loop.
+# A Session owns everything torrents can share: the listening port (inbound
+# handshakes are routed to the right torrent by info hash), the UDP tracker
+# socket, the hashing threads, the disk I/O queue, a limit on peer
+# connections across all torrents and the session-wide bandwidth limits
+# (every torrent's limits are nested in them). Each torrent added to it
+# gets its own TorrentDownloader and AnnounceManager, running as a task of
+# the session: it downloads, then seeds (if asked to) until it is removed
+# or the session is closed.
+
+import asyncio
+import logging
+import os
+
+from announce_manager import AnnounceManager
+from connect_to_peer_async import TorrentDownloader
+from disk_io import DiskQueue
+from get_peers import make_peer_id
+from hash_pool import HashPool
+from metainfo import as_metainfo
+from rate_limit import RateLimits
+from seeding import PeerServer, UPLOAD_SLOTS
+from udp_parser import UDPTrackerClient
+
+log = logging.getLogger(__name__)
+
+# Peer connections across every torrent of the session
+MAX_CONNECTIONS = 500
+# Read cache of each torrent; smaller than a lone download's, as there are many
+TORRENT_CACHE_SIZE = 4 * 1024 * 1024
+
+
+class Session:
+    """Downloads and seeds many torrents with shared sockets, threads and limits."""
+
+    def __init__(self, port=6881, max_connections=MAX_CONNECTIONS, max_peers_per_torrent=50,
+                 hash_workers=None, disk_workers=2, upload_slots=UPLOAD_SLOTS,
+                 cache_size=TORRENT_CACHE_SIZE, peer_id=None, download_rate=0, upload_rate=0):
+        """
+        Args:
+            port: The port we accept peers on, for every torrent.
+            max_connections: Peer connections across all torrents.
+            max_peers_per_torrent: Peer connections per torrent.
+            hash_workers: Hashing threads (default: CPU count).
+            disk_workers: Disk I/O threads.
+            upload_slots: Peers each torrent uploads to at once.
+            cache_size: Read cache of each torrent, in bytes.
+            peer_id: Our 20-byte peer ID, the same for every torrent (random
+                if omitted).
+            download_rate: Total ingress limit in bytes/s (0: unlimited).
+            upload_rate: Total egress limit in bytes/s (0: unlimited).
+        """
+        self.port = port
+        self.max_connections = max_connections
+        self.max_peers_per_torrent = max_peers_per_torrent
+        self.upload_slots = upload_slots
+        self.cache_size = cache_size
+        self.peer_id = peer_id or make_peer_id()
+
+        self.server = PeerServer(port)
+        self.udp_client = UDPTrackerClient()
+        self.hash_pool = HashPool(max_workers=hash_workers)
+        self.disk_queue = DiskQueue(max_workers=disk_workers)
+        self.connection_slots = asyncio.Semaphore(max_connections)
+        self.limits = RateLimits(download_rate, upload_rate)
+
+        # info_hash -> TorrentDownloader, and the task running each one
+        self.torrents = {}
+        self.tasks = {}
+        self._closed = False
+
+    async def start(self):
+        """Start listening for inbound peers (downloads work without it)."""
+        return await self.server.start()
+
+    def set_rates(self, download_rate=None, upload_rate=None):
+        """Change the session-wide limits (None keeps one, 0 removes it)."""
+        self.limits.set_rates(download_rate, upload_rate)
+
+    def add_torrent(self, torrent, output_path=None, peers=(), seed=True, download_rate=0,
+                    upload_rate=0, on_complete=None):
+        """
+        Start downloading (and then seeding) a torrent.
+
+        Args:
+            torrent: A Metainfo, or the path to a .torrent file.
+            output_path: Where to save it (default: the torrent's name in
+                the current directory).
+            peers: (ip, port) tuples to try besides the trackers' peers.
+            seed: Keep uploading after the download completes.
+            download_rate: This torrent's ingress limit in bytes/s (0: only
+                the session's applies); see downloader.limits to change it.
+            upload_rate: This torrent's egress limit in bytes/s.
+            on_complete: Called with the downloader once the download is
+                complete (before seeding starts).
+
+        Returns:
+            TorrentDownloader: The torrent's downloader.
+        """
+        if self._closed:
+            raise RuntimeError("Session is closed")
+        metainfo = as_metainfo(torrent)
+        if metainfo.info_hash in self.torrents:
+            raise ValueError(f"Torrent {metainfo.name!r} is already in the session")
+        if output_path is None:
+            output_path = os.path.basename(metainfo.name) or metainfo.info_hash.hex()
+
+        announcer = None
+        if metainfo.announce or metainfo.announce_list:
+            announcer = AnnounceManager(metainfo, peer_id=self.peer_id, port=self.port,
+                                        udp_client=self.udp_client)
+        downloader = TorrentDownloader(metainfo, list(peers), self.max_peers_per_torrent,
+                                       hash_pool=self.hash_pool, disk_queue=self.disk_queue,
+                                       announcer=announcer, seed=seed,
+                                       upload_slots=self.upload_slots, cache_size=self.cache_size,
+                                       server=self.server, connection_slots=self.connection_slots,
+                                       peer_id=self.peer_id,
+                                       rate_limits=self.limits.child(download_rate, upload_rate))
+        self.torrents[metainfo.info_hash] = downloader
+        task = asyncio.create_task(self._run_torrent(downloader, output_path, on_complete))
+        self.tasks[metainfo.info_hash] = task
+        task.add_done_callback(lambda _: self._torrent_done(metainfo.info_hash, task))
+        return downloader
+
+    async def _run_torrent(self, downloader, output_path, on_complete=None):
+        """Download one torrent, then seed it until it is stopped."""
+        try:
+            complete = await downloader.download(output_path)
+            if complete and on_complete is not None:
+                on_complete(downloader)
+            if complete and downloader.seed:
+                await downloader.stopped.wait()
+            return complete
+        finally:
+            await downloader.stop()
+
+    def _torrent_done(self, info_hash, task):
+        if self.tasks.get(info_hash) is task:
+            del self.tasks[info_hash]
+            del self.torrents[info_hash]
+        if not task.cancelled() and task.exception() is not None:
+            log.error("Torrent %s failed: %s", info_hash.hex(), task.exception())
+
+    async def remove_torrent(self, info_hash):
+        """Stop a torrent (sending its `stopped` announce) and forget it."""
+        task = self.tasks.get(info_hash)
+        if task is None:
+            return
+        # The task stops its downloader on the way out, downloading or seeding
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    async def wait(self):
+        """
+        Wait until every torrent has stopped (or finished, if not seeding).
+
+        Returns:
+            dict: info_hash -> whether the torrent completed (an exception
+            if it failed).
+        """
+        tasks = dict(self.tasks)
+        results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        return dict(zip(tasks, results))
+
+    async def close(self):
+        """Stop every torrent, then release the shared port, sockets and threads."""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            await asyncio.gather(*(self.remove_torrent(info_hash) for info_hash in list(self.torrents)),
+                                 return_exceptions=True)
+        finally:
+            self.server.close()
+            self.udp_client.close()
+            await self.disk_queue.close()
+            self.hash_pool.close()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
@@ -0,0 +1,375 @@
+# In this file we keep downloaded pieces on disk instead of in memory.
+# The output file(s) are preallocated up front and every verified piece is
+# written straight to its offset, so a download never has to hold more
+# than the pieces that are currently in flight.
+#
+# A torrent is one contiguous byte stream cut into pieces; for multi-file
+# torrents that stream is the concatenation of info[b'files'], so a piece
+# (or even a block) may straddle several files. We build a piece -> file
+# index once and serve every read/write with pread/pwrite on memoryview
+# slices, so no intermediate copies are made.
+#
+# Reads and writes run on worker threads (the disk queue, the read cache,
+# rechecks). Descriptors are kept in an LRU of at most max_open_files, and
+# each one counts the calls using it: only idle descriptors are evicted, so
+# a descriptor is never closed (and its number reused for another file)
+# under a running pread/pwrite. close() waits for those calls to finish.
+
+import errno
+import os
+import threading
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+
+# Most buffers a single pwritev() call accepts
+try:
+    _IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 1024
+
+
+class PieceStorage:
+    """Preallocated on-disk storage addressed by piece index."""
+
+    def __init__(self, files, piece_length, max_open_files=64, root=None):
+        """
+        Args:
+            files: List of (path, length) tuples in torrent order.
+            piece_length: Nominal piece length from the info dictionary.
+            max_open_files: How many file descriptors to keep open at once.
+            root: The output path the files were laid out under, if any.
+        """
+        self.files = [(path, length) for path, length in files]
+        self.root = root
+        self.piece_length = piece_length
+        self.max_open_files = max_open_files
+        self.total_length = sum(length for _, length in self.files)
+        self.num_pieces = -(-self.total_length // piece_length) if self.total_length else 0
+
+        # file_offsets[i] is where file i starts in the torrent byte stream
+        self.file_offsets = array('Q')
+        offset = 0
+        for _, length in self.files:
+            self.file_offsets.append(offset)
+            offset += length
+
+        # piece_first_file[p] is the first file that piece p touches
+        self.piece_first_file = array('I', bytes(4 * self.num_pieces))
+        file_idx = 0
+        for piece_idx in range(self.num_pieces):
+            start = piece_idx * piece_length
+            while self._file_end(file_idx) <= start:
+                file_idx += 1
+            self.piece_first_file[piece_idx] = file_idx
+
+        # file_idx -> [fd, calls using it], least recently used first
+        self._fds = OrderedDict()
+        self._fds_lock = threading.Lock()
+        # Notified whenever a call is done with its descriptor
+        self._fd_released = threading.Condition(self._fds_lock)
+        self._closed = False
+        self.opened = False
+        # Size of each file before open() preallocated it (0 if it was missing)
+        self.existing_sizes = [0] * len(self.files)
+
+    @classmethod
+    def from_info(cls, info, output_path, **kwargs):
+        """
+        Build storage for an info dictionary.
+
+        For single-file torrents `output_path` is the file itself. For
+        multi-file torrents it is the directory the files are created in.
+        """
+        piece_length = info[b'piece length']
+        if b'files' not in info:
+            return cls([(output_path, info[b'length'])], piece_length, root=output_path, **kwargs)
+
+        files = []
+        for entry in info[b'files']:
+            path = _safe_join(output_path, entry[b'path'])
+            files.append((path, entry[b'length']))
+        return cls(files, piece_length, root=output_path, **kwargs)
+
+    @property
+    def output_path(self):
+        """Path of the output file, or the common directory for multi-file torrents."""
+        if self.root is not None:
+            return self.root
+        if len(self.files) == 1:
+            return self.files[0][0]
+        return os.path.commonpath([path for path, _ in self.files])
+
+    def piece_size(self, piece_idx):
+        """Length of a piece in bytes (the last piece may be shorter)."""
+        start = piece_idx * self.piece_length
+        return min(self.piece_length, self.total_length - start)
+
+    def open(self):
+        """
+        Create every file and preallocate it to its final size.
+
+        Existing data is kept, so partially written files can be reused.
+        """
+        if self.opened:
+            return
+        with self._fds_lock:
+            self._closed = False
+        for file_idx, (path, length) in enumerate(self.files):
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                size = os.fstat(fd).st_size
+                self.existing_sizes[file_idx] = size
+                if size != length:
+                    _preallocate(fd, length)
+            finally:
+                os.close(fd)
+        self.opened = True
+
+    def spans(self, offset, length):
+        """
+        Map a range of the torrent byte stream onto the files.
+
+        Yields:
+            (file_idx, file_offset, chunk_offset, chunk_length) tuples, where
+            chunk_offset is relative to `offset`.
+        """
+        if offset < 0 or offset + length > self.total_length:
+            raise ValueError(f"Range {offset}+{length} is outside the torrent")
+        piece_idx = offset // self.piece_length
+        if piece_idx < self.num_pieces:
+            file_idx = self.piece_first_file[piece_idx]
+        else:
+            file_idx = bisect_right(self.file_offsets, offset) - 1
+
+        done = 0
+        while done < length:
+            position = offset + done
+            while self._file_end(file_idx) <= position:
+                file_idx += 1
+            file_offset = position - self.file_offsets[file_idx]
+            chunk = min(length - done, self._file_end(file_idx) - position)
+            yield file_idx, file_offset, done, chunk
+            done += chunk
+
+    def on_disk(self, offset, length):
+        """Whether a range was already backed by file data before open()."""
+        return all(file_offset + chunk <= self.existing_sizes[file_idx]
+                   for file_idx, file_offset, _, chunk in self.spans(offset, length))
+
+    def file_stats(self):
+        """
+        (size, mtime_ns) of every file, or None if any file is missing.
+        """
+        stats = []
+        for path, _ in self.files:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                return None
+            stats.append((st.st_size, st.st_mtime_ns))
+        return stats
+
+    def write_at(self, offset, data):
+        """Write `data` at an absolute offset of the torrent byte stream."""
+        view = memoryview(data)
+        for file_idx, file_offset, start, chunk in self.spans(offset, len(view)):
+            fd = self._acquire(file_idx)
+            try:
+                _pwrite_all(fd, view[start:start + chunk], file_offset)
+            finally:
+                self._release(file_idx)
+
+    def writev_at(self, offset, buffers):
+        """
+        Write consecutive buffers starting at an absolute offset.
+
+        Every file the range touches gets a single pwritev() call (where
+        available) for all the buffers that fall into it.
+        """
+        views = [memoryview(buffer) for buffer in buffers]
+        total = sum(len(view) for view in views)
+        view_idx = 0
+        view_pos = 0
+        for file_idx, file_offset, _, chunk in self.spans(offset, total):
+            iov = []
+            while chunk:
+                view = views[view_idx]
+                take = min(len(view) - view_pos, chunk)
+                iov.append(view[view_pos:view_pos + take])
+                chunk -= take
+                view_pos += take
+                if view_pos == len(view):
+                    view_idx += 1
+                    view_pos = 0
+            fd = self._acquire(file_idx)
+            try:
+                _pwritev_all(fd, iov, file_offset)
+            finally:
+                self._release(file_idx)
+
+    def readinto_at(self, offset, buffer):
+        """Fill a writable buffer from an absolute offset of the torrent byte stream."""
+        view = memoryview(buffer)
+        for file_idx, file_offset, start, chunk in self.spans(offset, len(view)):
+            fd = self._acquire(file_idx)
+            try:
+                _preadinto(fd, view[start:start + chunk], file_offset)
+            finally:
+                self._release(file_idx)
+        return buffer
+
+    def write_block(self, piece_idx, begin, data):
+        """Write a block of a piece; the block may cross file boundaries."""
+        self.write_at(piece_idx * self.piece_length + begin, data)
+
+    def read_block(self, piece_idx, begin, length):
+        """Read a block of a piece into a new bytearray."""
+        buffer = bytearray(length)
+        return self.readinto_at(piece_idx * self.piece_length + begin, buffer)
+
+    def write_piece(self, piece_idx, data):
+        """Write a verified piece at its place in the output file(s)."""
+        if len(data) != self.piece_size(piece_idx):
+            raise ValueError(f"Piece {piece_idx} has the wrong length ({len(data)} bytes)")
+        self.write_block(piece_idx, 0, data)
+
+    def read_piece(self, piece_idx):
+        """Read a whole piece back from disk."""
+        return self.read_block(piece_idx, 0, self.piece_size(piece_idx))
+
+    def close(self):
+        """
+        Flush and close every open file.
+
+        Reads and writes still running on other threads are waited for;
+        later ones fail with EBADF until the storage is opened again.
+        """
+        with self._fds_lock:
+            self._closed = True
+            while any(entry[1] for entry in self._fds.values()):
+                self._fd_released.wait()
+            while self._fds:
+                _, (fd, _) = self._fds.popitem(last=False)
+                os.fsync(fd)
+                os.close(fd)
+        self.opened = False
+
+    def _file_end(self, file_idx):
+        return self.file_offsets[file_idx] + self.files[file_idx][1]
+
+    def _acquire(self, file_idx):
+        """
+        Return an open descriptor for a file and count one more call using
+        it; _release() must follow. Opening one evicts the least recently
+        used idle descriptor (if every one is busy, the limit is exceeded
+        until they are released).
+        """
+        with self._fds_lock:
+            if self._closed:
+                raise OSError(errno.EBADF, "Storage is closed")
+            entry = self._fds.get(file_idx)
+            if entry is not None:
+                self._fds.move_to_end(file_idx)
+                entry[1] += 1
+                return entry[0]
+            if len(self._fds) >= self.max_open_files:
+                self._evict_idle(self.max_open_files - 1)
+            fd = os.open(self.files[file_idx][0], os.O_RDWR)
+            self._fds[file_idx] = [fd, 1]
+            return fd
+
+    def _release(self, file_idx):
+        with self._fds_lock:
+            entry = self._fds[file_idx]
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._fd_released.notify_all()
+                if len(self._fds) > self.max_open_files:
+                    self._evict_idle(self.max_open_files)
+
+    def _evict_idle(self, keep):
+        """Close the least recently used descriptors nobody is using, down to `keep`."""
+        for file_idx in [idx for idx, (_, users) in self._fds.items() if not users]:
+            if len(self._fds) <= keep:
+                break
+            fd, _ = self._fds.pop(file_idx)
+            os.close(fd)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def _safe_join(root, components):
+    """Join torrent path components under `root`, refusing to escape it."""
+    parts = []
+    for component in components:
+        name = component.decode('utf-8', errors='replace')
+        if name in ('', '.', '..') or '/' in name or '\\' in name:
+            raise ValueError(f"Unsafe path component in torrent: {name!r}")
+        parts.append(name)
+    if not parts:
+        raise ValueError("Empty path in torrent file list")
+    return os.path.join(root, *parts)
+
+
+def _preallocate(fd, length):
+    """Size the file to `length` bytes, reserving the blocks when possible."""
+    os.ftruncate(fd, length)
+    if length and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, length)
+        except OSError:
+            # Not every filesystem supports fallocate; a sparse file is fine.
+            pass
+
+
+def _pwrite_all(fd, view, offset):
+    """Write all of `view` at `offset`, retrying on short writes."""
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def _pwritev_all(fd, iov, offset):
+    """Write a list of buffers back to back at `offset`, retrying on short writes."""
+    if not hasattr(os, 'pwritev'):
+        for view in iov:
+            _pwrite_all(fd, view, offset)
+            offset += len(view)
+        return
+    first = 0
+    while first < len(iov):
+        written = os.pwritev(fd, iov[first:first + _IOV_MAX], offset)
+        offset += written
+        # Drop the buffers that were written completely, trim a partial one
+        while written:
+            length = len(iov[first])
+            if written < length:
+                iov[first] = iov[first][written:]
+                break
+            written -= length
+            first += 1
+
+
+def _preadinto(fd, view, offset):
+    """Read exactly len(view) bytes at `offset` straight into `view`."""
+    while view:
+        if hasattr(os, 'preadv'):
+            count = os.preadv(fd, [view], offset)
+        else:
+            data = os.pread(fd, len(view), offset)
+            count = len(data)
+            view[:count] = data
+        if count == 0:
+            raise EOFError(f"Unexpected end of file at offset {offset}")
+        view = view[count:]
+        offset += count
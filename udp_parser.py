@@ -1,85 +1,259 @@
-import socket
+# In this file we talk to udp:// trackers (BEP 15) with asyncio.
+# One UDPTrackerClient owns one datagram socket, and every announce (for
+# any torrent, to any tracker) goes through it: transaction IDs map replies
+# back to the waiting request. Connection IDs are cached per tracker for
+# their 60 second lifetime, and concurrent announces to the same tracker
+# share one connect request. Lost packets are retransmitted after
+# 15 * 2^n seconds, n = 0..8, as the spec asks.
+
+import asyncio
+import logging
 import random
+import socket
 import struct
 import time
-import binascii
-
-def get_peers_from_udp_tracker(announce_url, info_hash, peer_id, left, port=6881, numwant=50):
-    from urllib.parse import urlparse
-    parse = urlparse(announe_url)
-    if parsed.scheme != 'udp':
-        return []
-    host = parsed.hostname
-    tracker_port =  parsed.port or 80
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.settimeout(8)
-
-    connection_id = _udp_connect(sock, (host, tracker_port))
-    if not connection_id:
-        return []
-
-    peers = _udp_announce(sock, (host,tracker_port),connection_id, info_hash, peer_id, left, port, numwant)
-    sock.close()
-    return peers
-
- def _udp_connect(sock, addr):
-        protocol_id = 0x41727101980
-        action = 0
-        transaction_id = random.randint(0, 0xFFFFFFFF)
-        request = struct.pack("!qui", protocol_id, action, transaction_id)
-
-        for attempt touchdown in range(5):
-            try:
-                sock.sendto(request,addr)
-                response = sock.recv(1024)
-                if len(response)<16:
-                    continue
-                action_resp, trans_id_resp, conn_id = struct.unpack("!iiq", response[:16])
-                if trans_id_resp == transaction_id and action_resp == 0:
-                    return conn_id
-             except socket.timeout:
-                pass
- return None
-
- def  _udp_announce(sock, addr, connection_id, info_hash, peer_id, downloaded, left, uploaded, port, numwant):
-    action =1
-    transaction_id = random.randint(0, 0xFFFFFFFF)
-    key = random.randint(0, 0xFFFFFFFF)
-    ip = 0  # default
-
-    request = struct.pack("!qii20s20sQQQiiiIH",
-                          connection_id, action, transaction_id,
-                          info_hash, peer_id,
-                          downloaded, left, uploaded,
-                          2,  # event: started
-                          ip, key, numwant, port)
-    for _ in range(5):
+from urllib.parse import urlparse
+
+from get_peers import AnnounceResult, parse_compact_peers
+
+log = logging.getLogger(__name__)
+
+UDP_PROTOCOL_ID = 0x41727101980
+
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_ERROR = 3
+
+EVENTS = {None: 0, '': 0, 'completed': 1, 'started': 2, 'stopped': 3}
+
+# A connection ID may be used for one minute after it was received
+CONNECTION_ID_LIFETIME = 60
+
+_CONNECT = struct.Struct("!qII")
+_CONNECT_RESPONSE = struct.Struct("!IIq")
+_ANNOUNCE = struct.Struct("!qII20s20sQQQIIIiH")
+_ANNOUNCE_RESPONSE = struct.Struct("!IIIII")
+_HEADER = struct.Struct("!II")
+
+
+class UDPTrackerProtocol(asyncio.DatagramProtocol):
+    """Routes tracker replies to the request waiting on their transaction ID."""
+
+    def __init__(self):
+        self.transport = None
+        self.transactions = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 8:
+            return
+        action, transaction_id = _HEADER.unpack_from(data)
+        waiter = self.transactions.pop(transaction_id, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result((action, data))
+
+    def error_received(self, exc):
+        # ICMP errors (e.g. port unreachable) are treated like lost packets;
+        # the retransmit timer takes care of them
+        pass
+
+    def connection_lost(self, exc):
+        for waiter in self.transactions.values():
+            if not waiter.done():
+                waiter.set_exception(exc or ConnectionResetError("Tracker socket closed"))
+        self.transactions.clear()
+
+
+class UDPTrackerClient:
+    """Asynchronous BEP 15 client multiplexing announces over one socket."""
+
+    def __init__(self, timeout_base=15, max_retries=8):
+        """
+        Args:
+            timeout_base: Seconds to wait for the first reply (15 in BEP 15).
+            max_retries: Retransmissions before giving up (8 in BEP 15).
+        """
+        self.timeout_base = timeout_base
+        self.max_retries = max_retries
+        self.protocol = None
+        # (host, port) -> (connection_id, received_at)
+        self._connection_ids = {}
+        # (host, port) -> task fetching a connection ID
+        self._connecting = {}
+        self._addresses = {}
+        # Concurrent first announces must not each open a socket
+        self._start_lock = asyncio.Lock()
+
+    async def start(self):
+        """Open the shared socket."""
+        async with self._start_lock:
+            if self.protocol is None:
+                loop = asyncio.get_running_loop()
+                _, self.protocol = await loop.create_datagram_endpoint(
+                    UDPTrackerProtocol, local_addr=('0.0.0.0', 0), family=socket.AF_INET)
+        return self
+
+    def close(self):
+        if self.protocol is not None:
+            self.protocol.transport.close()
+            self.protocol = None
+        for task in self._connecting.values():
+            task.cancel()
+        self._connecting.clear()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    async def announce(self, announce_url, info_hash, peer_id, left, port=6881, numwant=50,
+                       downloaded=0, uploaded=0, event='started'):
+        """
+        Announce to a udp:// tracker.
+
+        Args:
+            announce_url (str): The tracker URL, e.g. udp://tracker.example:1337/announce.
+            info_hash (bytes): The torrent's 20-byte info hash.
+            peer_id (bytes): Our 20-byte peer ID.
+            left (int): Bytes we still need.
+            port (int): The port we accept peers on.
+            numwant (int): Number of peers to ask for.
+            downloaded (int): Bytes downloaded so far.
+            uploaded (int): Bytes uploaded so far.
+            event (str): 'started', 'completed', 'stopped' or None.
+
+        Returns:
+            AnnounceResult: The peers plus the tracker's interval and swarm counts.
+
+        Raises:
+            ValueError: If the URL is not udp:// or the tracker returns an error.
+            asyncio.TimeoutError: If the tracker never answers.
+        """
+        parsed = urlparse(announce_url)
+        if parsed.scheme != 'udp' or not parsed.hostname:
+            raise ValueError(f"Not a UDP tracker URL: {announce_url}")
+        await self.start()
+        addr = await self._resolve(parsed.hostname, parsed.port or 80)
+        key = random.getrandbits(32)
+
+        def build(connection_id, transaction_id):
+            return _ANNOUNCE.pack(connection_id, ACTION_ANNOUNCE, transaction_id,
+                                  info_hash, peer_id, downloaded, left, uploaded,
+                                  EVENTS[event], 0, key, numwant, port)
+
+        data = await self._transact(addr, ACTION_ANNOUNCE, build)
+        if len(data) < _ANNOUNCE_RESPONSE.size:
+            raise ValueError("Short announce response from UDP tracker")
+        _, _, interval, leechers, seeders = _ANNOUNCE_RESPONSE.unpack_from(data)
+        peers_data = data[_ANNOUNCE_RESPONSE.size:]
+        peers = parse_compact_peers(peers_data[:len(peers_data) - len(peers_data) % 6])
+        log.debug("UDP tracker %s:%d: %d peers (seeders = %d, leechers = %d)",
+                  addr[0], addr[1], len(peers), seeders, leechers)
+        return AnnounceResult(peers, interval, None, seeders, leechers)
+
+    async def _transact(self, addr, action, build):
+        """Send a request with BEP 15 retransmission, reconnecting as needed."""
+        n = 0
+        while True:
+            timeout = self.timeout_base * 2 ** n
             try:
-                sock.sendto(request, addr)
-                sock.settimeout(8)
-                response = sock.recv(4098)
-
-                if len(response) < 20:
-                    continue
-                action_resp. trans_id_resp = struct.unpack("!ii", response[:8])
-                if trans_id_resp != transaction_id or action_resp != 1:
-                    continue 
-                interval  = struct.unpack("!i", response[8:12])[0]
-                leachers = struct.unpack("!i", response[12:16])[0]
-                seeders =  struct.unpack("!i", response[16:20])[0]
-
-                peers = []
-                peer_data = response[20:]
-                for i in range(0, len(peer_data),6):
-                    if i+6 > len(peer_data):
-                        break
-                    ip_bytes = peer_data[i:i+4]
-                    port = struct.unpack("!H", peer_data[i+4:i:6])[0]
-                    ip = ".".join(str(b) for b in ip_bytes)
-                    peers.append((ip,port))
-                print(f"udp tracker: {len(peers)} peers (seeders ={seeder}, leechers = {leechers})")
-                return peers
-
-            except socket.timeout:
-                pass
-return []
\ No newline at end of file
+                connection_id = await self._connection_id(addr, timeout)
+                transaction_id = self._new_transaction_id()
+                reply_action, data = await self._send(addr, build(connection_id, transaction_id),
+                                                      transaction_id, timeout)
+            except asyncio.TimeoutError:
+                if n >= self.max_retries:
+                    raise
+                n += 1
+                continue
+
+            if reply_action == ACTION_ERROR:
+                message = data[8:].decode('utf-8', errors='replace')
+                raise ValueError(f"Tracker failure: {message}")
+            if reply_action != action:
+                raise ValueError(f"Unexpected action {reply_action} from UDP tracker")
+            return data
+
+    async def _connection_id(self, addr, timeout):
+        """Return a live connection ID for a tracker, connecting if needed."""
+        cached = self._connection_ids.get(addr)
+        if cached is not None and time.monotonic() - cached[1] < CONNECTION_ID_LIFETIME:
+            return cached[0]
+
+        task = self._connecting.get(addr)
+        if task is None:
+            task = asyncio.create_task(self._connect(addr, timeout))
+            self._connecting[addr] = task
+            task.add_done_callback(lambda t: self._connect_done(addr, t))
+        # Other announces may be waiting on the same connect; don't cancel it for them
+        return await asyncio.shield(task)
+
+    def _connect_done(self, addr, task):
+        self._connecting.pop(addr, None)
+        # Everyone waiting may have given up already; don't leave the error unretrieved
+        if not task.cancelled():
+            task.exception()
+
+    async def _connect(self, addr, timeout):
+        transaction_id = self._new_transaction_id()
+        request = _CONNECT.pack(UDP_PROTOCOL_ID, ACTION_CONNECT, transaction_id)
+        action, data = await self._send(addr, request, transaction_id, timeout)
+        if action != ACTION_CONNECT or len(data) < _CONNECT_RESPONSE.size:
+            raise ValueError("Invalid connect response from UDP tracker")
+        connection_id = _CONNECT_RESPONSE.unpack_from(data)[2]
+        self._connection_ids[addr] = (connection_id, time.monotonic())
+        return connection_id
+
+    async def _send(self, addr, request, transaction_id, timeout):
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        # Hold on to this socket's protocol: close() may drop it while we wait
+        protocol = self.protocol
+        if protocol is None:
+            raise ConnectionResetError("Tracker socket closed")
+        protocol.transactions[transaction_id] = waiter
+        try:
+            protocol.transport.sendto(request, addr)
+            return await asyncio.wait_for(waiter, timeout)
+        finally:
+            protocol.transactions.pop(transaction_id, None)
+
+    def _new_transaction_id(self):
+        while True:
+            transaction_id = random.getrandbits(32)
+            if transaction_id not in self.protocol.transactions:
+                return transaction_id
+
+    async def _resolve(self, host, port):
+        addr = self._addresses.get((host, port))
+        if addr is None:
+            loop = asyncio.get_running_loop()
+            infos = await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            if not infos:
+                raise ValueError(f"Could not resolve UDP tracker {host}")
+            addr = infos[0][4][:2]
+            self._addresses[(host, port)] = addr
+        return addr
+
+
+async def get_peers_from_udp_tracker(announce_url, info_hash, peer_id, left, port=6881,
+                                     numwant=50, client=None):
+    """
+    Announce once to a udp:// tracker and return its peers.
+
+    Args:
+        client: A started UDPTrackerClient to share; a temporary one is
+            used if omitted.
+
+    Returns:
+        list: List of tuples (ip_str, port_int) for peers.
+    """
+    if client is not None:
+        result = await client.announce(announce_url, info_hash, peer_id, left, port, numwant)
+        return result.peers
+    async with UDPTrackerClient() as client:
+        result = await client.announce(announce_url, info_hash, peer_id, left, port, numwant)
+        return result.peers